@@ -2,11 +2,27 @@
 # Source this file from individual blob scripts.
 #   source "$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)/../lib.sh"
 
+# Checks the hashes in parallel and caches them by inode, size and mtime, so
+# that unchanged blobs are not hashed again (see me_hashes.py --help).
+ME_HASHES="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)/utils/me_cleaner/me_hashes.py"
+
+have_me_hashes() {
+	command -v python3 >/dev/null 2>&1 && [[ -f "$ME_HASHES" ]]
+}
+
 # Verify sha256sum for a file.  Exit with error on mismatch.
 chk_sha256sum() {
 	local sha256_hash="$1"
 	local filename="$2"
 	echo "$sha256_hash" "$filename" "$(pwd)"
+	if have_me_hashes; then
+		# A fresh download: nothing to reuse from the cache
+		if ! python3 "$ME_HASHES" --no-cache -p "${sha256_hash} ${filename}"; then
+			echo "ERROR: SHA256 checksum for ${filename} doesn't match."
+			exit 1
+		fi
+		return 0
+	fi
 	sha256sum "$filename"
 	if ! echo "${sha256_hash} ${filename}" | sha256sum --check; then
 		echo "ERROR: SHA256 checksum for ${filename} doesn't match."
@@ -21,6 +37,14 @@ chk_sha256sum() {
 check_outputs() {
 	local all_ok=y
 	local pair hash path
+	if have_me_hashes; then
+		local args=()
+		for pair in "$@"; do
+			args+=(-p "$(echo "$pair" | tr -s ' ')")
+		done
+		[[ ${#args[@]} -eq 0 ]] || python3 "$ME_HASHES" "${args[@]}"
+		return
+	fi
 	for pair in "$@"; do
 		pair="$(echo "$pair" | tr -s ' ')"
 		hash="${pair%% *}"
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+# me_bench - Benchmarks of me_cleaner and me7_update_parser
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# Each case generates a synthetic image with me_synth (once, in the work
+# directory), runs a scenario on it a few times in this process and keeps
+# the timings of each phase reported by me_cleaner (see Report.phase): parse,
+# partitions, modules, relocate, truncate, extract, write, signature and
+# total. me7_update_parser is timed as a whole (clean) and for the final
+# signature check (verify).
+#
+# The results are printed (or saved) as JSON; with --compare, the phases
+# slower than in a previous result file are listed and the exit status is 1.
+
+from __future__ import division, print_function
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import me_cleaner
+import me_signature
+import me_synth
+
+ME7_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                       "xx20")
+
+MIB = 1024 * 1024
+
+# As given on the command line: argparse converts them with int_list()
+DEFAULT_GENS = "1,2,3"
+DEFAULT_SIZES = "1,4,16,64"
+DEFAULT_CHUNKS = "64,256,1024"
+DEFAULT_ME7_CHUNKS = "32,96,160"
+
+# Phases faster than this are too noisy to be compared
+MIN_COMPARED_TIME = 0.001
+
+
+def me_size_for(size):
+    """Size of the ME region of a synthetic full dump of the given size: a
+    quarter of it, but at least 1.5 MiB when there is room for it"""
+    return max(size // 4, min(size - 0x10000, 0x180000))
+
+
+def image_name(image):
+    if image["gen"] == 7:
+        name = "me7-update"
+    else:
+        name = "gen{}-{}M".format(image["gen"], image["size"] // MIB)
+    if image.get("chunks"):
+        name += "-c{}".format(image["chunks"])
+    if image.get("modules"):
+        name += "-m{}".format(image["modules"])
+    return name
+
+
+def generate(image, work_dir):
+    """Return the path of the synthetic image, generating it if needed"""
+    path = os.path.join(work_dir, image_name(image) + ".bin")
+    if os.path.exists(path):
+        return path
+
+    kwargs = {}
+    if image.get("modules"):
+        kwargs["num_modules"] = image["modules"]
+    if image.get("chunks"):
+        kwargs["chunk_count"] = image["chunks"]
+
+    if image["gen"] == 7:
+        data = me_synth.build_me7_update(**kwargs)
+    else:
+        data = me_synth.build_full_dump(image["size"], image["me_size"],
+                                        image["gen"], **kwargs)
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.rename(path + ".tmp", path)
+    return path
+
+
+def me_cleaner_options(scenario, gen, out_dir):
+    """CleanOptions of a scenario: check only, or a full cleaning of the
+    dump with relocation, truncation and extraction"""
+    if scenario == "check":
+        return me_cleaner.CleanOptions(check=True, json=True)
+
+    options = me_cleaner.CleanOptions(output=os.path.join(out_dir, "out.bin"),
+                                      json=True)
+    if gen != 1:
+        options.soft_disable = options.relocate = options.truncate = True
+        options.extract_descriptor = os.path.join(out_dir, "descriptor.bin")
+        options.extract_me = os.path.join(out_dir, "me.bin")
+    return options
+
+
+def clear_outputs(out_dir):
+    for name in os.listdir(out_dir):
+        os.unlink(os.path.join(out_dir, name))
+
+
+def summarize(runs):
+    """Reduce the timings of each run to the minimum and median wall time
+    and the median CPU time of each phase"""
+
+    def median(values):
+        values = sorted(values)
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2
+
+    phases = {}
+    for name in sorted(set().union(*runs)):
+        timings = [run[name] for run in runs if name in run]
+        phases[name] = {
+            "wall": min(t["wall"] for t in timings),
+            "wall_median": median([t["wall"] for t in timings]),
+            "cpu": median([t["cpu"] for t in timings]),
+        }
+    return phases
+
+
+def bench_me_cleaner(path, image, scenario, repeat, out_dir):
+    runs = []
+    for _ in range(repeat):
+        clear_outputs(out_dir)
+        # Every run must verify the signatures again
+        me_signature._verified.clear()
+        report = me_cleaner.Report(text=False)
+        me_cleaner.clean(path, me_cleaner_options(scenario, image["gen"],
+                                                  out_dir), report)
+        runs.append(report.data["timings"])
+    return summarize(runs)
+
+
+def bench_me7(path, repeat, out_dir):
+    sys.path.insert(0, ME7_DIR)
+    import me7_update_parser
+
+    output = os.path.join(out_dir, "me.bin")
+    runs = []
+    for _ in range(repeat):
+        clear_outputs(out_dir)
+        me_signature._verified.clear()
+        timings = {}
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            for phase, step in (
+                    ("clean", lambda: me7_update_parser.generate_me_blob(
+                        path, output)),
+                    ("verify", lambda: me7_update_parser.verify_output(
+                        output))):
+                wall, cpu = time.perf_counter(), time.process_time()
+                step()
+                timings[phase] = {"wall": time.perf_counter() - wall,
+                                  "cpu": time.process_time() - cpu}
+        timings["total"] = {
+            "wall": sum(t["wall"] for t in timings.values()),
+            "cpu": sum(t["cpu"] for t in timings.values())}
+        runs.append(timings)
+    return summarize(runs)
+
+
+def cases(args):
+    for gen in args.gens:
+        for size in args.sizes:
+            for chunks in args.chunks if gen != 3 else (None,):
+                image = {"gen": gen, "size": size * MIB,
+                         "me_size": me_size_for(size * MIB),
+                         "modules": args.modules, "chunks": chunks}
+                for scenario in ("check", "clean"):
+                    yield "me_cleaner", image, scenario
+
+    if not args.no_me7:
+        for chunks in args.me7_chunks:
+            image = {"gen": 7, "size": 0x80000, "modules": args.modules,
+                     "chunks": chunks}
+            yield "me7_update_parser", image, "update"
+
+
+def format_phases(phases):
+    return ", ".join("{} {:.2f}".format(name, phase["wall"] * 1000)
+                     for name, phase in sorted(phases.items())
+                     if name != "total")
+
+
+def run(args, work_dir):
+    out_dir = tempfile.mkdtemp(prefix="me_bench-")
+    results = []
+    try:
+        for tool, image, scenario in cases(args):
+            name = "{}/{}".format(image_name(image), scenario)
+            result = {"name": name, "tool": tool, "scenario": scenario,
+                      "image": image}
+            results.append(result)
+
+            try:
+                path = generate(image, work_dir)
+            except ValueError as e:
+                # The image can't hold that many modules or chunks
+                result["skipped"] = str(e)
+                print("{:<32} skipped: {}".format(name, e), file=sys.stderr)
+                continue
+
+            if tool == "me_cleaner":
+                phases = bench_me_cleaner(path, image, scenario, args.repeat,
+                                          out_dir)
+            else:
+                phases = bench_me7(path, args.repeat, out_dir)
+
+            result["phases"] = phases
+            print("{:<32} {:9.2f} ms ({})".format(
+                name, phases["total"]["wall"] * 1000,
+                format_phases(phases)), file=sys.stderr)
+    finally:
+        shutil.rmtree(out_dir)
+
+    return {
+        "me_cleaner": me_cleaner.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def compare(document, baseline, threshold):
+    """Return the phases of document slower than in baseline by more than
+    threshold times, as (name, phase, old, new) tuples"""
+    old_results = {r["name"]: r for r in baseline["results"]
+                   if "phases" in r}
+    regressions = []
+
+    for result in document["results"]:
+        old = old_results.get(result["name"])
+        if old is None or "phases" not in result:
+            continue
+        for phase, timing in sorted(result["phases"].items()):
+            if phase not in old["phases"]:
+                continue
+            old_wall = old["phases"][phase]["wall"]
+            new_wall = timing["wall"]
+            if new_wall > max(old_wall * threshold,
+                              old_wall + MIN_COMPARED_TIME):
+                regressions.append((result["name"], phase, old_wall,
+                                    new_wall))
+
+    return regressions
+
+
+def int_list(value):
+    return [int(x) for x in value.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark me_cleaner and "
+                                     "me7_update_parser on synthetic ME/TXE "
+                                     "images")
+    parser.add_argument("-o", "--output", metavar="results_file",
+                        help="save the results to results_file instead of "
+                        "printing them")
+    parser.add_argument("-g", "--gens", metavar="gens", type=int_list,
+                        default=DEFAULT_GENS, help="comma separated list of "
+                        "ME generations (default: %(default)s)")
+    parser.add_argument("-s", "--sizes", metavar="MiB", type=int_list,
+                        default=DEFAULT_SIZES, help="comma separated list of "
+                        "full dump sizes, in MiB (default: %(default)s)")
+    parser.add_argument("-c", "--chunks", metavar="chunks", type=int_list,
+                        default=DEFAULT_CHUNKS, help="comma separated list of "
+                        "LLUT chunk counts, for generations 1 and 2 "
+                        "(default: %(default)s)")
+    parser.add_argument("-m", "--modules", metavar="modules", type=int,
+                        help="number of modules of the FTPR partition")
+    parser.add_argument("--me7-chunks", metavar="chunks", type=int_list,
+                        default=DEFAULT_ME7_CHUNKS, help="comma separated "
+                        "list of LLUT chunk counts of the ME 7 update images "
+                        "(default: %(default)s)")
+    parser.add_argument("--no-me7", help="don't benchmark "
+                        "me7_update_parser", action="store_true")
+    parser.add_argument("-r", "--repeat", metavar="runs", type=int,
+                        default=5, help="runs of each case; the fastest one "
+                        "and the median are kept (default: %(default)s)")
+    parser.add_argument("-w", "--work-dir", metavar="work_dir",
+                        help="keep the generated images in work_dir, to "
+                        "reuse them in the next runs")
+    parser.add_argument("--compare", metavar="baseline", help="compare the "
+                        "results with those saved in baseline and exit with "
+                        "status 1 if a phase got slower")
+    parser.add_argument("--threshold", metavar="ratio", type=float,
+                        default=1.25, help="slowdown reported by --compare "
+                        "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.work_dir:
+        if not os.path.isdir(args.work_dir):
+            os.makedirs(args.work_dir)
+        document = run(args, args.work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="me_bench-images-")
+        try:
+            document = run(args, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    else:
+        me_cleaner.print_json(document)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(document, baseline, args.threshold)
+        for name, phase, old, new in regressions:
+            print("SLOWER {} {}: {:.2f} ms -> {:.2f} ms".format(
+                name, phase, old * 1000, new * 1000), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+# me_cache - Content-addressed cache of cleaned ME/TXE images
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# A cache entry maps a key, the SHA-256 of the input image plus the tool and
+# its normalized options, to the files the run produced. The files are stored
+# once by content under objects/, the entries as small JSON documents under
+# entries/. Entries are evicted least recently used first when the objects
+# exceed the size limit.
+
+from __future__ import division, print_function
+
+import contextlib
+import errno
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# ioctl(dest_fd, FICLONE, src_fd) shares the extents of src with dest on
+# filesystems supporting reflinks (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def file_sha256(filename):
+    """SHA-256 of a whole file, hashed from a memory map when possible"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sha256.update(mm)
+        except (ValueError, EnvironmentError):
+            # Empty or special file
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+    return sha256.hexdigest()
+
+
+def tool_id(name, sources):
+    """Identify a tool by name and by the content of its source files (and of
+    this module), so that a modified tool never reuses the results of another
+    one"""
+    sha256 = hashlib.sha256()
+    for source in list(sources) + [__file__]:
+        with open(source, "rb") as f:
+            sha256.update(f.read())
+    return "{} {}".format(name, sha256.hexdigest()[:16])
+
+
+class _Tee:
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+@contextlib.contextmanager
+def capture_stdout():
+    """Keep a copy of everything printed on stdout in the yielded StringIO,
+    to be replayed when the result is restored from the cache"""
+    log = io.StringIO()
+    with contextlib.redirect_stdout(_Tee(sys.stdout, log)):
+        yield log
+
+
+def _copy_data(fsrc, fdst):
+    """Copy the whole file fsrc over fdst, sharing the data with a reflink
+    when the filesystem supports it"""
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (IOError, OSError):
+            pass
+    fsrc.seek(0)
+    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    fdst.truncate()
+
+
+def clone_fileobj(fsrc, dest):
+    """Copy the open file fsrc to dest, sharing the data with a reflink when
+    the filesystem supports it. A symlink dest is followed. dest is replaced
+    atomically, unless it has other hard links: it is then rewritten in
+    place, so that they all get the new data."""
+    dest = os.path.realpath(dest)
+    try:
+        in_place = os.stat(dest).st_nlink > 1
+    except OSError:
+        in_place = False
+    if in_place:
+        with open(dest, "r+b") as fdst:
+            _copy_data(fsrc, fdst)
+        return
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fdst:
+            _copy_data(fsrc, fdst)
+        os.chmod(tmp, stat.S_IMODE(os.fstat(fsrc.fileno()).st_mode))
+        os.replace(tmp, dest)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def clone_file(src, dest):
+    """Copy src to dest, as clone_fileobj()"""
+    with open(src, "rb") as fsrc:
+        clone_fileobj(fsrc, dest)
+
+
+class OutputCache:
+    """On-disk cache of the files produced by a tool for a given input"""
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.objects_dir = os.path.join(path, "objects")
+        self.entries_dir = os.path.join(path, "entries")
+
+        for d in (self.objects_dir, self.entries_dir):
+            try:
+                os.makedirs(d)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @staticmethod
+    def key(input_hash, tool, options):
+        """Cache key of a run: options must be JSON serializable and
+        normalized, i.e. equal for runs giving the same outputs"""
+        data = json.dumps([input_hash, tool, options], sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.entries_dir, key + ".json")
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def get(self, key):
+        """Return the entry stored for key, as a dict with the files by role
+        and the metadata saved with them, or None"""
+        try:
+            with open(self._entry_path(key)) as f:
+                entry = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+
+        # The objects may have been evicted by a concurrent run
+        if not all(os.path.exists(self.object_path(digest))
+                   for digest in entry["files"].values()):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(self._entry_path(key), None)
+        except OSError:
+            pass
+
+        return entry
+
+    def restore(self, entry, paths):
+        """Copy the cached files of entry to the paths given by role. The
+        objects are all opened first, so that none of the paths is written
+        if one of them was evicted by a concurrent run."""
+        sources = {}
+        try:
+            for role, digest in entry["files"].items():
+                sources[role] = open(self.object_path(digest), "rb")
+            for role, fsrc in sources.items():
+                clone_fileobj(fsrc, paths[role])
+        finally:
+            for fsrc in sources.values():
+                fsrc.close()
+
+    def put(self, key, paths, metadata=None):
+        """Store the files given by role under key, with some JSON
+        serializable metadata, then enforce the size limit"""
+        files = {role: self.add_object(path)
+                 for role, path in paths.items()}
+        self.put_entry(key, files, metadata)
+
+    def add_object(self, path, move=False):
+        """Store the file at path as an object, moving it into the cache if
+        move is set, and return its digest. The object is evicted by the
+        next put unless an entry refers to it."""
+        digest = file_sha256(path)
+        if os.path.exists(self.object_path(digest)):
+            if move:
+                os.unlink(path)
+        elif move:
+            os.replace(path, self.object_path(digest))
+        else:
+            clone_file(path, self.object_path(digest))
+        return digest
+
+    def add_data(self, data):
+        """Store data as an object and return its digest, as add_object"""
+        digest = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self.object_path(digest)):
+            fd, tmp = tempfile.mkstemp(dir=self.objects_dir, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.object_path(digest))
+        return digest
+
+    def put_entry(self, key, files, metadata=None):
+        """Store under key the objects (digests) given by role, with some
+        JSON serializable metadata, then enforce the size limit"""
+        fd, tmp = tempfile.mkstemp(dir=self.entries_dir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"files": files, "metadata": metadata or {}}, f)
+        os.replace(tmp, self._entry_path(key))
+
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.entries_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.entries_dir, name)
+            try:
+                with open(path) as f:
+                    files = json.load(f).get("files", {})
+                entries.append((os.stat(path).st_mtime, path,
+                                set(files.values())))
+            except (EnvironmentError, ValueError):
+                continue
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the stored objects
+        fit in max_size, then remove the objects no entry refers to"""
+        sizes = {}
+        for name in os.listdir(self.objects_dir):
+            if not name.startswith(".tmp-"):
+                sizes[name] = \
+                    os.path.getsize(os.path.join(self.objects_dir, name))
+
+        entries = self._entries()
+        total = sum(sizes.values())
+
+        while entries and total > self.max_size:
+            _, path, _ = entries.pop(0)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            referenced = set().union(*(e[2] for e in entries))
+            total = sum(size for digest, size in sizes.items()
+                        if digest in referenced)
+
+        referenced = set().union(*(e[2] for e in entries))
+        for digest in sizes:
+            if digest not in referenced:
+                try:
+                    os.unlink(self.object_path(digest))
+                except OSError:
+                    pass
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+# me_carve - Search of ME/TXE structures at any offset of a file
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# Vendor installers and update capsules embed the ME region (or a whole
+# flash image) somewhere in their payload. The file is mapped in memory and
+# the tags ($FPT, $CPD, $MN2/$MAN, LLUT and the descriptor signature) are
+# searched over the whole map with find(), without copying it.
+# Each hit is checked with the headers around it:
+#
+#  - $FPT: sane header, checksum of the FPT header (with or without the ROM
+#    bypass in front of it) and a CODE/FTPR entry pointing to a $CPD
+#    directory or a manifest; the region ends with its last partition
+#  - descriptor: FLREG of an ME region starting with an FPT found above
+#  - $MN2/$MAN: sane manifest header and size, and whether its public key is
+#    in the table of me_cleaner
+#  - $CPD: sane header and printable entry names
+#  - LLUT: sane chunk count and chunk size
+#
+# me_cleaner --carve cleans the image found this way through a PlanFile: the
+# image is moved to offset 0 by an edit of the plan, so its bytes are read
+# from the map (and copied by the kernel when written) but never duplicated.
+
+from __future__ import division, print_function
+
+import argparse
+import hashlib
+import mmap
+import sys
+from collections import namedtuple
+
+from me_structs import CpdDirectory, FlashMap, FlashRegions, \
+    FptEntry, FptHeader, LlutHeader, ManifestHeader, flreg_to_start_end
+
+DESCRIPTOR_SIGNATURE = b"\x5a\xa5\xf0\x0f"
+MANIFEST_TAGS = (b"$MN2", b"$MAN")
+
+MAX_FPT_ENTRIES = 64
+MAX_CPD_ENTRIES = 256
+
+# tag: $FPT, $CPD, $MN2, $MAN, LLUT or FD (descriptor)
+# offset: of the structure (the manifest header for $MN2, not its tag)
+# info: dict describing it
+Structure = namedtuple("Structure", "tag offset info")
+
+# kind: "full dump" or "ME/TXE image"
+# start, end: extent of the image in the file
+Image = namedtuple("Image", "kind start end info")
+
+
+def find_tags(buf, tags):
+    """Offsets of all the occurrences of each tag in buf, as a dict"""
+    found = {}
+    for tag in tags:
+        offsets = found[tag] = []
+        # The start must be given: mmap.find() starts at the file position
+        pos = buf.find(tag, 0)
+        while pos >= 0:
+            offsets.append(pos)
+            pos = buf.find(tag, pos + 1)
+    return found
+
+
+def byte_sum(buf, start, end):
+    return sum(bytearray(buf[start:end])) & 0xff
+
+
+def printable(name):
+    name = name.rstrip(b"\x00")
+    return len(name) > 0 and all(0x20 < c < 0x7f for c in bytearray(name))
+
+
+def check_partition(buf, offset):
+    """Whether a code partition (a $CPD directory or a manifest) starts at
+    offset"""
+    if offset < 0 or offset + 0x20 > len(buf):
+        return False
+    return buf[offset:offset + 4] == b"$CPD" or \
+        buf[offset + 0x1c:offset + 0x20] in MANIFEST_TAGS
+
+
+def check_fpt(buf, tag_offset):
+    """Return the ME region whose FPT header is at tag_offset, as an
+    Image, or None"""
+    if tag_offset + 0x20 > len(buf):
+        return None
+    header = FptHeader.unpack_from(buf, tag_offset)
+    if not 0 < header.num_entries <= MAX_FPT_ENTRIES or \
+       header.entry_version != 0x10 or header.header_length != 0x20:
+        return None
+    entries_end = tag_offset + 0x20 + header.num_entries * 0x20
+    if entries_end > len(buf):
+        return None
+
+    # The FPT is at 0x10 after the ROM bypass (with a checksum over 0x0:0x30
+    # before generation 3, over 0x10:0x30 since) or at 0x0 (generation 1)
+    starts = []
+    if tag_offset >= 0x10 and (
+            byte_sum(buf, tag_offset - 0x10, tag_offset + 0x20) == 0 or
+            byte_sum(buf, tag_offset, tag_offset + 0x20) == 0):
+        starts.append(tag_offset - 0x10)
+    if byte_sum(buf, tag_offset, tag_offset + 0x30) == 0:
+        starts.append(tag_offset)
+
+    entries = FptEntry.array_from(buf, tag_offset + 0x20, header.num_entries)
+    ftpr = next((e for e in entries if e.tag in (b"FTPR", b"CODE")), None)
+    if ftpr is None:
+        return None
+
+    for start in starts:
+        if not check_partition(buf, start + ftpr.offset):
+            continue
+        end = entries_end
+        for e in entries:
+            if e.offset > 0 and 0 < e.length < 0xffffffff and \
+               e.flags & 0x7f != 2:
+                end = max(end, start + e.offset + e.length)
+        return Image("ME/TXE image", start, min(end, len(buf)), {
+            "fpt_offset": tag_offset - start,
+            "partitions": [e.name for e in entries],
+            "truncated": end > len(buf),
+        })
+    return None
+
+
+def check_descriptor(buf, sig_offset, regions):
+    """Return the full dump whose descriptor signature is at sig_offset, as
+    an Image, or None. regions are the ME regions found, by start."""
+    # The signature is at 0x10 (at 0x0 in generation 1)
+    for start in (sig_offset - 0x10, sig_offset):
+        if start < 0 or start + 0x1000 > len(buf):
+            continue
+        flmap = FlashMap.unpack_from(buf, sig_offset + 4)
+        if start + flmap.frba + 0xc > len(buf):
+            continue
+        flreg = FlashRegions.unpack_from(buf, start + flmap.frba)
+        me_start, me_end = flreg_to_start_end(flreg.me)
+        if me_start >= me_end or start + me_start not in regions:
+            continue
+        ends = [flreg_to_start_end(r)[1] for r in
+                (flreg.descriptor, flreg.bios, flreg.me)]
+        end = start + max(ends)
+        return Image("full dump", start, min(end, len(buf)), {
+            "me_region": [me_start, me_end],
+            "truncated": end > len(buf),
+        })
+    return None
+
+
+def check_manifest(buf, tag_offset, pubkeys):
+    offset = tag_offset - 0x1c
+    if offset < 0 or offset + 0x284 > len(buf):
+        return None
+    manifest = ManifestHeader.unpack_from(buf, offset)
+    if manifest.header_length * 4 < 0x284 or \
+       manifest.size < manifest.header_length or \
+       offset + manifest.size * 4 > len(buf):
+        return None
+    pubkey_md5 = hashlib.md5(buf[offset + 0x80:offset + 0x184]).hexdigest()
+    return Structure(manifest.tag.decode(), offset, {
+        "version": ".".join(str(v) for v in manifest.version),
+        "size": manifest.size * 4,
+        "pubkey_md5": pubkey_md5,
+        "pubkey_known": pubkey_md5 in pubkeys,
+    })
+
+
+def check_cpd(buf, offset):
+    directory = CpdDirectory.unpack_from(buf, offset)
+    if directory is None:
+        return None
+    header = directory.header
+    if not 0 < header.num_entries <= MAX_CPD_ENTRIES or \
+       header.header_length not in (0x10, 0x14) or \
+       len(directory.entries) < header.num_entries or \
+       not printable(header.partition_name) or \
+       not all(printable(e.raw_name) for e in directory.entries):
+        return None
+    return Structure("$CPD", offset, {
+        "partition": directory.name,
+        "entries": header.num_entries,
+    })
+
+
+def check_llut(buf, offset):
+    if offset + 0x40 > len(buf):
+        return None
+    header = LlutHeader.unpack_from(buf, offset)
+    if header.chunk_count == 0 or \
+       offset + 0x40 + header.chunk_count * 4 > len(buf) or \
+       header.chunk_size not in (0x400, 0x800, 0x1000, 0x2000, 0x4000):
+        return None
+    return Structure("LLUT", offset, {"chunks": header.chunk_count,
+                                      "chunk_size": header.chunk_size})
+
+
+def carve(buf, pubkeys=()):
+    """Search buf (bytes, or better a memory map) for ME/TXE structures;
+    return the images found (full dumps and ME/TXE images, those inside a
+    full dump excluded) and all the valid structures, sorted by offset.
+    pubkeys is the set of the known public key MD5s."""
+
+    found = find_tags(buf, (b"$FPT", DESCRIPTOR_SIGNATURE, b"$CPD",
+                            b"LLUT") + MANIFEST_TAGS)
+    regions = {}
+    structures = []
+    for offset in found[b"$FPT"]:
+        image = check_fpt(buf, offset)
+        if image is not None:
+            regions.setdefault(image.start, image)
+            structures.append(Structure("$FPT", offset, {
+                "region": [image.start, image.end]}))
+
+    dumps = []
+    for offset in found[DESCRIPTOR_SIGNATURE]:
+        image = check_descriptor(buf, offset, regions)
+        if image is not None:
+            dumps.append(image)
+            structures.append(Structure("FD", offset, {
+                "image": [image.start, image.end]}))
+
+    for tag in MANIFEST_TAGS:
+        for offset in found[tag]:
+            structure = check_manifest(buf, offset, pubkeys)
+            if structure is not None:
+                structures.append(structure)
+    for offset in found[b"$CPD"]:
+        structure = check_cpd(buf, offset)
+        if structure is not None:
+            structures.append(structure)
+    for offset in found[b"LLUT"]:
+        structure = check_llut(buf, offset)
+        if structure is not None:
+            structures.append(structure)
+
+    images = list(dumps)
+    for region in regions.values():
+        if not any(d.start <= region.start and region.end <= d.end
+                   for d in dumps):
+            images.append(region)
+
+    images.sort(key=lambda i: i.start)
+    structures.sort(key=lambda s: s.offset)
+    return images, structures
+
+
+def choose_image(images, offset=None):
+    """The image at offset, or the only image found; raise ValueError if
+    there is no such image or more than one"""
+    if offset is not None:
+        for image in images:
+            if image.start == offset:
+                return image
+        raise ValueError("No ME/TXE image or full dump at {:#x}"
+                         .format(offset))
+    if not images:
+        raise ValueError("No ME/TXE image or full dump found")
+    if len(images) > 1:
+        raise ValueError("{} images found (at {}), choose one with "
+                         "--carve-offset".format(len(images), ", ".join(
+                             "{:#x}".format(i.start) for i in images)))
+    return images[0]
+
+
+def map_file(f):
+    """Read-only memory map of the whole file f"""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def main(argv=None):
+    import me_cleaner
+
+    parser = argparse.ArgumentParser(description="Find the ME/TXE images "
+                                     "and structures embedded in a file")
+    parser.add_argument("file", help="file to search")
+    parser.add_argument("-a", "--all", help="list all the structures found, "
+                        "not only the images", action="store_true")
+    args = parser.parse_args(argv)
+
+    with open(args.file, "rb") as f:
+        try:
+            buf = map_file(f)
+        except (ValueError, EnvironmentError) as e:
+            sys.exit("Can't map {}: {}".format(args.file, e))
+        try:
+            images, structures = carve(buf, me_cleaner.pubkeys_md5)
+        finally:
+            buf.close()
+
+    for image in images:
+        print("{:#010x} - {:#010x}: {}{}".format(
+            image.start, image.end, image.kind,
+            " (truncated)" if image.info["truncated"] else ""))
+    if args.all:
+        for structure in structures:
+            print("  {:#010x} {:<4} {}".format(
+                structure.offset, structure.tag,
+                ", ".join("{}={}".format(k, v) for k, v in
+                          sorted(structure.info.items()))))
+    if not images:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
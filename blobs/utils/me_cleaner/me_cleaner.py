@@ -18,12 +18,45 @@ from __future__ import division, print_function
 
 import argparse
 import binascii
+import bisect
+import contextlib
+import copy
+import errno
 import hashlib
+import io
 import itertools
+import json
+import mmap
+import os
+import shlex
 import shutil
 import sys
+import tempfile
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from struct import pack, unpack
 
+from me_cache import OutputCache, DEFAULT_MAX_SIZE, capture_stdout, \
+    clone_file, file_sha256, tool_id
+from me_profile import Profiler
+import me_carve
+import me_signature
+import me_structs
+import me_update
+from me_signature import check_partition_signature
+from me_structs import CpdDirectory, FlashMap, FlashRegions, \
+    FptEntry, FptHeader, LlutHeader, ManifestHeader, ModuleHeader, \
+    flreg_to_start_end, start_end_to_flreg
+
+
+__version__ = "1.2"
+
+# --sparse leaves holes in place of the 0xFF runs covering whole blocks of
+# this size, and lists them in a map saved next to the image
+SPARSE_BLOCK = 4096
+SPARSE_MAP_SUFFIX = ".ffmap"
 
 min_ftpr_offset = 0x400
 spared_blocks = 4
@@ -58,6 +91,86 @@ class OutOfRegionException(Exception):
     pass
 
 
+class MeCleanerError(Exception):
+    """Fatal error on the image being processed"""
+    pass
+
+
+def wrap_error(e, invalid=None):
+    """A MeCleanerError for an unexpected error e (an unreadable file, a bad
+    document...), so that --json still prints a report: the message of an
+    EnvironmentError, else the type and message of e, after invalid if
+    given"""
+    if isinstance(e, EnvironmentError):
+        return MeCleanerError(str(e))
+    message = "{}: {}".format(type(e).__name__, e)
+    if invalid:
+        message = "{} ({})".format(invalid, message)
+    return MeCleanerError(message)
+
+
+class Report:
+    """What happens to an image: printed on the console as it goes (unless
+    text is False, in which case the messages are not even formatted) and
+    collected in data, a JSON serializable dict for --json.
+
+    The image layout and regions use absolute offsets; FPT entries, modules,
+    Huffman chunks and the relocation use offsets from the ME region start,
+    as the FPT does."""
+
+    def __init__(self, text=True, hooks=()):
+        self.text = text
+        self.data = {"timings": {}}
+        self.hooks = list(hooks)
+
+    def say(self, fmt="", *args, **kwargs):
+        if self.text:
+            print(fmt.format(*args) if args else fmt, **kwargs)
+
+    def warn(self, fmt, *args):
+        self.append("warnings", fmt.format(*args) if args else fmt)
+        self.say(fmt, *args)
+
+    def set(self, **kwargs):
+        self.data.update(kwargs)
+
+    def append(self, key, value):
+        self.data.setdefault(key, []).append(value)
+
+    def add_hook(self, hook):
+        """Call hook(event, name) when a phase starts (event "start") and when
+        it stops (event "stop", even if it raised)"""
+        self.hooks.append(hook)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the wall and CPU time spent in the with block to the timings of
+        phase name"""
+        for hook in self.hooks:
+            hook("start", name)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            timing = self.data["timings"].setdefault(name,
+                                                     {"wall": 0.0, "cpu": 0.0})
+            timing["wall"] += time.perf_counter() - wall_start
+            timing["cpu"] += time.process_time() - cpu_start
+            for hook in reversed(self.hooks):
+                hook("stop", name)
+
+
+def uncovered_source(offset_from, size, offset_to):
+    """The (start, end) part of the source of a move of size bytes from
+    offset_from to offset_to which is not overwritten by the destination"""
+    if offset_to >= offset_from + size or offset_to + size <= offset_from:
+        return offset_from, offset_from + size
+    elif offset_to > offset_from:
+        return offset_from, offset_to
+    else:
+        return offset_to + size, offset_from + size
+
+
 class RegionFile:
     def __init__(self, f, region_start, region_end):
         self.f = f
@@ -65,13 +178,13 @@ class RegionFile:
         self.region_end = region_end
 
     def read(self, n):
-        if f.tell() + n <= self.region_end:
+        if self.f.tell() + n <= self.region_end:
             return self.f.read(n)
         else:
             raise OutOfRegionException()
 
     def readinto(self, b):
-        if f.tell() + len(b) <= self.region_end:
+        if self.f.tell() + len(b) <= self.region_end:
             return self.f.readinto(b)
         else:
             raise OutOfRegionException()
@@ -106,13 +219,14 @@ class RegionFile:
     def move_range(self, offset_from, size, offset_to, fill):
         if self.region_start + offset_from + size <= self.region_end and \
            self.region_start + offset_to + size <= self.region_end:
-            for i in range(0, size, 4096):
-                self.f.seek(self.region_start + offset_from + i, 0)
-                block = self.f.read(min(size - i, 4096))
-                self.f.seek(self.region_start + offset_from + i, 0)
-                self.f.write(fill * len(block))
-                self.f.seek(self.region_start + offset_to + i, 0)
-                self.f.write(block)
+            # The whole source is read before anything is written, so the
+            # destination gets the original data whatever the overlap
+            self.f.seek(self.region_start + offset_from)
+            data = self.f.read(size)
+            self.fill_range(*uncovered_source(offset_from, size, offset_to),
+                            fill=fill)
+            self.f.seek(self.region_start + offset_to)
+            self.f.write(data)
         else:
             raise OutOfRegionException()
 
@@ -127,79 +241,622 @@ class RegionFile:
             raise OutOfRegionException()
 
 
-def get_chunks_offsets(llut):
-    chunk_count = unpack("<I", llut[0x04:0x08])[0]
-    huffman_stream_end = sum(unpack("<II", llut[0x10:0x18]))
-    nonzero_offsets = [huffman_stream_end]
-    offsets = []
+class MappedFile:
+    """File-like object backed by a shared memory map of a whole image.
+
+    Reads and writes are plain memory copies on the map; the data reaches the
+    file once, when the map is flushed by close() or truncate()."""
+
+    def __init__(self, f, writable):
+        self.file = f
+        self.writable = writable
+        self._map()
+
+    def _map(self):
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=access)
+        self.view = memoryview(self.mm)
+
+    def _unmap(self):
+        if self.mm is not None:
+            self.view.release()
+            if self.writable:
+                self.mm.flush()
+            self.mm.close()
+            self.mm = self.view = None
+
+    def read(self, n=-1):
+        return self.mm.read(n)
+
+    def readinto(self, b):
+        pos = self.mm.tell()
+        n = min(len(b), len(self.mm) - pos)
+        b[:n] = self.view[pos:pos + n]
+        self.mm.seek(pos + n)
+        return n
+
+    def seek(self, offset, whence=0):
+        self.mm.seek(offset, whence)
+        return self.mm.tell()
+
+    def tell(self):
+        return self.mm.tell()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def write(self, data):
+        self.mm.write(data)
+        return len(data)
+
+    def truncate(self, size):
+        self._unmap()
+        self.file.truncate(size)
+        if size > 0:
+            self._map()
+
+    def flush(self):
+        if self.writable:
+            self.mm.flush()
+
+    def close(self):
+        self._unmap()
+        self.file.close()
+
+
+class MappedRegionFile(RegionFile):
+    """RegionFile on a MappedFile: fills, moves and extractions are slice
+    operations on the map instead of 4 KiB reads and writes."""
+
+    def fill_range(self, start, end, fill):
+        if self.region_start + end <= self.region_end:
+            if start < end:
+                self.f.view[self.region_start + start:
+                            self.region_start + end] = fill * (end - start)
+        else:
+            raise OutOfRegionException()
+
+    def move_range(self, offset_from, size, offset_to, fill):
+        if self.region_start + offset_from + size <= self.region_end and \
+           self.region_start + offset_to + size <= self.region_end:
+            # memmove semantics: the destination gets the original source data
+            # whatever the overlap, then the part of the source which is not
+            # covered by the destination is filled.
+            self.f.mm.move(self.region_start + offset_to,
+                           self.region_start + offset_from, size)
+            self.fill_range(*uncovered_source(offset_from, size, offset_to),
+                            fill=fill)
+        else:
+            raise OutOfRegionException()
+
+    def save(self, filename, size):
+        if self.region_start + size <= self.region_end:
+            copyf = open(filename, "w+b")
+            copyf.write(self.f.view[self.region_start:
+                                    self.region_start + size])
+            return copyf
+        else:
+            raise OutOfRegionException()
+
+
+class EditPlan:
+    """Ordered list of the edits made to an image, and map of the resulting
+    image as a sorted list of extents (start, end, kind, value) where the
+    data comes from the input image at offset value (INPUT), is the byte
+    value repeated (FILL) or is the literal bytes value (DATA)"""
+
+    INPUT, FILL, DATA = "input", "fill", "data"
+
+    def __init__(self, size):
+        self.input_size = self.size = size
+        self.edits = []
+        self.extents = [(0, size, self.INPUT, 0)] if size > 0 else []
+        self.starts = [e[0] for e in self.extents]
+
+    def _split(self, pos):
+        """Make pos the start of an extent and return its index"""
+        i = bisect.bisect_right(self.starts, pos) - 1
+        if i < 0 or pos >= self.extents[i][1]:
+            return i + 1
+        start, end, kind, value = self.extents[i]
+        if pos == start:
+            return i
+        if kind == self.INPUT:
+            tail = value + pos - start
+        elif kind == self.DATA:
+            value, tail = value[:pos - start], value[pos - start:]
+        else:
+            tail = value
+        self.extents[i:i + 1] = [(start, pos, kind, value),
+                                 (pos, end, kind, tail)]
+        self.starts.insert(i + 1, pos)
+        return i + 1
+
+    def _replace(self, start, end, extents):
+        i = self._split(start)
+        j = self._split(end)
+        self.extents[i:j] = extents
+        self.starts[i:j] = [e[0] for e in extents]
+
+    def _check(self, start, end):
+        if not 0 <= start <= end <= self.size:
+            raise OutOfRegionException()
+
+    def fill(self, start, end, byte):
+        self._check(start, end)
+        if start < end:
+            self.edits.append({"op": "fill", "start": start, "end": end,
+                               "byte": byte})
+            self._replace(start, end, [(start, end, self.FILL, byte)])
+
+    def write(self, offset, data):
+        data = bytes(data)
+        self._check(offset, offset + len(data))
+        if data:
+            self.edits.append({"op": "write", "offset": offset,
+                               "data": binascii.hexlify(data).decode()})
+            self._replace(offset, offset + len(data),
+                          [(offset, offset + len(data), self.DATA, data)])
+
+    def move(self, offset_from, size, offset_to, byte):
+        """Move size bytes from offset_from to offset_to and fill the part of
+        the source not covered by the destination with byte"""
+        self._check(offset_from, offset_from + size)
+        self._check(offset_to, offset_to + size)
+        if size > 0:
+            self.edits.append({"op": "move", "from": offset_from,
+                               "size": size, "to": offset_to, "byte": byte})
+            i = self._split(offset_from)
+            j = self._split(offset_from + size)
+            diff = offset_to - offset_from
+            moved = [(start + diff, end + diff, kind, value)
+                     for start, end, kind, value in self.extents[i:j]]
+            self._replace(offset_from, offset_from + size,
+                          [(offset_from, offset_from + size, self.FILL,
+                            byte)])
+            self._replace(offset_to, offset_to + size, moved)
+
+    def truncate(self, size):
+        self.edits.append({"op": "truncate", "size": size})
+        if size < self.size:
+            self._replace(size, self.size, [])
+        elif size > self.size:
+            self.extents.append((self.size, size, self.FILL, 0))
+            self.starts.append(self.size)
+        self.size = size
+
+    def apply(self, edit):
+        """Replay an edit, as found in edits"""
+        op = edit["op"]
+        if op == "fill":
+            self.fill(edit["start"], edit["end"], edit["byte"])
+        elif op == "write":
+            self.write(edit["offset"], binascii.unhexlify(edit["data"]))
+        elif op == "move":
+            self.move(edit["from"], edit["size"], edit["to"], edit["byte"])
+        elif op == "truncate":
+            self.truncate(edit["size"])
+        else:
+            raise MeCleanerError("Unknown edit {}".format(op))
+
+    def _pieces(self, start, end):
+        """Yield the extents between start and end, clipped to that range"""
+        i = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        for e_start, e_end, kind, value in self.extents[i:]:
+            if e_start >= end:
+                break
+            lo, hi = max(start, e_start), min(end, e_end)
+            if lo >= hi:
+                continue
+            if kind == self.INPUT:
+                value += lo - e_start
+            elif kind == self.DATA:
+                value = value[lo - e_start:hi - e_start]
+            yield lo, hi, kind, value
+
+    def _chunks(self, f, lo, hi, kind, value):
+        if kind == self.INPUT:
+            f.seek(value)
+            for pos in range(lo, hi, 1024 * 1024):
+                yield f.read(min(hi - pos, 1024 * 1024))
+        elif kind == self.FILL:
+            block = bytes((value,)) * min(hi - lo, 1024 * 1024)
+            for pos in range(lo, hi, len(block)):
+                yield block[:hi - pos]
+        else:
+            yield value
+
+    def sha256(self, f):
+        """SHA-256 of the resulting image, reading the unmodified parts from
+        f, the input image"""
+        sha256 = hashlib.sha256()
+        for piece in self._pieces(0, self.size):
+            for chunk in self._chunks(f, *piece):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def patch_extents(self, f):
+        """The extents of the resulting image as compact [kind, length,
+        value] lists (value being hex for DATA), in order and without their
+        start: the written data still equal to the input at the same offset
+        become copies of the input, and the adjacent extents of the same kind
+        that continue each other are merged"""
+        extents = []
+        for lo, hi, kind, value in self._pieces(0, self.size):
+            if kind == self.DATA and hi <= self.input_size:
+                f.seek(lo)
+                if f.read(hi - lo) == value:
+                    kind, value = self.INPUT, lo
+
+            if extents:
+                last_kind, last_length, last_value = extents[-1]
+                if kind == last_kind and (
+                        kind == self.DATA or
+                        kind == self.FILL and value == last_value or
+                        kind == self.INPUT and
+                        value == last_value + last_length):
+                    if kind == self.DATA:
+                        extents[-1][2] = last_value + value
+                    extents[-1][1] += hi - lo
+                    continue
+            extents.append([kind, hi - lo, value])
+
+        for extent in extents:
+            if extent[0] == self.DATA:
+                extent[2] = binascii.hexlify(extent[2]).decode()
+        return extents
+
+    @classmethod
+    def from_patch_extents(cls, input_size, extents):
+        """EditPlan of the patch_extents() of a plan on an input image of
+        input_size bytes"""
+        plan = cls(input_size)
+        plan.extents = []
+        start = 0
+        for kind, length, value in extents:
+            if kind == cls.DATA:
+                value = binascii.unhexlify(value)
+                if len(value) != length:
+                    raise MeCleanerError("Bad data extent in the patch")
+            elif kind == cls.INPUT:
+                if value + length > input_size:
+                    raise MeCleanerError("The patch reads beyond the end of "
+                                         "the input image")
+            elif kind != cls.FILL:
+                raise MeCleanerError("Unknown extent {}".format(kind))
+            plan.extents.append((start, start + length, kind, value))
+            start += length
+        plan.starts = [e[0] for e in plan.extents]
+        plan.size = start
+        return plan
+
+    def read(self, f, offset, n):
+        end = self.size if n < 0 else min(offset + n, self.size)
+        return b"".join(b for piece in self._pieces(offset, end)
+                        for b in self._chunks(f, *piece))
+
+    def _runs(self, start, end):
+        """_pieces(), with the adjacent fills of the same byte merged"""
+        run = None
+        for piece in self._pieces(start, end):
+            if run is not None and run[2] == piece[2] == self.FILL and \
+               run[3] == piece[3] and run[1] == piece[0]:
+                run = (run[0], piece[1], run[2], run[3])
+            else:
+                if run is not None:
+                    yield run
+                run = piece
+        if run is not None:
+            yield run
+
+    def stream(self, f, out, start=0, end=None, holes=None):
+        """Write the resulting image from start to end to out (reading the
+        unmodified parts from f, the input image) in a single sequential
+        pass. When both are real files, the unmodified parts are copied by
+        the kernel.
+
+        If holes is a list, the 0xFF fills are not written where they cover
+        whole blocks of SPARSE_BLOCK bytes, leaving holes in out, and the
+        ranges skipped are appended to holes."""
+        copy_file_range = getattr(os, "copy_file_range", None)
+        base = out.tell() - start
+
+        for lo, hi, kind, value in self._runs(
+                start, self.size if end is None else end):
+            if kind == self.FILL and value == 0xff and holes is not None:
+                hole_start = -(-lo // SPARSE_BLOCK) * SPARSE_BLOCK
+                hole_end = hi // SPARSE_BLOCK * SPARSE_BLOCK
+                if hole_start < hole_end:
+                    if lo < hole_start:
+                        out.writelines(self._chunks(f, lo, hole_start, kind,
+                                                    value))
+                    out.seek(base + hole_end)
+                    holes.append((hole_start, hole_end))
+                    lo = hole_end
+            elif kind == self.INPUT and copy_file_range is not None:
+                try:
+                    out.flush()
+                    out_fd, in_fd = out.fileno(), f.fileno()
+                    while lo < hi:
+                        n = copy_file_range(in_fd, out_fd, hi - lo, value)
+                        if n == 0:
+                            break
+                        lo, value = lo + n, value + n
+                except (AttributeError, io.UnsupportedOperation, OSError):
+                    # Not real files, or not supported by the filesystem:
+                    # copy what is left with reads and writes
+                    copy_file_range = None
+                # The kernel moved the file position behind out's back
+                out.seek(base + lo)
+            if lo < hi:
+                out.writelines(self._chunks(f, lo, hi, kind, value))
+
+        if holes is not None:
+            # The image may end with a hole
+            out.truncate()
+
+    def format_edit(self, edit):
+        op = edit["op"]
+        if op == "fill":
+            return "fill     0x{:08x} - 0x{:08x} with 0x{:02x}" \
+                .format(edit["start"], edit["end"], edit["byte"])
+        elif op == "write":
+            data = edit["data"]
+            return "write    0x{:08x} - 0x{:08x}: {}{}" \
+                .format(edit["offset"], edit["offset"] + len(data) // 2,
+                        data[:32], "..." if len(data) > 32 else "")
+        elif op == "move":
+            return "move     0x{:08x} - 0x{:08x} to 0x{:08x}, fill with " \
+                   "0x{:02x}".format(edit["from"], edit["from"] +
+                                     edit["size"], edit["to"], edit["byte"])
+        else:
+            return "truncate 0x{:08x}".format(edit["size"])
+
+
+class PlanFile:
+    """File-like object over a read-only image, recording the writes in an
+    EditPlan instead of performing them. Reads see the edits."""
 
-    for i in range(0, chunk_count):
-        chunk = llut[0x40 + i * 4:0x44 + i * 4]
-        offset = 0
+    def __init__(self, f):
+        self.base = f
+        f.seek(0, 2)
+        self.plan = EditPlan(f.tell())
+        self.pos = 0
+
+    def read(self, n=-1):
+        data = self.plan.read(self.base, self.pos, n)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        else:
+            self.pos = self.plan.size + offset
+        return self.pos
 
-        if chunk[3] != 0x80:
-            offset = unpack("<I", chunk[0:3] + b"\x00")[0]
+    def tell(self):
+        return self.pos
 
-        offsets.append([offset, 0])
-        if offset != 0:
-            nonzero_offsets.append(offset)
+    def write(self, data):
+        self.plan.write(self.pos, data)
+        self.pos += len(data)
+        return len(data)
 
-    nonzero_offsets.sort()
+    def truncate(self, size):
+        self.plan.truncate(size)
 
-    for i in offsets:
-        if i[0] != 0:
-            i[1] = nonzero_offsets[nonzero_offsets.index(i[0]) + 1]
+    def flush(self):
+        pass
 
-    return offsets
+    def close(self):
+        self.base.close()
+
+
+class PlanRegionFile(RegionFile):
+    """RegionFile on a PlanFile: fills and moves are recorded as such in the
+    plan, extractions are streamed from it"""
+
+    def fill_range(self, start, end, fill):
+        if self.region_start + end <= self.region_end:
+            self.f.plan.fill(self.region_start + start,
+                             self.region_start + end, ord(fill))
+        else:
+            raise OutOfRegionException()
 
+    def move_range(self, offset_from, size, offset_to, fill):
+        if self.region_start + offset_from + size <= self.region_end and \
+           self.region_start + offset_to + size <= self.region_end:
+            self.f.plan.move(self.region_start + offset_from, size,
+                             self.region_start + offset_to, ord(fill))
+        else:
+            raise OutOfRegionException()
 
-def remove_modules(f, mod_headers, ftpr_offset, me_end):
+    def save(self, filename, size):
+        if self.region_start + size <= self.region_end:
+            copyf = open(filename, "w+b")
+            self.f.plan.stream(self.f.base, copyf, self.region_start,
+                               self.region_start + size)
+            return copyf
+        else:
+            raise OutOfRegionException()
+
+
+def open_image(filename, mode, use_mmap=True):
+    """Open an image file, mapping it in memory if possible"""
+    f = open(filename, mode)
+    if use_mmap:
+        try:
+            return MappedFile(f, "+" in mode)
+        except (ValueError, EnvironmentError):
+            # Empty files and some special files can't be mapped
+            pass
+    return f
+
+
+def region_file(f, region_start, region_end):
+    if isinstance(f, MappedFile):
+        return MappedRegionFile(f, region_start, region_end)
+    elif isinstance(f, PlanFile):
+        return PlanRegionFile(f, region_start, region_end)
+    else:
+        return RegionFile(f, region_start, region_end)
+
+
+def u32_array(data):
+    """Decode a buffer of little-endian 32-bit integers in a single pass"""
+    a = array("I")
+    if a.itemsize != 4:
+        a = array("L")
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+class ChunkOffsets:
+    """Start and end offsets of the Huffman chunks listed in a LLUT.
+
+    The offsets are kept in two arrays; indexing returns a (start, end) tuple
+    and slicing returns another ChunkOffsets. Empty chunks start and end at
+    0."""
+
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ChunkOffsets(self.starts[i], self.ends[i])
+        return self.starts[i], self.ends[i]
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+
+def get_chunks_offsets(llut):
+    header = LlutHeader.unpack_from(llut)
+    huffman_stream_end = header.huffman_end
+
+    entries = u32_array(memoryview(llut)[0x40:0x40 + header.chunk_count * 4])
+    starts = array("Q", [0 if entry >> 24 == 0x80 else entry & 0xffffff
+                         for entry in entries])
+
+    # Each chunk ends where the next one in address order begins, the last
+    # one at the end of the Huffman stream. The successor map is built from
+    # the highest offset down, so that a chunk which shares its start with
+    # another one gets that same offset as its end (i.e. it is empty).
+    nonzero_offsets = sorted([x for x in starts if x] + [huffman_stream_end])
+    successor = dict(zip(reversed(nonzero_offsets[:-1]),
+                         reversed(nonzero_offsets[1:])))
+    ends = array("Q", [successor.get(x, x) if x else 0 for x in starts])
+
+    return ChunkOffsets(starts, ends)
+
+
+def relocate_chunks(chunks, offset_diff):
+    """Add offset_diff to the offsets of a LLUT chunk array, skipping the
+    empty chunks, and return the new array as bytes"""
+    entries = u32_array(chunks)
+    relocated = array(entries.typecode,
+                      [entry if entry >> 24 == 0x80 else
+                       entry & 0xff000000 | (entry + offset_diff) & 0xffffff
+                       for entry in entries])
+    if sys.byteorder == "big":
+        relocated.byteswap()
+    return relocated.tobytes()
+
+
+class IntervalIndex:
+    """Sorted set of disjoint [start, end) ranges, built by merging the
+    overlapping and contiguous ones among the given (start, end) pairs.
+
+    Iterating yields the merged ranges, i.e. the maximal runs covered by the
+    input, and point queries are binary searches."""
+
+    def __init__(self, ranges):
+        self.starts = array("Q")
+        self.ends = array("Q")
+
+        for start, end in sorted(r for r in ranges if r[1] > r[0]):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def end(self):
+        return self.ends[-1] if self.ends else 0
+
+    def touches(self, start, end):
+        """Check whether start lies in [s, e) or end lies in (s, e] for one
+        of the ranges (a range contained in [start, end) doesn't count)"""
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i >= 0 and start < self.ends[i]:
+            return True
+        i = bisect.bisect_left(self.starts, end) - 1
+        return i >= 0 and end <= self.ends[i]
+
+
+def remove_modules(f, image, me_end, report):
     comp_str = ("uncomp.", "Huffman", "LZMA")
+    ftpr_offset = image.ftpr_offset
     unremovable_huff_chunks = []
     chunks_offsets = []
     base = 0
     chunk_size = 0
     end_addr = 0
 
-    for mod_header in mod_headers:
-        name = mod_header[0x04:0x14].rstrip(b"\x00").decode("ascii")
-        offset = unpack("<I", mod_header[0x38:0x3C])[0] + ftpr_offset
-        size = unpack("<I", mod_header[0x40:0x44])[0]
-        flags = unpack("<I", mod_header[0x50:0x54])[0]
-        comp_type = (flags >> 4) & 7
+    for mod_header in image.ftpr_modules[1]:
+        name = mod_header.name
+        offset = mod_header.offset + ftpr_offset
+        size = mod_header.size
+        comp_type = mod_header.compression
 
-        print(" {:<16} ({:<7}, ".format(name, comp_str[comp_type]), end="")
+        module = {"name": name, "compression": comp_str[comp_type]
+                  if comp_type < len(comp_str) else "unknown"}
+        report.append("modules", module)
+        report.say(" {:<16} ({:<7}, ", name, module["compression"], end="")
 
         if comp_type == 0x00 or comp_type == 0x02:
-            print("0x{:06x} - 0x{:06x}       ): "
-                  .format(offset, offset + size), end="")
+            module.update(start=offset, end=offset + size)
+            report.say("0x{:06x} - 0x{:06x}       ): ", offset, offset + size,
+                       end="")
 
             if name in unremovable_modules:
                 end_addr = max(end_addr, offset + size)
-                print("NOT removed, essential")
+                module["action"] = "kept, essential"
+                report.say("NOT removed, essential")
             else:
                 end = min(offset + size, me_end)
                 f.fill_range(offset, end, b"\xff")
-                print("removed")
+                module["action"] = "removed"
+                report.say("removed")
 
         elif comp_type == 0x01:
             if not chunks_offsets:
-                f.seek(offset)
-                llut = f.read(4)
-                if llut == b"LLUT":
-                    llut += f.read(0x3c)
-
-                    chunk_count = unpack("<I", llut[0x4:0x8])[0]
-                    base = unpack("<I", llut[0x8:0xc])[0] + 0x10000000
-                    chunk_size = unpack("<I", llut[0x30:0x34])[0]
-
-                    llut += f.read(chunk_count * 4)
-                    chunks_offsets = get_chunks_offsets(llut)
-                else:
-                    sys.exit("Huffman modules found, but LLUT is not present")
+                llut_header, chunks_offsets = image.ftpr_llut
+                base = llut_header.addr_base + 0x10000000
+                chunk_size = llut_header.chunk_size
 
-            module_base = unpack("<I", mod_header[0x34:0x38])[0]
-            module_size = unpack("<I", mod_header[0x3c:0x40])[0]
+            module_base = mod_header.base
+            module_size = mod_header.uncompressed_size
             first_chunk_num = (module_base - base) // chunk_size
             last_chunk_num = first_chunk_num + module_size // chunk_size
             huff_size = 0
@@ -207,84 +864,71 @@ def remove_modules(f, mod_headers, ftpr_offset, me_end):
             for chunk in chunks_offsets[first_chunk_num:last_chunk_num + 1]:
                 huff_size += chunk[1] - chunk[0]
 
-            print("fragmented data, {:<9}): "
-                  .format("~" + str(int(round(huff_size / 1024))) + " KiB"),
-                  end="")
+            module.update(size=huff_size, first_chunk=first_chunk_num,
+                          last_chunk=last_chunk_num)
+            if report.text:
+                report.say("fragmented data, {:<9}): ",
+                           "~" + str(int(round(huff_size / 1024))) + " KiB",
+                           end="")
 
             if name in unremovable_modules:
-                print("NOT removed, essential")
+                module["action"] = "kept, essential"
+                report.say("NOT removed, essential")
 
                 unremovable_huff_chunks += \
                     [x for x in chunks_offsets[first_chunk_num:
                      last_chunk_num + 1] if x[0] != 0]
             else:
-                print("removed")
+                module["action"] = "removed"
+                report.say("removed")
 
         else:
-            print("0x{:06x} - 0x{:06x}): unknown compression, skipping"
-                  .format(offset, offset + size), end="")
+            module.update(start=offset, end=offset + size,
+                          action="skipped, unknown compression")
+            report.say("0x{:06x} - 0x{:06x}): unknown compression, skipping",
+                       offset, offset + size, end="")
 
     if chunks_offsets:
-        removable_huff_chunks = []
-
-        for chunk in chunks_offsets:
-            if all(not(unremovable_chk[0] <= chunk[0] < unremovable_chk[1] or
-                       unremovable_chk[0] < chunk[1] <= unremovable_chk[1])
-                   for unremovable_chk in unremovable_huff_chunks):
-                removable_huff_chunks.append(chunk)
-
-        for removable_chunk in removable_huff_chunks:
-            if removable_chunk[1] > removable_chunk[0]:
-                end = min(removable_chunk[1], me_end)
-                f.fill_range(removable_chunk[0], end, b"\xff")
-
-        end_addr = max(end_addr,
-                       max(unremovable_huff_chunks, key=lambda x: x[1])[1])
-
-    return end_addr
-
+        unremovable_index = IntervalIndex(unremovable_huff_chunks)
 
-def check_partition_signature(f, offset):
-    f.seek(offset)
-    header = f.read(0x80)
-    modulus = int(binascii.hexlify(f.read(0x100)[::-1]), 16)
-    public_exponent = unpack("<I", f.read(4))[0]
-    signature = int(binascii.hexlify(f.read(0x100)[::-1]), 16)
+        # Chunks are wiped in maximal contiguous runs, not one by one
+        removable_runs = IntervalIndex(
+            chunk for chunk in chunks_offsets
+            if not unremovable_index.touches(*chunk))
 
-    header_len = unpack("<I", header[0x4:0x8])[0] * 4
-    manifest_len = unpack("<I", header[0x18:0x1c])[0] * 4
-    f.seek(offset + header_len)
+        for start, end in removable_runs:
+            f.fill_range(start, min(end, me_end), b"\xff")
 
-    sha256 = hashlib.sha256()
-    sha256.update(header)
-    sha256.update(f.read(manifest_len - header_len))
+        report.set(huffman_chunks={
+            "count": len(chunks_offsets),
+            "kept": [[start, end] for start, end in unremovable_index],
+            "removed": [[start, end] for start, end in removable_runs]})
 
-    decrypted_sig = pow(signature, public_exponent, modulus)
+        end_addr = max(end_addr, unremovable_index.end())
 
-    return "{:#x}".format(decrypted_sig).endswith(sha256.hexdigest())   # FIXME
+    return end_addr
 
 
-def print_check_partition_signature(f, offset):
+def print_check_partition_signature(f, offset, report):
     if check_partition_signature(f, offset):
-        print("VALID")
+        report.say("VALID")
     else:
-        print("INVALID!!")
-        sys.exit("The FTPR partition signature is not valid. Is the input "
-                 "ME/TXE image valid?")
+        report.say("INVALID!!")
+        raise MeCleanerError("The FTPR partition signature is not valid. Is "
+                             "the input ME/TXE image valid?")
 
 
 def relocate_partition(f, me_end, partition_header_offset,
-                       new_offset, mod_headers):
+                       new_offset, mod_headers, report):
 
-    f.seek(partition_header_offset)
-    name = f.read(4).rstrip(b"\x00").decode("ascii")
-    f.seek(partition_header_offset + 0x8)
-    old_offset, partition_size = unpack("<II", f.read(0x8))
+    partition = FptEntry.read(f, partition_header_offset)
+    name = partition.name
+    old_offset, partition_size = partition.offset, partition.length
 
     llut_start = 0
     for mod_header in mod_headers:
-        if (unpack("<I", mod_header[0x50:0x54])[0] >> 4) & 7 == 0x01:
-            llut_start = unpack("<I", mod_header[0x38:0x3C])[0] + old_offset
+        if mod_header.compression == 0x01:
+            llut_start = mod_header.offset + old_offset
             break
 
     if mod_headers and llut_start != 0:
@@ -292,163 +936,140 @@ def relocate_partition(f, me_end, partition_header_offset,
         # to the SpiBase (bytes 0xc:0x10 of the LLUT) to compute the final
         # start of the LLUT. Since AddrBase is not modifiable, we can act only
         # on SpiBase and here we compute the minimum allowed new_offset.
-        f.seek(llut_start + 0x9)
-        lut_start_corr = unpack("<H", f.read(2))[0]
+        llut = LlutHeader.read(f, llut_start)
+        lut_start_corr = llut.start_correction
         new_offset = max(new_offset,
                          lut_start_corr - llut_start - 0x40 + old_offset)
         new_offset = ((new_offset + 0x1f) // 0x20) * 0x20
 
     offset_diff = new_offset - old_offset
-    print("Relocating {} from {:#x} - {:#x} to {:#x} - {:#x}..."
-          .format(name, old_offset, old_offset + partition_size,
-                  new_offset, new_offset + partition_size))
+    report.set(relocation={"partition": name, "from": old_offset,
+                           "to": new_offset, "size": partition_size})
+    report.say("Relocating {} from {:#x} - {:#x} to {:#x} - {:#x}...",
+               name, old_offset, old_offset + partition_size,
+               new_offset, new_offset + partition_size)
 
-    print(" Adjusting FPT entry...")
+    report.say(" Adjusting FPT entry...")
     f.write_to(partition_header_offset + 0x8,
                pack("<I", new_offset))
 
     if mod_headers:
         if llut_start != 0:
-            f.seek(llut_start)
-            if f.read(4) == b"LLUT":
-                print(" Adjusting LUT start offset...")
+            if llut.tag == b"LLUT":
+                report.say(" Adjusting LUT start offset...")
                 lut_offset = llut_start + offset_diff + 0x40 - lut_start_corr
                 f.write_to(llut_start + 0x0c, pack("<I", lut_offset))
 
-                print(" Adjusting Huffman start offset...")
-                f.seek(llut_start + 0x14)
-                old_huff_offset = unpack("<I", f.read(4))[0]
+                report.say(" Adjusting Huffman start offset...")
                 f.write_to(llut_start + 0x14,
-                           pack("<I", old_huff_offset + offset_diff))
+                           pack("<I", llut.huffman_offset + offset_diff))
 
-                print(" Adjusting chunks offsets...")
-                f.seek(llut_start + 0x4)
-                chunk_count = unpack("<I", f.read(4))[0]
+                report.say(" Adjusting chunks offsets...")
                 f.seek(llut_start + 0x40)
-                chunks = bytearray(chunk_count * 4)
+                chunks = bytearray(llut.chunk_count * 4)
                 f.readinto(chunks)
-                for i in range(0, chunk_count * 4, 4):
-                    if chunks[i + 3] != 0x80:
-                        chunks[i:i + 3] = \
-                            pack("<I", unpack("<I", chunks[i:i + 3] +
-                                 b"\x00")[0] + offset_diff)[0:3]
-                f.write_to(llut_start + 0x40, chunks)
+                f.write_to(llut_start + 0x40,
+                           relocate_chunks(chunks, offset_diff))
             else:
-                sys.exit("Huffman modules present but no LLUT found!")
+                raise MeCleanerError("Huffman modules present but no LLUT "
+                                     "found!")
         else:
-            print(" No Huffman modules found")
+            report.say(" No Huffman modules found")
 
-    print(" Moving data...")
+    report.say(" Moving data...")
     partition_size = min(partition_size, me_end - old_offset)
     f.move_range(old_offset, partition_size, new_offset, b"\xff")
 
     return new_offset
 
 
-def check_and_remove_modules(f, me_end, offset, min_offset,
-                             relocate, keep_modules):
+def check_and_remove_modules(f, image, me_end, min_offset, relocate,
+                             keep_modules, report):
 
-    f.seek(offset + 0x20)
-    num_modules = unpack("<I", f.read(4))[0]
-    f.seek(offset + 0x290)
-    data = f.read(0x84)
-
-    mod_header_size = 0
-    if data[0x0:0x4] == b"$MME":
-        if data[0x60:0x64] == b"$MME" or num_modules == 1:
-            mod_header_size = 0x60
-        elif data[0x80:0x84] == b"$MME":
-            mod_header_size = 0x80
+    offset, length = image.ftpr_offset, image.ftpr_length
+    mod_header_size, mod_headers = image.ftpr_modules
 
     if mod_header_size != 0:
-        f.seek(offset + 0x290)
-        data = f.read(mod_header_size * num_modules)
-        mod_headers = [data[i * mod_header_size:(i + 1) * mod_header_size]
-                       for i in range(0, num_modules)]
-
-        if all(hdr.startswith(b"$MME") for hdr in mod_headers):
-            if args.keep_modules:
-                end_addr = offset + ftpr_length
+        if len(mod_headers) == image.manifest.num_modules and \
+           all(hdr.tag == b"$MME" for hdr in mod_headers):
+            if keep_modules:
+                end_addr = offset + length
             else:
-                end_addr = remove_modules(f, mod_headers, offset, me_end)
+                end_addr = remove_modules(f, image, me_end, report)
 
-            if args.relocate:
-                new_offset = relocate_partition(f, me_end, 0x30, min_offset,
-                                                mod_headers)
+            if relocate:
+                with report.phase("relocate"):
+                    new_offset = relocate_partition(f, me_end, 0x30,
+                                                    min_offset, mod_headers,
+                                                    report)
                 end_addr += new_offset - offset
                 offset = new_offset
 
             return end_addr, offset
 
         else:
-            print("Found less modules than expected in the FTPR "
-                  "partition; skipping modules removal")
+            report.warn("Found less modules than expected in the FTPR "
+                        "partition; skipping modules removal")
     else:
-        print("Can't find the module header size; skipping "
-              "modules removal")
+        report.warn("Can't find the module header size; skipping "
+                    "modules removal")
 
     return -1, offset
 
 
-def check_and_remove_modules_gen3(f, me_end, partition_offset,
-                                  partition_length, min_offset, relocate,
-                                  keep_modules):
+def check_and_remove_modules_gen3(f, image, me_end, min_offset, relocate,
+                                  keep_modules, report):
 
     comp_str = ("LZMA/uncomp.", "Huffman")
+    partition_offset = image.ftpr_offset
+    partition_length = image.ftpr_length
 
     if keep_modules:
         end_data = partition_offset + partition_length
     else:
         end_data = 0
 
-        f.seek(partition_offset + 0x4)
-        module_count = unpack("<I", f.read(4))[0]
-
-        modules = []
-        modules.append(("end", partition_length, 0))
+        directory = image.cpd_directory(partition_offset)
 
-        f.seek(partition_offset + 0x10)
-        for i in range(0, module_count):
-            data = f.read(0x18)
-            name = data[0x0:0xc].rstrip(b"\x00").decode("ascii")
-            offset_block = unpack("<I", data[0xc:0x10])[0]
-            offset = offset_block & 0x01ffffff
-            comp_type = (offset_block & 0x02000000) >> 25
-
-            modules.append((name, offset, comp_type))
-
-        modules.sort(key=lambda x: x[1])
-
-        for i in range(0, module_count):
-            name = modules[i][0]
-            offset = partition_offset + modules[i][1]
-            end = partition_offset + modules[i + 1][1]
+        for entry, start, end in directory.modules(partition_length):
+            name = entry.name
+            offset = partition_offset + start
+            end = partition_offset + end
             removed = False
 
             if name.endswith(".man") or name.endswith(".met"):
                 compression = "uncompressed"
             else:
-                compression = comp_str[modules[i][2]]
+                compression = comp_str[entry.huffman]
 
-            print(" {:<12} ({:<12}, 0x{:06x} - 0x{:06x}): "
-                  .format(name, compression, offset, end), end="")
+            module = {"name": name, "compression": compression,
+                      "start": offset, "end": end}
+            report.append("modules", module)
+            report.say(" {:<12} ({:<12}, 0x{:06x} - 0x{:06x}): ",
+                       name, compression, offset, end, end="")
 
             if name.endswith(".man"):
-                print("NOT removed, partition manif.")
+                module["action"] = "kept, partition manifest"
+                report.say("NOT removed, partition manif.")
             elif name.endswith(".met"):
-                print("NOT removed, module metadata")
+                module["action"] = "kept, module metadata"
+                report.say("NOT removed, module metadata")
             elif any(name.startswith(m) for m in unremovable_modules_gen3):
-                print("NOT removed, essential")
+                module["action"] = "kept, essential"
+                report.say("NOT removed, essential")
             else:
                 removed = True
                 f.fill_range(offset, min(end, me_end), b"\xff")
-                print("removed")
+                module["action"] = "removed"
+                report.say("removed")
 
             if not removed:
                 end_data = max(end_data, end)
 
     if relocate:
-        new_offset = relocate_partition(f, me_end, 0x30, min_offset, [])
+        with report.phase("relocate"):
+            new_offset = relocate_partition(f, me_end, 0x30, min_offset, [],
+                                            report)
         end_data += new_offset - partition_offset
         partition_offset = new_offset
 
@@ -456,377 +1077,1253 @@ def check_and_remove_modules_gen3(f, me_end, partition_offset,
 
 
 def check_mn2_tag(f, offset, gen):
-    f.seek(offset + 0x1c)
-    tag = f.read(4)
+    tag = ManifestHeader.read(f, offset).tag
     expected_tag = b"$MAN" if gen == 1 else b"$MN2"
     if tag != expected_tag:
-        sys.exit("Wrong FTPR manifest tag ({}), this image may be corrupted"
-                 .format(tag))
-
-
-def flreg_to_start_end(flreg):
-    return (flreg & 0x7fff) << 12, (flreg >> 4 & 0x7fff000 | 0xfff) + 1
-
-
-def start_end_to_flreg(start, end):
-    return (start & 0x7fff000) >> 12 | ((end - 1) & 0x7fff000) << 4
-
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Tool to remove as much code "
-                                     "as possible from Intel ME/TXE firmware "
-                                     "images")
-    softdis = parser.add_mutually_exclusive_group()
-    bw_list = parser.add_mutually_exclusive_group()
-
-    parser.add_argument("-v", "--version", action="version",
-                        version="%(prog)s 1.2")
-
-    parser.add_argument("file", help="ME/TXE image or full dump")
-    parser.add_argument("-O", "--output", metavar='output_file', help="save "
-                        "the modified image in a separate file, instead of "
-                        "modifying the original file")
-    softdis.add_argument("-S", "--soft-disable", help="in addition to the "
-                         "usual operations on the ME/TXE firmware, set the "
-                         "MeAltDisable bit or the HAP bit to ask Intel ME/TXE "
-                         "to disable itself after the hardware initialization "
-                         "(requires a full dump)", action="store_true")
-    softdis.add_argument("-s", "--soft-disable-only", help="instead of the "
-                         "usual operations on the ME/TXE firmware, just set "
-                         "the MeAltDisable bit or the HAP bit to ask Intel "
-                         "ME/TXE to disable itself after the hardware "
-                         "initialization (requires a full dump)",
-                         action="store_true")
-    parser.add_argument("-r", "--relocate", help="relocate the FTPR partition "
-                        "to the top of the ME region to save even more space",
-                        action="store_true")
-    parser.add_argument("-t", "--truncate", help="truncate the empty part of "
-                        "the firmware (requires a separated ME/TXE image or "
-                        "--extract-me)", action="store_true")
-    parser.add_argument("-k", "--keep-modules", help="don't remove the FTPR "
-                        "modules, even when possible", action="store_true")
-    bw_list.add_argument("-w", "--whitelist", metavar="whitelist",
-                         help="Comma separated list of additional partitions "
-                         "to keep in the final image. This can be used to "
-                         "specify the MFS partition for example, which stores "
-                         "PCIe and clock settings.")
-    bw_list.add_argument("-b", "--blacklist", metavar="blacklist",
-                         help="Comma separated list of partitions to remove "
-                         "from the image. This option overrides the default "
-                         "removal list.")
-    parser.add_argument("-d", "--descriptor", help="remove the ME/TXE "
-                        "Read/Write permissions to the other regions on the "
-                        "flash from the Intel Flash Descriptor (requires a "
-                        "full dump)", action="store_true")
-    parser.add_argument("-D", "--extract-descriptor",
-                        metavar='output_descriptor', help="extract the flash "
-                        "descriptor from a full dump; when used with "
-                        "--truncate save a descriptor with adjusted regions "
-                        "start and end")
-    parser.add_argument("-M", "--extract-me", metavar='output_me_image',
-                        help="extract the ME firmware from a full dump; when "
-                        "used with --truncate save a truncated ME/TXE image")
-    parser.add_argument("-c", "--check", help="verify the integrity of the "
-                        "fundamental parts of the firmware and exit",
-                        action="store_true")
+        raise MeCleanerError("Wrong FTPR manifest tag ({}), this image may "
+                             "be corrupted".format(tag))
 
-    args = parser.parse_args()
 
-    if args.check and (args.soft_disable_only or args.soft_disable or
-       args.relocate or args.descriptor or args.truncate or args.output):
-        sys.exit("-c can't be used with -S, -s, -r, -d, -t or -O")
+class MeImage:
+    """Layout of an ME/TXE image or of a full dump, as found by parse_image().
 
-    if args.soft_disable_only and (args.relocate or args.truncate):
-        sys.exit("-s can't be used with -r or -t")
+    The flash descriptor, the FPT header and the FTPR manifest header are
+    decoded by parse_image(). The partition table, the $CPD directories, the
+    FTPR modules and the LLUT are read from the image file f only when they
+    are first needed, and then kept: they can be accessed as long as f is
+    open.
 
-    if (args.whitelist or args.blacklist) and args.relocate:
-        sys.exit("Relocation is not yet supported with custom whitelist or "
-                 "blacklist")
+    Offsets of the FPT, of the partitions and of the FTPR manifest are
+    relative to the start of the ME region (me_start)."""
 
-    gen = None
+    def __init__(self, f=None):
+        self.f = f
+        self.size = 0
+        self.full_dump = False
+        self.gen = None
+
+        # Flash descriptor (full dumps only)
+        self.frba = self.fmba = self.fisba = self.fmsba = self.fpsba = 0
+        self.fd_start = self.fd_end = 0
+        self.bios_start = self.bios_end = 0
+        self.me_start = self.me_end = 0
+
+        # ME/TXE firmware
+        self.fpt_offset = 0
+        self.num_partitions = 0
+        self.ftpr_offset = self.ftpr_length = 0
+        self.ftpr_mn2_offset = 0
+        self.manifest = None
+        self.version = None
+        self.pubkey_md5 = None
+        self.variant = None
+        self.pubkey_versions = None
+
+        # Layout of the update image the region was built from (see
+        # open_update)
+        self.layout = None
+
+        # Decoded on demand
+        self._mef = None
+        self._partitions = None
+        self._cpd_directories = {}
+        self._code_partitions = None
+        self._ftpr_modules = None
+        self._ftpr_llut = None
+
+    @property
+    def mef(self):
+        if self._mef is None:
+            self._mef = region_file(self.f, self.me_start, self.me_end)
+        return self._mef
+
+    @property
+    def partitions(self):
+        """The entries of the FPT"""
+        if self._partitions is None:
+            self._partitions = FptEntry.read_array(
+                self.mef, self.fpt_offset + 0x20, self.num_partitions)
+        return self._partitions
+
+    def find_partition(self, tags):
+        """Return the first entry of the FPT with one of the given tags, or
+        None, reading the table only up to that entry"""
+        if self._partitions is not None:
+            return next((p for p in self._partitions if p.tag in tags), None)
+
+        for i in range(self.num_partitions):
+            partition = FptEntry.read(self.mef,
+                                      self.fpt_offset + 0x20 + i * 0x20)
+            if partition.tag in tags:
+                return partition
+
+        return None
+
+    def cpd_directory(self, offset):
+        """The $CPD directory at offset, or None if there is no such
+        directory"""
+        if offset not in self._cpd_directories:
+            self._cpd_directories[offset] = CpdDirectory.read(
+                self.mef, offset, self.me_end - self.me_start)
+        return self._cpd_directories[offset]
+
+    @property
+    def code_partitions(self):
+        """The $CPD directories of the code partitions (generation 3), by
+        partition name, in the order of the FPT"""
+        if self._code_partitions is None:
+            region_size = self.me_end - self.me_start
+            self._code_partitions = {}
+            for partition in self.partitions:
+                if partition.flags & 0x7f == 2 or partition.offset == 0 or \
+                   partition.length in (0, 0xffffffff) or \
+                   partition.offset + partition.length > region_size:
+                    continue
+                directory = self.cpd_directory(partition.offset)
+                if directory is not None:
+                    self._code_partitions[partition.name] = directory
+        return self._code_partitions
+
+    @property
+    def ftpr_modules(self):
+        """Size and list of the $MME headers of the FTPR modules (generation
+        2). The size is 0 if it can't be found; the list may hold less
+        headers than expected if the manifest is truncated."""
+        if self._ftpr_modules is None:
+            offset = self.ftpr_offset + self.ftpr_mn2_offset
+            num_modules = self.manifest.num_modules
+            self.mef.seek(offset + 0x290)
+            data = self.mef.read(0x84)
+
+            mod_header_size = 0
+            if data[0x0:0x4] == b"$MME":
+                if data[0x60:0x64] == b"$MME" or num_modules == 1:
+                    mod_header_size = 0x60
+                elif data[0x80:0x84] == b"$MME":
+                    mod_header_size = 0x80
+
+            mod_headers = []
+            if mod_header_size != 0:
+                self.mef.seek(offset + 0x290)
+                data = memoryview(self.mef.read(mod_header_size *
+                                                num_modules))
+                mod_headers = ModuleHeader.array_from(
+                    data, 0, min(num_modules, len(data) // mod_header_size),
+                    mod_header_size)
+
+            self._ftpr_modules = mod_header_size, mod_headers
+        return self._ftpr_modules
+
+    @property
+    def ftpr_llut(self):
+        """Header of the LLUT of the Huffman compressed FTPR modules and
+        offsets of their chunks, as a tuple, or None if there are no such
+        modules"""
+        if self._ftpr_llut is None:
+            huffman = [m for m in self.ftpr_modules[1] if m.compression == 1]
+            if not huffman:
+                return None
+
+            offset = self.ftpr_offset + huffman[0].offset
+            self.mef.seek(offset)
+            llut = self.mef.read(0x40)
+            if llut[0x0:0x4] != b"LLUT":
+                raise MeCleanerError("Huffman modules found, but LLUT is not "
+                                     "present")
+            header = LlutHeader.unpack_from(llut)
+            llut += self.mef.read(header.chunk_count * 4)
+            self._ftpr_llut = header, get_chunks_offsets(llut)
+        return self._ftpr_llut
+
+    @property
+    def me_disabled(self):
+        return self.me_start >= self.me_end
+
+    @property
+    def ftpr_manifest_offset(self):
+        return self.ftpr_offset + self.ftpr_mn2_offset
+
+    @property
+    def pubkey_known(self):
+        return self.pubkey_versions is not None
+
+    @property
+    def version_string(self):
+        return ".".join(str(i) for i in self.version)
+
+    def to_dict(self, code_partitions=False):
+        """The layout as a JSON serializable dict, with absolute offsets.
+        The $CPD directories of all the code partitions (generation 3) are
+        only read and listed if code_partitions is set."""
+
+        regions = {"me": [self.me_start, self.me_end]}
+        if self.full_dump:
+            regions["descriptor"] = [self.fd_start, self.fd_end]
+            regions["bios"] = [self.bios_start, self.bios_end]
+
+        image = {
+            "type": "full dump" if self.full_dump else "ME/TXE image",
+            "size": self.size,
+            "generation": self.gen,
+            "regions": regions,
+        }
+
+        if self.version is not None:
+            image.update({
+                "version": self.version_string,
+                "variant": self.variant,
+                "public_key_md5": self.pubkey_md5,
+                "public_key_known": self.pubkey_known,
+                "fpt_offset": self.me_start + self.fpt_offset,
+                "ftpr": [self.me_start + self.ftpr_offset,
+                         self.me_start + self.ftpr_offset + self.ftpr_length],
+                "ftpr_manifest": self.me_start + self.ftpr_manifest_offset,
+            })
+
+        if code_partitions and self.gen == 3:
+            image["code_partitions"] = [
+                {"name": name, "offset": self.me_start + directory.offset,
+                 "entries": [entry.name for entry in directory.entries]}
+                for name, directory in self.code_partitions.items()]
+
+        if self.layout is not None:
+            image["update_layout"] = self.layout.name
+
+        return image
+
+
+def parse_image(f, report=None, full_dump_error=None):
+    """Parse the layout of the ME/TXE image or full dump in f (any readable
+    and seekable file object) and return a MeImage. If full_dump_error is
+    given, a MeCleanerError with this message is raised as soon as f turns
+    out to hold a bare ME/TXE image."""
+
+    if report is None:
+        report = Report()
+
+    image = MeImage(f)
 
-    f = open(args.file, "rb" if args.check or args.output else "r+b")
     magic0 = f.read(4)
     f.seek(0x10)
     magic10 = f.read(4)
+    f.seek(0, 2)
+    image.size = f.tell()
 
     if b"$FPT" in {magic0, magic10}:
-        print("ME/TXE image detected")
+        report.say("ME/TXE image detected")
 
-        if args.descriptor or args.extract_descriptor or args.extract_me or \
-           args.soft_disable or args.soft_disable_only:
-            sys.exit("-d, -D, -M, -S and -s require a full dump")
+        if full_dump_error:
+            raise MeCleanerError(full_dump_error)
 
-        f.seek(0, 2)
-        me_start = 0
-        me_end = f.tell()
-        mef = RegionFile(f, me_start, me_end)
+        image.me_start = 0
+        image.me_end = image.size
 
     elif b"\x5a\xa5\xf0\x0f" in {magic0, magic10}:
-        print("Full image detected")
+        report.say("Full image detected")
+        image.full_dump = True
 
-        f.seek(0x4 if magic0 == b"\x5a\xa5\xf0\x0f" else 0x14)
-        flmap0, flmap1, flmap2 = unpack("<III", f.read(0xc))
-        frba = flmap0 >> 12 & 0xff0
-        fmba = (flmap1 & 0xff) << 4
+        flmap = FlashMap.read(f, 0x4 if magic0 == b"\x5a\xa5\xf0\x0f"
+                              else 0x14)
+        image.frba = flmap.frba
+        image.fmba = flmap.fmba
 
         # Generation 1
-        fisba = flmap1 >> 12 & 0xff0
-        fmsba = (flmap2 & 0xff) << 4
+        image.fisba = flmap.fisba
+        image.fmsba = flmap.fmsba
 
         # Generation 2-3
-        fpsba = fisba
+        image.fpsba = image.fisba
 
-        f.seek(frba)
-        flreg = unpack("<III", f.read(12))
+        flreg = FlashRegions.read(f, image.frba)
 
-        fd_start, fd_end = flreg_to_start_end(flreg[0])
-        bios_start, bios_end = flreg_to_start_end(flreg[1])
-        me_start, me_end = flreg_to_start_end(flreg[2])
+        image.fd_start, image.fd_end = flreg_to_start_end(flreg.descriptor)
+        image.bios_start, image.bios_end = flreg_to_start_end(flreg.bios)
+        image.me_start, image.me_end = flreg_to_start_end(flreg.me)
 
-        if me_start >= me_end:
-            print("The ME region in this image has already been disabled")
-        else:
-            mef = RegionFile(f, me_start, me_end)
+        if image.me_disabled:
+            report.say("The ME region in this image has already been "
+                       "disabled")
 
         if magic0 == b"\x5a\xa5\xf0\x0f":
-            gen = 1
+            image.gen = 1
 
     else:
-        sys.exit("Unknown image")
+        raise MeCleanerError("Unknown image")
+
+    if image.me_disabled:
+        return image
+
+    mef = image.mef
 
-    if me_start < me_end:
-        mef.seek(0)
+    mef.seek(0)
+    if mef.read(4) == b"$FPT":
+        image.fpt_offset = 0
+    else:
+        mef.seek(0x10)
         if mef.read(4) == b"$FPT":
-            fpt_offset = 0
+            image.fpt_offset = 0x10
         else:
-            mef.seek(0x10)
-            if mef.read(4) == b"$FPT":
-                fpt_offset = 0x10
+            if image.me_start > 0:
+                raise MeCleanerError("The ME/TXE region is valid but the "
+                                     "firmware is corrupted or missing")
             else:
-                if me_start > 0:
-                    sys.exit("The ME/TXE region is valid but the firmware is "
-                             "corrupted or missing")
-                else:
-                    sys.exit("Unknown error")
-
-    if gen == 1:
-        end_addr = 0
-    else:
-        end_addr = me_end
-
-    if me_start < me_end:
-        print("Found FPT header at {:#x}".format(mef.region_start + fpt_offset))
+                raise MeCleanerError("Unknown error")
 
-        mef.seek(fpt_offset + 0x4)
-        entries = unpack("<I", mef.read(4))[0]
-        print("Found {} partition(s)".format(entries))
+    report.say("Found FPT header at {:#x}",
+               mef.region_start + image.fpt_offset)
 
-        mef.seek(fpt_offset + 0x20)
-        partitions = mef.read(entries * 0x20)
+    image.num_partitions = FptHeader.read(mef, image.fpt_offset).num_entries
+    report.say("Found {} partition(s)", image.num_partitions)
 
-        ftpr_header = b""
+    ftpr_header = image.find_partition({b"CODE", b"FTPR"})
+    if ftpr_header is None:
+        raise MeCleanerError("FTPR header not found, this image doesn't seem "
+                             "to be valid")
 
-        for i in range(entries):
-            if partitions[i * 0x20:(i * 0x20) + 4] in {b"CODE", b"FTPR"}:
-                ftpr_header = partitions[i * 0x20:(i + 1) * 0x20]
-                break
+    if ftpr_header.tag == b"CODE":
+        image.gen = 1
 
-        if ftpr_header == b"":
-            sys.exit("FTPR header not found, this image doesn't seem to be "
-                     "valid")
+    image.ftpr_offset = ftpr_offset = ftpr_header.offset
+    image.ftpr_length = ftpr_header.length
+    report.say("Found FTPR header: FTPR partition spans from {:#x} to {:#x}",
+               ftpr_offset, ftpr_offset + image.ftpr_length)
 
-        if ftpr_header[0x0:0x4] == b"CODE":
-            gen = 1
+    ftpr_cpd = image.cpd_directory(ftpr_offset)
+    if ftpr_cpd is not None:
+        image.gen = 3
+        ftpr_man = ftpr_cpd.get("FTPR.man")
+        ftpr_mn2_offset = ftpr_man.offset if ftpr_man is not None else -1
 
-        ftpr_offset, ftpr_length = unpack("<II", ftpr_header[0x08:0x10])
-        print("Found FTPR header: FTPR partition spans from {:#x} to {:#x}"
-              .format(ftpr_offset, ftpr_offset + ftpr_length))
+        if ftpr_mn2_offset >= 0:
+            check_mn2_tag(mef, ftpr_offset + ftpr_mn2_offset, image.gen)
+            report.say("Found FTPR manifest at {:#x}",
+                       ftpr_offset + ftpr_mn2_offset)
+        else:
+            raise MeCleanerError("Can't find the manifest of the FTPR "
+                                 "partition")
 
-        mef.seek(ftpr_offset)
-        if mef.read(4) == b"$CPD":
-            gen = 3
-            num_entries = unpack("<I", mef.read(4))[0]
+    else:
+        check_mn2_tag(mef, ftpr_offset, image.gen)
+        ftpr_mn2_offset = 0
+        if not image.gen:
+            image.gen = 2
 
-            mef.seek(ftpr_offset + 0x10)
-            ftpr_mn2_offset = -1
+    image.ftpr_mn2_offset = ftpr_mn2_offset
 
-            for i in range(0, num_entries):
-                data = mef.read(0x18)
-                name = data[0x0:0xc].rstrip(b"\x00").decode("ascii")
-                offset = unpack("<I", data[0xc:0xf] + b"\x00")[0]
+    image.manifest = ManifestHeader.read(mef, ftpr_offset + ftpr_mn2_offset)
+    image.version = version = image.manifest.version
+    report.say("ME/TXE firmware version {} (generation {})",
+               image.version_string, image.gen)
 
-                if name == "FTPR.man":
-                    ftpr_mn2_offset = offset
-                    break
+    mef.seek(ftpr_offset + ftpr_mn2_offset + 0x80)
+    image.pubkey_md5 = hashlib.md5(mef.read(0x104)).hexdigest()
 
-            if ftpr_mn2_offset >= 0:
-                check_mn2_tag(mef, ftpr_offset + ftpr_mn2_offset, gen)
-                print("Found FTPR manifest at {:#x}"
-                      .format(ftpr_offset + ftpr_mn2_offset))
+    if image.pubkey_md5 in pubkeys_md5:
+        image.variant, image.pubkey_versions = pubkeys_md5[image.pubkey_md5]
+        report.say("Public key match: Intel {}, firmware versions {}",
+                   image.variant, ", ".join(image.pubkey_versions))
+    else:
+        if version[0] >= 6:
+            image.variant = "ME"
+        else:
+            image.variant = "TXE"
+        report.warn("WARNING Unknown public key {}\n"
+                    "        Assuming Intel {}\n"
+                    "        Please report this warning to the project's "
+                    "maintainer!", image.pubkey_md5, image.variant)
+
+    return image
+
+
+class CleanOptions:
+    """Options of clean(), with the same names and defaults as the command
+    line arguments"""
+
+    def __init__(self, output=None, soft_disable=False,
+                 soft_disable_only=False, relocate=False, truncate=False,
+                 keep_modules=False, whitelist=None, blacklist=None,
+                 descriptor=False, extract_descriptor=None, extract_me=None,
+                 check=False, mmap=True, cache=None,
+                 cache_size=DEFAULT_MAX_SIZE, json=False, plan=None,
+                 sparse=False, patch=None, from_update=False, carve=False,
+                 carve_offset=None):
+        self.output = output
+        self.soft_disable = soft_disable
+        self.soft_disable_only = soft_disable_only
+        self.relocate = relocate
+        self.truncate = truncate
+        self.keep_modules = keep_modules
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self.descriptor = descriptor
+        self.extract_descriptor = extract_descriptor
+        self.extract_me = extract_me
+        self.check = check
+        self.mmap = mmap
+        self.cache = cache
+        self.cache_size = cache_size
+        self.json = json
+        self.plan = plan
+        self.sparse = sparse
+        self.patch = patch
+        self.from_update = from_update
+        self.carve = carve
+        self.carve_offset = carve_offset
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(output=args.output, soft_disable=args.soft_disable,
+                   soft_disable_only=args.soft_disable_only,
+                   relocate=args.relocate, truncate=args.truncate,
+                   keep_modules=args.keep_modules, whitelist=args.whitelist,
+                   blacklist=args.blacklist, descriptor=args.descriptor,
+                   extract_descriptor=args.extract_descriptor,
+                   extract_me=args.extract_me, check=args.check,
+                   mmap=not args.no_mmap, cache=args.cache,
+                   cache_size=args.cache_size * 1024 * 1024, json=args.json,
+                   plan=args.plan, sparse=args.sparse, patch=args.patch,
+                   from_update=args.from_update, carve=args.carve,
+                   carve_offset=args.carve_offset)
+
+    def validate(self):
+        if self.check and (self.soft_disable_only or self.soft_disable or
+           self.relocate or self.descriptor or self.truncate or self.output):
+            raise MeCleanerError("-c can't be used with -S, -s, -r, -d, -t or "
+                                 "-O")
+
+        if self.soft_disable_only and (self.relocate or self.truncate):
+            raise MeCleanerError("-s can't be used with -r or -t")
+
+        if (self.whitelist or self.blacklist) and self.relocate:
+            raise MeCleanerError("Relocation is not yet supported with custom "
+                                 "whitelist or blacklist")
+
+        if self.plan and (self.check or self.output or
+                          self.extract_descriptor or self.extract_me):
+            raise MeCleanerError("--plan can't be used with -c, -O, -D or -M")
+
+        if self.sparse and (self.check or self.plan):
+            raise MeCleanerError("--sparse can't be used with -c or --plan")
+
+        if self.patch and (self.check or self.plan or self.sparse or
+                           self.output or self.extract_descriptor or
+                           self.extract_me):
+            raise MeCleanerError("--patch can't be used with -c, --plan, "
+                                 "--sparse, -O, -D or -M")
+
+        if self.carve_offset is not None and not self.carve:
+            raise MeCleanerError("--carve-offset requires --carve")
+
+        if self.carve and self.from_update:
+            raise MeCleanerError("--carve can't be used with -u")
+
+    def cache_options(self):
+        """The options that affect the files produced by clean(), normalized
+        to be part of a cache key"""
+
+        def partition_list(names):
+            return sorted(set(names.split(","))) if names else None
+
+        return {
+            "soft_disable": self.soft_disable,
+            "soft_disable_only": self.soft_disable_only,
+            "relocate": self.relocate,
+            "truncate": self.truncate,
+            "keep_modules": self.keep_modules,
+            "whitelist": partition_list(self.whitelist),
+            "blacklist": partition_list(self.blacklist),
+            "descriptor": self.descriptor,
+            "in_place": not self.output,
+            "extract_descriptor": bool(self.extract_descriptor),
+            "extract_me": bool(self.extract_me),
+            "sparse": self.sparse,
+            "from_update": self.from_update,
+            "carve": self.carve,
+            "carve_offset": self.carve_offset,
+            # Only the text output is saved to be replayed
+            "json": self.json,
+        }
+
+
+class CleanResult:
+    """Outcome of clean()"""
+
+    def __init__(self, image):
+        self.image = image
+        self.min_size = None
+        self.me6_ignition = False
+        self.signature_valid = None
+        self.extracted_signature_valid = None
+        self.cached = False
+        self.report = None
+
+
+def clean(filename, options, report=None):
+    """Check or clean the ME/TXE image or full dump in filename as the
+    command line tool does, and return a CleanResult.
+
+    Errors on the image raise MeCleanerError; the image files are always
+    closed before returning. If options.cache is set, the files produced are
+    restored from there when the same image has already been cleaned with
+    the same options. What happens is described in report (a new Report,
+    printing only if options.json is False, if not given), which is also
+    available as the report attribute of the result."""
+
+    if report is None:
+        report = Report(text=not options.json)
+
+    report.set(file=filename, tool="me_cleaner " + __version__)
+
+    try:
+        with report.phase("total"):
+            options.validate()
+
+            if options.cache and not options.check and \
+               not options.plan and not options.patch:
+                result = clean_cached(filename, options, report)
             else:
-                sys.exit("Can't find the manifest of the FTPR partition")
+                result = _clean(filename, options, report)
+    except MeCleanerError as e:
+        report.set(ok=False, error=str(e))
+        raise
+    except (EnvironmentError, ValueError, KeyError) as e:
+        error = wrap_error(e)
+        report.set(ok=False, error=str(error))
+        raise error from e
+
+    report.set(ok=True, error=None)
+    result.report = report
+
+    return result
+
+
+def cache_tool_id():
+    """Identity of this version of me_cleaner in the cache keys"""
+    return tool_id("me_cleaner " + __version__,
+                   [__file__, me_carve.__file__, me_signature.__file__,
+                    me_structs.__file__, me_update.__file__])
+
+
+def clean_cached(filename, options, report):
+    cache = OutputCache(options.cache, options.cache_size)
+    input_hash = file_sha256(filename)
+    if is_sparse(filename):
+        input_hash += file_sha256(filename + SPARSE_MAP_SUFFIX)
+    key = cache.key(input_hash, cache_tool_id(), options.cache_options())
+
+    paths = {"image": options.output or filename}
+    if options.sparse:
+        paths["map"] = paths["image"] + SPARSE_MAP_SUFFIX
+    if options.extract_descriptor:
+        paths["descriptor"] = options.extract_descriptor
+    if options.extract_me:
+        paths["me"] = options.extract_me
+
+    entry = cache.get(key)
+    if entry is not None:
+        try:
+            cache.restore(entry, paths)
+        except EnvironmentError:
+            # Evicted by a concurrent run, or not restorable: clean again
+            entry = None
+    if entry is not None:
+        report.say("Restoring the result of a previous run from the cache "
+                   "({})...", key[:16])
+        if not options.sparse:
+            remove_sparse_map(paths["image"])
+
+        metadata = entry["metadata"]
+        if report.text:
+            # The log names the files of the run that filled the cache
+            log = metadata["log"]
+            for role, path in metadata["paths"].items():
+                if role in paths:
+                    log = log.replace('"{}"'.format(path),
+                                      '"{}"'.format(paths[role]))
+            report.say(log, end="")
+
+        cached_report = dict(metadata["report"])
+        cached_report["timings"].update(report.data["timings"])
+        report.set(**cached_report)
+        report.set(cached=True, file=filename)
+
+        result = CleanResult(None)
+        result.cached = True
+        for attr in ("min_size", "me6_ignition", "signature_valid",
+                     "extracted_signature_valid"):
+            setattr(result, attr, metadata[attr])
+        return result
+
+    with capture_stdout() as log:
+        result = _clean(filename, options, report)
+
+    metadata = {"log": log.getvalue(), "paths": paths, "report": report.data}
+    for attr in ("min_size", "me6_ignition", "signature_valid",
+                 "extracted_signature_valid"):
+        metadata[attr] = getattr(result, attr)
+
+    cache.put(key, {role: path for role, path in paths.items()
+                    if os.path.exists(path)}, metadata)
+
+    return result
+
+
+def _clean(filename, options, report):
+    layout = None
+    if options.from_update:
+        f, layout = open_update(filename, options.mmap, report)
+    elif options.carve:
+        f = open_carved(filename, options.carve_offset, options.mmap, report)
+    elif is_sparse(filename):
+        # Saved by --sparse: the holes are read back as 0xFF through the plan
+        f = open_sparse(filename, options.mmap)
+    else:
+        planned = options.plan or options.patch or options.output or \
+            options.sparse
+        f = open_image(filename,
+                       "rb" if options.check or planned else "r+b",
+                       options.mmap)
+        # The output image is written in one pass, once all the edits are
+        # known
+        if planned:
+            f = PlanFile(f)
+
+    try:
+        with report.phase("parse"):
+            image = parse_image(
+                f, report, "-d, -D, -M, -S and -s require a full dump"
+                if options.descriptor or options.extract_descriptor or
+                options.extract_me or options.soft_disable or
+                options.soft_disable_only else None)
+        image.layout = layout
+        report.set(image=image.to_dict(code_partitions=options.json))
+        result = CleanResult(image)
+
+        # Only the descriptor of a generation 1 dump can still be handled
+        # once its ME region is disabled
+        if image.me_disabled and image.gen != 1:
+            raise MeCleanerError("Can't identify the firmware generation of "
+                                 "an image whose ME region is disabled")
+        report.set(me_region_already_disabled=image.me_disabled)
+
+        gen = image.gen
+        me_start, me_end = image.me_start, image.me_end
+        variant, version = image.variant, image.version
+        ftpr_offset = image.ftpr_offset
+        ftpr_mn2_offset = image.ftpr_mn2_offset
 
+        if gen == 1:
+            end_addr = 0
         else:
-            check_mn2_tag(mef, ftpr_offset, gen)
-            ftpr_mn2_offset = 0
-            if not gen:
-                gen = 2
-
-        mef.seek(ftpr_offset + ftpr_mn2_offset + 0x24)
-        version = unpack("<HHHH", mef.read(0x08))
-        print("ME/TXE firmware version {} (generation {})"
-              .format('.'.join(str(i) for i in version), gen))
-
-        mef.seek(ftpr_offset + ftpr_mn2_offset + 0x80)
-        pubkey_md5 = hashlib.md5(mef.read(0x104)).hexdigest()
-
-        if pubkey_md5 in pubkeys_md5:
-            variant, pubkey_versions = pubkeys_md5[pubkey_md5]
-            print("Public key match: Intel {}, firmware versions {}"
-                  .format(variant, ", ".join(pubkey_versions)))
-        else:
-            if version[0] >= 6:
-                variant = "ME"
+            end_addr = me_end
+
+        mef = None if image.me_disabled else \
+            region_file(f, me_start, me_end)
+
+        if me_start > 0:
+            fdf = region_file(f, image.fd_start, image.fd_end)
+            descriptor_bits = {}
+            report.set(descriptor_bits=descriptor_bits)
+
+            if gen == 1:
+                for (ba, name) in ((image.fisba, "ICHSTRP0"),
+                                   (image.fmsba, "MCHSTRP0")):
+                    fdf.seek(ba)
+                    strp = unpack("<I", fdf.read(4))[0]
+                    bit = descriptor_bits["meDisable " + name] = \
+                        {"before": bool(strp & 1), "after": bool(strp & 1)}
+                    report.say("The meDisable bit in " + name + " is ",
+                               end="")
+                    if strp & 1:
+                        report.say("SET")
+                    elif options.check:
+                        report.say("NOT SET")
+                    else:
+                        report.say("NOT SET, setting it now...")
+                        fdf.write_to(ba, pack("<I", strp | 1))
+                        bit["after"] = True
+            elif gen == 2:
+                fdf.seek(image.fpsba + 0x28)
+                pchstrp10 = unpack("<I", fdf.read(4))[0]
+                altmedisable = bool(pchstrp10 & 1 << 7)
+                descriptor_bits["AltMeDisable"] = \
+                    {"before": altmedisable, "after": altmedisable}
+                report.say("The AltMeDisable bit is " +
+                           ("SET" if altmedisable else "NOT SET"))
             else:
-                variant = "TXE"
-            print("WARNING Unknown public key {}\n"
-                  "        Assuming Intel {}\n"
-                  "        Please report this warning to the project's "
-                  "maintainer!"
-                  .format(pubkey_md5, variant))
-
-    if not args.check and args.output:
-        f.close()
-        shutil.copy(args.file, args.output)
-        f = open(args.output, "r+b")
+                fdf.seek(image.fpsba)
+                pchstrp0 = unpack("<I", fdf.read(4))[0]
+                hap = bool(pchstrp0 & 1 << 16)
+                descriptor_bits["HAP"] = {"before": hap, "after": hap}
+                report.say("The HAP bit is " + ("SET" if hap else "NOT SET"))
+
+            # Generation 1: wipe everything and disable the ME region
+            if gen == 1 and not image.me_disabled and not options.check:
+                report.say("Disabling the ME region...")
+                f.seek(image.frba + 0x8)
+                f.write(pack("<I", 0x1fff))
+
+                report.say("Wiping the ME region...")
+                mef = region_file(f, me_start, me_end)
+                mef.fill_all(b"\xff")
+                report.set(me_region_disabled=True)
+
+        # ME 6 Ignition: wipe everything
+        me6_ignition = False
+        if gen == 2 and not options.check and \
+           not options.soft_disable_only and variant == "ME" and \
+           version[0] == 6:
+            num_modules = image.manifest.num_modules
+            mef.seek(ftpr_offset + 0x290 + (num_modules + 1) * 0x60)
+            data = mef.read(0xc)
+
+            if data[0x0:0x4] == b"$SKU" and \
+               data[0x8:0xc] == b"\x00\x00\x00\x00":
+                report.say("ME 6 Ignition firmware detected, removing "
+                           "everything...")
+                mef.fill_all(b"\xff")
+                me6_ignition = True
+
+        result.me6_ignition = me6_ignition
+        report.set(me6_ignition=me6_ignition)
+
+        if gen != 1 and not options.check:
+            if not options.soft_disable_only and not me6_ignition:
+                end_addr = clean_partitions(mef, image, options, report)
+
+                if end_addr > 0:
+                    result.min_size = end_addr
+                    report.set(min_size=end_addr)
+                    report.say("The ME minimum size should be {0} bytes "
+                               "({0:#x} bytes)", end_addr)
+
+                    if me_start > 0:
+                        report.say("The ME region can be reduced up to:\n"
+                                   " {:08x}:{:08x} me",
+                                   me_start, me_start + end_addr - 1)
+                    elif options.truncate:
+                        report.say("Truncating file at {:#x}...", end_addr)
+                        with report.phase("truncate"):
+                            f.truncate(end_addr)
+                        report.set(truncated_to=end_addr)
+
+            if options.soft_disable or options.soft_disable_only:
+                if gen == 3:
+                    report.say("Setting the HAP bit in PCHSTRP0 to disable "
+                               "Intel ME...")
+                    pchstrp0 |= (1 << 16)
+                    fdf.write_to(image.fpsba, pack("<I", pchstrp0))
+                    descriptor_bits["HAP"]["after"] = True
+                else:
+                    report.say("Setting the AltMeDisable bit in PCHSTRP10 to "
+                               "disable Intel ME...")
+                    pchstrp10 |= (1 << 7)
+                    fdf.write_to(image.fpsba + 0x28, pack("<I", pchstrp10))
+                    descriptor_bits["AltMeDisable"]["after"] = True
+
+        if options.descriptor:
+            report.say("Removing ME/TXE R/W access to the other flash "
+                       "regions...")
+            if gen == 3:
+                flmstr2 = 0x00400500
+            else:
+                fdf.seek(image.fmba + 0x4)
+                flmstr2 = (unpack("<I", fdf.read(4))[0] | 0x04040000) & \
+                    0x0404ffff
+
+            fdf.write_to(image.fmba + 0x4, pack("<I", flmstr2))
+            report.set(flmstr2=flmstr2)
+
+        if options.extract_descriptor:
+            with report.phase("extract"):
+                extract_descriptor(fdf, image, options, end_addr, report)
+
+        if isinstance(f, PlanFile) and not options.check and \
+           not options.plan and not options.patch:
+            target = options.output or filename
+            with report.phase("write"):
+                sparse_map = write_plan(f.plan, f.base, filename, target,
+                                        options.sparse)
+            report.set(output=target)
+            if sparse_map is not None:
+                holes = sum(end - start for start, end in sparse_map["runs"])
+                report.say("Left {:#x} bytes of 0xFF as holes, listed in "
+                           "\"{}\"", holes, target + SPARSE_MAP_SUFFIX)
+                report.set(sparse={"map": target + SPARSE_MAP_SUFFIX,
+                                   "runs": len(sparse_map["runs"]),
+                                   "holes_size": holes})
+
+        # The FTPR partition may have been relocated by clean_partitions()
+        ftpr_offset = image.ftpr_offset
+        signature = {}
+
+        if gen != 1:
+            if options.extract_me:
+                with report.phase("extract"):
+                    if options.truncate:
+                        report.say("Extracting and truncating the ME image "
+                                   "to \"{}\"...", options.extract_me)
+                        mef_copy = mef.save(options.extract_me, end_addr)
+                    else:
+                        report.say("Extracting the ME image to \"{}\"...",
+                                   options.extract_me)
+                        mef_copy = mef.save(options.extract_me,
+                                            me_end - me_start)
+                report.set(extracted_me=options.extract_me)
+
+                try:
+                    if not me6_ignition:
+                        report.say("Checking the FTPR RSA signature of the "
+                                   "extracted ME image... ", end="")
+                        report.set(signature=signature)
+                        result.extracted_signature_valid = \
+                            signature["extracted_me"] = False
+                        with report.phase("signature"):
+                            print_check_partition_signature(
+                                mef_copy, ftpr_offset + ftpr_mn2_offset,
+                                report)
+                        result.extracted_signature_valid = \
+                            signature["extracted_me"] = True
+                finally:
+                    mef_copy.close()
 
-    if me_start < me_end:
-        mef = RegionFile(f, me_start, me_end)
+            if not me6_ignition:
+                report.say("Checking the FTPR RSA signature... ", end="")
+                report.set(signature=signature)
+                result.signature_valid = signature["ftpr"] = False
+                with report.phase("signature"):
+                    print_check_partition_signature(
+                        mef, ftpr_offset + ftpr_mn2_offset, report)
+                result.signature_valid = signature["ftpr"] = True
 
-    if me_start > 0:
-        fdf = RegionFile(f, fd_start, fd_end)
+        if options.plan:
+            save_plan(f.plan, filename, options.plan, report)
 
-        if gen == 1:
-            for (ba, name) in ((fisba, "ICHSTRP0"), (fmsba, "MCHSTRP0")):
-                fdf.seek(ba)
-                strp = unpack("<I", fdf.read(4))[0]
-                print("The meDisable bit in " + name + " is ", end="")
-                if strp & 1:
-                    print("SET")
-                elif args.check:
-                    print("NOT SET")
-                else:
-                    print("NOT SET, setting it now...")
-                    fdf.write_to(ba, pack("<I", strp | 1))
-        elif gen == 2:
-            fdf.seek(fpsba + 0x28)
-            pchstrp10 = unpack("<I", fdf.read(4))[0]
-            print("The AltMeDisable bit is " +
-                  ("SET" if pchstrp10 & 1 << 7 else "NOT SET"))
+        if options.patch:
+            save_patch(f.plan, f.base, filename, options.patch, report)
+
+    finally:
+        f.close()
+
+    if not options.check:
+        report.say("Done! Good luck!")
+
+    return result
+
+
+def write_plan(plan, f, filename, target, sparse=False):
+    """Write the image resulting from plan on the input image f (opened from
+    filename) to target in one sequential pass, through a temporary file so
+    that target may also be filename. A symlink target is followed, and a
+    target with other hard links is rewritten in place once the image is
+    complete. If sparse is set, the 0xFF runs are left as holes, listed in
+    the map saved next to target, and the map is returned. Otherwise a stale
+    map of target is removed."""
+
+    holes = [] if sparse else None
+    real_target = os.path.realpath(target)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(real_target),
+                               prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            plan.stream(f, out, holes=holes)
+        shutil.copymode(filename, tmp)
+        if os.path.exists(real_target) and \
+           os.stat(real_target).st_nlink > 1:
+            clone_file(tmp, real_target)
+            os.unlink(tmp)
         else:
-            fdf.seek(fpsba)
-            pchstrp0 = unpack("<I", fdf.read(4))[0]
-            print("The HAP bit is " +
-                  ("SET" if pchstrp0 & 1 << 16 else "NOT SET"))
-
-        # Generation 1: wipe everything and disable the ME region
-        if gen == 1 and me_start < me_end and not args.check:
-            print("Disabling the ME region...")
-            f.seek(frba + 0x8)
-            f.write(pack("<I", 0x1fff))
-
-            print("Wiping the ME region...")
-            mef = RegionFile(f, me_start, me_end)
-            mef.fill_all("\xff")
-
-    # ME 6 Ignition: wipe everything
-    me6_ignition = False
-    if gen == 2 and not args.check and not args.soft_disable_only and \
-       variant == "ME" and version[0] == 6:
-        mef.seek(ftpr_offset + 0x20)
-        num_modules = unpack("<I", mef.read(4))[0]
-        mef.seek(ftpr_offset + 0x290 + (num_modules + 1) * 0x60)
-        data = mef.read(0xc)
-
-        if data[0x0:0x4] == b"$SKU" and data[0x8:0xc] == b"\x00\x00\x00\x00":
-            print("ME 6 Ignition firmware detected, removing everything...")
-            mef.fill_all(b"\xff")
-            me6_ignition = True
-
-    if gen != 1 and not args.check:
-        if not args.soft_disable_only and not me6_ignition:
-            print("Reading partitions list...")
-            unremovable_part_fpt = b""
-            extra_part_end = 0
-            whitelist = []
-            blacklist = []
-
-            whitelist += unremovable_partitions
-
-            if args.blacklist:
-                blacklist = args.blacklist.split(",")
-            elif args.whitelist:
-                whitelist += args.whitelist.split(",")
-
-            for i in range(entries):
-                partition = partitions[i * 0x20:(i + 1) * 0x20]
-                flags = unpack("<I", partition[0x1c:0x20])[0]
+            os.replace(tmp, real_target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    if sparse:
+        return write_sparse_map(target, plan.size, holes)
+    else:
+        remove_sparse_map(target)
 
-                try:
-                    part_name = \
-                        partition[0x0:0x4].rstrip(b"\x00").decode("ascii")
-                except UnicodeDecodeError:
-                    part_name = "????"
-
-                part_start, part_length = unpack("<II", partition[0x08:0x10])
-
-                # ME 6: the last partition has 0xffffffff as size
-                if variant == "ME" and version[0] == 6 and \
-                   i == entries - 1 and part_length == 0xffffffff:
-                    part_length = me_end - me_start - part_start
-
-                part_end = part_start + part_length
-
-                if flags & 0x7f == 2:
-                    print(" {:<4} ({:^24}, 0x{:08x} total bytes): nothing to "
-                          "remove"
-                          .format(part_name, "NVRAM partition, no data",
-                                  part_length))
-                elif part_start == 0 or part_length == 0 or part_end > me_end:
-                    print(" {:<4} ({:^24}, 0x{:08x} total bytes): nothing to "
-                          "remove"
-                          .format(part_name, "no data here", part_length))
-                else:
-                    print(" {:<4} (0x{:08x} - 0x{:09x}, 0x{:08x} total bytes): "
-                          .format(part_name, part_start, part_end, part_length),
-                          end="")
-                    if part_name in whitelist or (blacklist and
-                       part_name not in blacklist):
-                        unremovable_part_fpt += partition
-                        if part_name != "FTPR":
-                            extra_part_end = max(extra_part_end, part_end)
-                        print("NOT removed")
-                    else:
-                        mef.fill_range(part_start, part_end, b"\xff")
-                        print("removed")
 
-            print("Removing partition entries in FPT...")
-            mef.write_to(0x30, unremovable_part_fpt)
-            mef.write_to(0x14,
-                         pack("<I", len(unremovable_part_fpt) // 0x20))
+def write_sparse_map(filename, size, runs):
+    """Save the list of the (start, end) 0xFF runs missing from the sparse
+    image in filename, of the given size"""
+    sparse_map = {"size": size, "byte": 0xff,
+                  "runs": [list(run) for run in runs]}
+    map_file = filename + SPARSE_MAP_SUFFIX
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(map_file)),
+                               prefix=".tmp-")
+    with os.fdopen(fd, "w") as mf:
+        json.dump(sparse_map, mf)
+    shutil.copymode(filename, tmp)
+    os.replace(tmp, map_file)
+    return sparse_map
+
+
+def remove_sparse_map(filename):
+    try:
+        os.unlink(filename + SPARSE_MAP_SUFFIX)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def is_sparse(filename):
+    return os.path.exists(filename + SPARSE_MAP_SUFFIX)
+
+
+def open_sparse(filename, use_mmap=True):
+    """Open an image written with --sparse, returning a PlanFile where the
+    runs listed in its map read back as 0xFF, without expanding the file"""
+    map_file = filename + SPARSE_MAP_SUFFIX
+    with open(map_file) as mf:
+        sparse_map = json.load(mf)
+
+    f = PlanFile(open_image(filename, "rb", use_mmap))
+    if f.plan.size != sparse_map["size"]:
+        f.close()
+        raise MeCleanerError("The size of {} doesn't match its map {}"
+                             .format(filename, map_file))
+
+    for start, end in sparse_map["runs"]:
+        f.plan.fill(start, end, sparse_map["byte"])
+
+    return f
+
+
+def open_update(filename, use_mmap=True, report=None):
+    """Open an update image (a bare FTPR partition) as the ME region of its
+    layout, returning a PlanFile where the FPT header and the FTPR entry are
+    followed by the partition, at its offset in the factory region, and the
+    layout"""
+
+    if report is None:
+        report = Report()
+
+    f = PlanFile(open_image(filename, "rb", use_mmap))
+    try:
+        manifest = ManifestHeader.read(f, 0)
+        if manifest.tag != b"$MN2":
+            raise MeCleanerError("Can't find the FTPR manifest at the start "
+                                 "of the update image")
+
+        f.seek(0x80)
+        pubkey_md5 = hashlib.md5(f.read(0x104)).hexdigest()
+        version = ".".join(str(v) for v in manifest.version)
+        layout, pubkey_known = me_update.find_layout(manifest.version,
+                                                     pubkey_md5)
+        if layout is None:
+            raise MeCleanerError("No known layout for the update images of "
+                                 "version {}".format(version))
+        # An unknown public key is reported by parse_image()
+        report.say("Update image of version {}, building a region with the "
+                   "{} layout{}", version, layout.name,
+                   "" if pubkey_known else " (unknown public key)")
+
+        # The edits are recorded as any other, so that --plan and --patch
+        # apply to the update image
+        plan = f.plan
+        ftpr_length = min(layout.ftpr_length, plan.size)
+        ftpr_end = layout.orig_ftpr_offset + ftpr_length
+        plan.truncate(max(me_update.region_size(layout), plan.size))
+        plan.move(0, ftpr_length, layout.orig_ftpr_offset, 0xff)
+        plan.fill(0, layout.orig_ftpr_offset, 0xff)
+        plan.fill(ftpr_end, plan.size, 0xff)
+        plan.truncate(me_update.region_size(layout))
+        plan.write(0, me_update.fpt_header(layout))
+        plan.write(0x30, me_update.ftpr_entry(layout))
+    except BaseException:
+        f.close()
+        raise
+
+    return f, layout
+
 
-            mef.fill_range(0x30 + len(unremovable_part_fpt),
-                           0x30 + len(partitions), b"\xff")
+def open_carved(filename, offset=None, use_mmap=True, report=None):
+    """Search the file for an embedded ME/TXE image or full dump (the one at
+    offset, or the only one) and return a PlanFile where it has been moved
+    to the start of the file and the rest truncated"""
 
-            if (not blacklist and "EFFS" not in whitelist) or \
-               "EFFS" in blacklist:
-                print("Removing EFFS presence flag...")
-                mef.seek(0x24)
-                flags = unpack("<I", mef.read(4))[0]
-                flags &= ~(0x00000001)
-                mef.write_to(0x24, pack("<I", flags))
+    if report is None:
+        report = Report()
 
+    f = PlanFile(open_image(filename, "rb", use_mmap))
+    try:
+        with report.phase("carve"):
+            try:
+                if isinstance(f.base, MappedFile):
+                    buf = f.base.mm
+                    images, _ = me_carve.carve(buf, pubkeys_md5)
+                else:
+                    with me_carve.map_file(f.base) as buf:
+                        images, _ = me_carve.carve(buf, pubkeys_md5)
+                image = me_carve.choose_image(images, offset)
+            except (ValueError, EnvironmentError) as e:
+                raise MeCleanerError(str(e))
+
+        report.say("Found {} at {:#x} - {:#x}{}", "a full dump"
+                   if image.kind == "full dump" else "an ME/TXE image",
+                   image.start, image.end, ", truncated"
+                   if image.info["truncated"] else "")
+        report.set(carved={"kind": image.kind, "start": image.start,
+                           "end": image.end})
+
+        # The edits are recorded as any other, so that --plan and --patch
+        # apply to the whole file
+        size = image.end - image.start
+        if image.start > 0:
+            f.plan.move(image.start, size, 0, 0xff)
+        f.plan.truncate(size)
+    except BaseException:
+        f.close()
+        raise
+
+    return f
+
+
+def expand_sparse(filename, output=None, report=None):
+    """Write the full image of the sparse image in filename to output (or
+    replace filename with it)"""
+
+    if report is None:
+        report = Report()
+
+    report.set(file=filename, tool="me_cleaner " + __version__)
+
+    try:
+        with report.phase("total"):
+            if not is_sparse(filename):
+                raise MeCleanerError("{} has no map of 0xFF runs, it isn't a "
+                                     "sparse image".format(filename))
+
+            target = output or filename
+            report.say("Expanding the sparse image to \"{}\"...", target)
+            f = open_sparse(filename)
+            try:
+                with report.phase("write"):
+                    write_plan(f.plan, f.base, filename, target)
+            finally:
+                f.close()
+            report.set(output=target)
+    except MeCleanerError as e:
+        report.set(ok=False, error=str(e))
+        raise
+    except (EnvironmentError, ValueError, KeyError, TypeError) as e:
+        error = wrap_error(e, "The map of {} is not valid".format(filename))
+        report.set(ok=False, error=str(error))
+        raise error from e
+
+    report.set(ok=True, error=None)
+    report.say("Done! Good luck!")
+
+
+def save_plan(plan, filename, plan_file, report):
+    """Save the plan of the edits on filename to plan_file, as JSON, or print
+    it if plan_file is "-" """
+
+    document = {
+        "tool": "me_cleaner " + __version__,
+        "input": {"file": filename, "size": plan.input_size,
+                  "sha256": file_sha256(filename)},
+        "output_size": plan.size,
+        "edits": plan.edits,
+    }
+    report.set(plan=document)
+
+    if plan_file == "-":
+        report.say("Planned edits ({}):", len(plan.edits))
+        if report.text:
+            for edit in plan.edits:
+                report.say(" " + plan.format_edit(edit))
+    else:
+        report.say("Saving the plan ({} edits) to \"{}\"...",
+                   len(plan.edits), plan_file)
+        with open(plan_file, "w") as pf:
+            json.dump(document, pf, indent=1)
+
+
+def save_patch(plan, f, filename, patch_file, report):
+    """Save to patch_file, as JSON, the extents of the image resulting from
+    plan on the input image f (opened from filename), with the size and the
+    SHA-256 of the input and of the output image to check it when applied"""
+
+    with report.phase("patch"):
+        extents = plan.patch_extents(f)
+        document = {
+            "tool": "me_cleaner " + __version__,
+            "input": {"size": plan.input_size,
+                      "sha256": file_sha256(filename)},
+            "output": {"size": plan.size, "sha256": plan.sha256(f)},
+            "extents": extents,
+        }
+    data_size = sum(length for kind, length, _ in extents
+                    if kind == EditPlan.DATA)
+    report.set(patch={"file": patch_file, "extents": len(extents),
+                      "data_size": data_size, "output": document["output"]})
+
+    report.say("Saving the patch ({} extents, {:#x} bytes of data) to "
+               "\"{}\"...", len(extents), data_size, patch_file)
+    with open(patch_file, "w") as pf:
+        json.dump(document, pf, separators=(",", ":"))
+
+
+def load_patch(document, f, filename, patch_file):
+    """EditPlan of a patch saved by --patch, checked against the input image
+    f (opened from filename)"""
+    plan = EditPlan.from_patch_extents(document["input"]["size"],
+                                       document["extents"])
+    output = document["output"]
+    # A matching output is all that matters, the input is only hashed to
+    # explain a mismatch
+    if plan.size != output["size"] or plan.sha256(f) != output["sha256"]:
+        if file_sha256(filename) != document["input"]["sha256"]:
+            raise MeCleanerError("The patch in {} has been computed for a "
+                                 "different image".format(patch_file))
+        raise MeCleanerError("The patch in {} is corrupted"
+                             .format(patch_file))
+    return plan
+
+
+def apply_plan(filename, plan_file, output=None, report=None, sparse=False):
+    """Apply the edits saved by --plan, or the patch saved by --patch, in
+    plan_file to the image in filename, writing the result to output (or
+    replacing filename) in a single sequential pass, as a sparse image if
+    sparse is set"""
+
+    if report is None:
+        report = Report()
+
+    report.set(file=filename, tool="me_cleaner " + __version__)
+
+    try:
+        with report.phase("total"):
+            with open(plan_file) as pf:
+                document = json.load(pf)
+
+            target = output or filename
+            f = open_image(filename, "rb")
+            try:
+                if "extents" in document:
+                    with report.phase("verify"):
+                        plan = load_patch(document, f, filename, plan_file)
+                    report.say("Applying the patch ({} extents) to \"{}\"...",
+                               len(plan.extents), target)
+                else:
+                    if file_sha256(filename) != document["input"]["sha256"]:
+                        raise MeCleanerError("The plan in {} has been "
+                                             "computed for a different image"
+                                             .format(plan_file))
+
+                    plan = EditPlan(document["input"]["size"])
+                    for edit in document["edits"]:
+                        plan.apply(edit)
+                    report.say("Applying {} edits to \"{}\"...",
+                               len(plan.edits), target)
+                report.set(output=target, output_size=plan.size)
+
+                with report.phase("write"):
+                    write_plan(plan, f, filename, target, sparse)
+            finally:
+                f.close()
+    except MeCleanerError as e:
+        report.set(ok=False, error=str(e))
+        raise
+    except (EnvironmentError, ValueError, KeyError, TypeError) as e:
+        error = wrap_error(e, "{} is not a valid plan or patch"
+                           .format(plan_file))
+        report.set(ok=False, error=str(error))
+        raise error from e
+
+    report.set(ok=True, error=None)
+    report.say("Done! Good luck!")
+
+
+def clean_partitions(mef, image, options, report):
+    """Remove the partitions and the FTPR modules that are not needed, fix up
+    the FPT and return the minimum size of the ME region (or a value <= 0 if
+    it can't be computed). image.ftpr_offset is updated if the FTPR partition
+    gets relocated."""
+
+    gen = image.gen
+    me_start, me_end = image.me_start, image.me_end
+    variant, version = image.variant, image.version
+    entries = len(image.partitions)
+    fpt = {"offset": me_start + image.fpt_offset, "entries": []}
+    report.set(fpt=fpt)
+
+    report.say("Reading partitions list...")
+    unremovable_part_fpt = b""
+    extra_part_end = 0
+    whitelist = []
+    blacklist = []
+
+    whitelist += unremovable_partitions
+
+    if options.blacklist:
+        blacklist = options.blacklist.split(",")
+    elif options.whitelist:
+        whitelist += options.whitelist.split(",")
+
+    with report.phase("partitions"):
+        for i, partition in enumerate(image.partitions):
+            flags = partition.flags
+            part_name = partition.name
+            part_start, part_length = partition.offset, partition.length
+
+            # ME 6: the last partition has 0xffffffff as size
+            if variant == "ME" and version[0] == 6 and \
+               i == entries - 1 and part_length == 0xffffffff:
+                part_length = me_end - me_start - part_start
+
+            part_end = part_start + part_length
+            entry = {"name": part_name, "start": part_start, "end": part_end,
+                     "length": part_length, "flags": flags}
+            fpt["entries"].append(entry)
+
+            if flags & 0x7f == 2:
+                entry["action"] = "nothing to remove, NVRAM partition"
+                report.say(" {:<4} ({:^24}, 0x{:08x} total bytes): nothing "
+                           "to remove",
+                           part_name, "NVRAM partition, no data", part_length)
+            elif part_start == 0 or part_length == 0 or part_end > me_end:
+                entry["action"] = "nothing to remove, no data"
+                report.say(" {:<4} ({:^24}, 0x{:08x} total bytes): nothing "
+                           "to remove", part_name, "no data here", part_length)
+            else:
+                report.say(" {:<4} (0x{:08x} - 0x{:09x}, 0x{:08x} total "
+                           "bytes): ", part_name, part_start, part_end,
+                           part_length, end="")
+                if part_name in whitelist or (blacklist and
+                   part_name not in blacklist):
+                    unremovable_part_fpt += partition.raw
+                    if part_name != "FTPR":
+                        extra_part_end = max(extra_part_end, part_end)
+                    entry["action"] = "kept"
+                    report.say("NOT removed")
+                else:
+                    mef.fill_range(part_start, part_end, b"\xff")
+                    entry["action"] = "removed"
+                    report.say("removed")
+
+        report.say("Removing partition entries in FPT...")
+        mef.write_to(0x30, unremovable_part_fpt)
+        mef.write_to(0x14,
+                     pack("<I", len(unremovable_part_fpt) // 0x20))
+
+        mef.fill_range(0x30 + len(unremovable_part_fpt),
+                       0x30 + entries * 0x20, b"\xff")
+        fpt["kept_entries"] = len(unremovable_part_fpt) // 0x20
+
+        fpt["effs_flag_removed"] = \
+            (not blacklist and "EFFS" not in whitelist) or \
+            "EFFS" in blacklist
+        if fpt["effs_flag_removed"]:
+            report.say("Removing EFFS presence flag...")
+            flags = FptHeader.read(mef, 0x10).flags
+            flags &= ~(0x00000001)
+            mef.write_to(0x24, pack("<I", flags))
+
+        with report.phase("checksum"):
             if gen == 3:
                 mef.seek(0x10)
                 header = bytearray(mef.read(0x20))
@@ -836,126 +2333,543 @@ if __name__ == "__main__":
                 header = bytearray(mef.read(0x30))
                 header[0x1b] = 0x00
             checksum = (0x100 - sum(header) & 0xff) & 0xff
+            fpt["checksum"] = checksum
 
-            print("Correcting checksum (0x{:02x})...".format(checksum))
-            # The checksum is just the two's complement of the sum of the first
-            # 0x30 bytes in ME < 11 or bytes 0x10:0x30 in ME >= 11 (except for
-            # 0x1b, the checksum itself). In other words, the sum of those
-            # bytes must be always 0x00.
+            report.say("Correcting checksum (0x{:02x})...", checksum)
+            # The checksum is just the two's complement of the sum of the
+            # first 0x30 bytes in ME < 11 or bytes 0x10:0x30 in ME >= 11
+            # (except for 0x1b, the checksum itself). In other words, the sum
+            # of those bytes must be always 0x00.
             mef.write_to(0x1b, pack("B", checksum))
 
-            print("Reading FTPR modules list...")
-            if gen == 3:
-                end_addr, ftpr_offset = \
-                    check_and_remove_modules_gen3(mef, me_end,
-                                                  ftpr_offset, ftpr_length,
-                                                  min_ftpr_offset,
-                                                  args.relocate,
-                                                  args.keep_modules)
-            else:
-                end_addr, ftpr_offset = \
-                    check_and_remove_modules(mef, me_end, ftpr_offset,
-                                             min_ftpr_offset, args.relocate,
-                                             args.keep_modules)
-
-            if end_addr > 0:
-                end_addr = max(end_addr, extra_part_end)
-                end_addr = (end_addr // 0x1000 + 1) * 0x1000
-                end_addr += spared_blocks * 0x1000
-
-                print("The ME minimum size should be {0} bytes "
-                      "({0:#x} bytes)".format(end_addr))
-
-                if me_start > 0:
-                    print("The ME region can be reduced up to:\n"
-                          " {:08x}:{:08x} me"
-                          .format(me_start, me_start + end_addr - 1))
-                elif args.truncate:
-                    print("Truncating file at {:#x}...".format(end_addr))
-                    f.truncate(end_addr)
-
-        if args.soft_disable or args.soft_disable_only:
-            if gen == 3:
-                print("Setting the HAP bit in PCHSTRP0 to disable Intel ME...")
-                pchstrp0 |= (1 << 16)
-                fdf.write_to(fpsba, pack("<I", pchstrp0))
-            else:
-                print("Setting the AltMeDisable bit in PCHSTRP10 to disable "
-                      "Intel ME...")
-                pchstrp10 |= (1 << 7)
-                fdf.write_to(fpsba + 0x28, pack("<I", pchstrp10))
+    report.say("Reading FTPR modules list...")
+    report.set(modules=[])
+    if image.layout is not None:
+        min_offset = image.layout.minified_ftpr_offset
+    else:
+        min_offset = min_ftpr_offset
 
-    if args.descriptor:
-        print("Removing ME/TXE R/W access to the other flash regions...")
+    with report.phase("modules"):
         if gen == 3:
-            flmstr2 = 0x00400500
+            end_addr, image.ftpr_offset = \
+                check_and_remove_modules_gen3(mef, image, me_end, min_offset,
+                                              options.relocate,
+                                              options.keep_modules, report)
         else:
-            fdf.seek(fmba + 0x4)
-            flmstr2 = (unpack("<I", fdf.read(4))[0] | 0x04040000) & 0x0404ffff
-
-        fdf.write_to(fmba + 0x4, pack("<I", flmstr2))
-
-    if args.extract_descriptor:
-        if args.truncate:
-            print("Extracting the descriptor to \"{}\"..."
-                  .format(args.extract_descriptor))
-            fdf_copy = fdf.save(args.extract_descriptor, fd_end - fd_start)
-
-            if bios_start == me_end:
-                print("Modifying the regions of the extracted descriptor...")
-                print(" {:08x}:{:08x} me   --> {:08x}:{:08x} me"
-                      .format(me_start, me_end - 1,
-                              me_start, me_start + end_addr - 1))
-                print(" {:08x}:{:08x} bios --> {:08x}:{:08x} bios"
-                      .format(bios_start, bios_end - 1,
-                              me_start + end_addr, bios_end - 1))
-
-                flreg1 = start_end_to_flreg(me_start + end_addr, bios_end)
-                if gen != 1:
-                    flreg2 = start_end_to_flreg(me_start, me_start + end_addr)
-
-                fdf_copy.seek(frba + 0x4)
-                fdf_copy.write(pack("<I", flreg1))
-                if gen != 1:
-                    fdf_copy.write(pack("<I", flreg2))
-            else:
-                print("\nWARNING:\n"
-                      "The start address of the BIOS region (0x{:08x}) isn't "
-                      "equal to the end address\nof the ME region (0x{:08x}): "
-                      "if you want to recover the space from the ME \nregion "
-                      "you have to manually modify the descriptor.\n"
-                      .format(bios_start, me_end))
+            end_addr, image.ftpr_offset = \
+                check_and_remove_modules(mef, image, me_end, min_offset,
+                                         options.relocate,
+                                         options.keep_modules, report)
+
+    if end_addr > 0:
+        end_addr = max(end_addr, extra_part_end)
+        end_addr = (end_addr // 0x1000 + 1) * 0x1000
+        end_addr += spared_blocks * 0x1000
+
+    return end_addr
+
+
+def extract_descriptor(fdf, image, options, end_addr, report):
+    me_start, me_end = image.me_start, image.me_end
+    bios_start, bios_end = image.bios_start, image.bios_end
+    frba = image.frba
+
+    report.set(extracted_descriptor=options.extract_descriptor)
+
+    if options.truncate:
+        report.say("Extracting the descriptor to \"{}\"...",
+                   options.extract_descriptor)
+        fdf_copy = fdf.save(options.extract_descriptor,
+                            image.fd_end - image.fd_start)
+
+        if bios_start == me_end:
+            report.set(extracted_descriptor_regions={
+                "me": [me_start, me_start + end_addr],
+                "bios": [me_start + end_addr, bios_end]})
+            report.say("Modifying the regions of the extracted descriptor...")
+            report.say(" {:08x}:{:08x} me   --> {:08x}:{:08x} me",
+                       me_start, me_end - 1, me_start, me_start + end_addr - 1)
+            report.say(" {:08x}:{:08x} bios --> {:08x}:{:08x} bios",
+                       bios_start, bios_end - 1, me_start + end_addr,
+                       bios_end - 1)
+
+            flreg1 = start_end_to_flreg(me_start + end_addr, bios_end)
+            if image.gen != 1:
+                flreg2 = start_end_to_flreg(me_start, me_start + end_addr)
+
+            fdf_copy.seek(frba + 0x4)
+            fdf_copy.write(pack("<I", flreg1))
+            if image.gen != 1:
+                fdf_copy.write(pack("<I", flreg2))
         else:
-            print("Extracting the descriptor to \"{}\"..."
-                  .format(args.extract_descriptor))
-            fdf_copy = fdf.save(args.extract_descriptor, fd_end - fd_start)
-
-        fdf_copy.close()
-
-    if gen != 1:
-        if args.extract_me:
-            if args.truncate:
-                print("Extracting and truncating the ME image to \"{}\"..."
-                      .format(args.extract_me))
-                mef_copy = mef.save(args.extract_me, end_addr)
-            else:
-                print("Extracting the ME image to \"{}\"..."
-                      .format(args.extract_me))
-                mef_copy = mef.save(args.extract_me, me_end - me_start)
+            report.warn("\nWARNING:\n"
+                        "The start address of the BIOS region (0x{:08x}) "
+                        "isn't equal to the end address\nof the ME region "
+                        "(0x{:08x}): if you want to recover the space from "
+                        "the ME \nregion you have to manually modify the "
+                        "descriptor.\n", bios_start, me_end)
+    else:
+        report.say("Extracting the descriptor to \"{}\"...",
+                   options.extract_descriptor)
+        fdf_copy = fdf.save(options.extract_descriptor,
+                            image.fd_end - image.fd_start)
+
+    fdf_copy.close()
+
+
+class BatchResult:
+    """Outcome of the processing of one image in a batch"""
+
+    def __init__(self, filename, output=None):
+        self.filename = filename
+        self.output = output
+        self.ok = False
+        self.error = None
+        self.min_size = None
+        self.signature_valid = None
+        self.log = ""
+        self.report = None
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    @classmethod
+    def failed(cls, filename, error):
+        """Result of a job rejected before running"""
+        result = cls(filename)
+        result.error = error
+        result.report = {"file": filename, "ok": False, "error": error}
+        return result
+
+
+def clean_isolated(filename, options):
+    """Run clean() capturing its console output and turning any error into a
+    failed BatchResult, so that a bad image can't stop a batch"""
+
+    result = BatchResult(filename, options.output)
+    log = io.StringIO()
+    report = Report(text=not options.json)
+    wall_start, cpu_start = time.time(), time.process_time()
+
+    try:
+        with contextlib.redirect_stdout(log):
+            clean_result = clean(filename, options, report)
+        result.ok = True
+        result.min_size = clean_result.min_size
+        result.signature_valid = clean_result.signature_valid
+    except MeCleanerError as e:
+        result.error = str(e)
+    except Exception as e:
+        result.error = "{}: {}".format(type(e).__name__, e)
+        report.set(ok=False, error=result.error)
+
+    result.wall_time = time.time() - wall_start
+    result.cpu_time = time.process_time() - cpu_start
+    result.log = log.getvalue()
+    result.report = report.data
+
+    return result
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def run_batch(jobs, workers=None, on_result=None):
+    """Clean many images in parallel on a pool of worker processes.
+
+    jobs is a list of (filename, CleanOptions) pairs; the BatchResults are
+    returned in the same order, and on_result (if given) is called with each
+    of them as soon as it is ready. If a worker process dies, the images it
+    may have been working on are retried one per process, so that only the
+    image that actually kills its worker is reported as failed."""
+
+    results = [None] * len(jobs)
+    workers = min(workers or available_cpus(), max(len(jobs), 1))
+    retry = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(clean_isolated, *job): i
+                   for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                retry.append(i)
+                continue
+            if on_result:
+                on_result(results[i])
+
+    for i in sorted(retry):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                results[i] = executor.submit(clean_isolated, *jobs[i]).result()
+            except BrokenProcessPool:
+                results[i] = BatchResult(jobs[i][0], jobs[i][1].output)
+                results[i].error = "the worker process died"
+        if on_result:
+            on_result(results[i])
+
+    return results
+
+
+def print_batch_summary(results, wall_time):
+    failed = sum(1 for r in results if not r.ok)
+
+    print("\nBatch summary: {} image(s), {} OK, {} failed, {:.2f} s"
+          .format(len(results), len(results) - failed, failed, wall_time))
+    print(" {:>4}  {:<6}  {:>9}  {:<9}  {:>8}  {:>8}  {}"
+          .format("#", "Result", "Min. size", "Signature", "Wall (s)",
+                  "CPU (s)", "Image"))
+
+    for i, r in enumerate(results):
+        if r.signature_valid is None:
+            signature = "-"
+        else:
+            signature = "VALID" if r.signature_valid else "INVALID"
+        print(" {:>4}  {:<6}  {:>9}  {:<9}  {:>8.3f}  {:>8.3f}  {}{}"
+              .format(i + 1, "OK" if r.ok else "FAILED",
+                      "-" if r.min_size is None else
+                      "{:#x}".format(r.min_size), signature, r.wall_time,
+                      r.cpu_time, r.filename,
+                      "" if r.ok else ": " + r.error))
+
+
+def report_profile(profiler, args, report):
+    report.set(profile=profiler.to_dict())
+    report.say()
+    for line in profiler.format_table():
+        report.say(line)
+    if args.profile_stats:
+        profiler.save_stats(args.profile_stats)
+        report.say("Python profile saved to \"{}\"", args.profile_stats)
+    if args.profile_trace:
+        profiler.save_trace(args.profile_trace)
+        report.say("Trace of the phases saved to \"{}\"", args.profile_trace)
+
+
+def print_json(document):
+    json.dump(document, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+def parse_manifest_line(parser, line):
+    """Parse the arguments of a line of the manifest, raising ValueError
+    instead of exiting if they are not valid"""
+
+    def error(message):
+        raise ValueError(message)
+
+    line_args = shlex.split(line, comments=True)
+    if not line_args:
+        return None
+    parser.error = error
+    try:
+        job_args = parser.parse_args(line_args)
+    finally:
+        del parser.error
+    if job_args.batch or job_args.manifest or len(job_args.file) != 1:
+        raise ValueError("each line of the manifest must contain the "
+                         "arguments of a single image")
+    return job_args
+
+
+def written_paths(filename, options):
+    """The files a job writes, resolved"""
+    paths = [] if options.check else [options.output or filename]
+    paths += [p for p in (options.extract_descriptor, options.extract_me)
+              if p]
+    return [os.path.realpath(p) for p in paths]
+
+
+def batch_jobs(parser, args):
+    """Build the (filename, CleanOptions) pairs of a batch run: one per line
+    of the manifest, and one per image given on the command line, with -O,
+    -D and -M naming directories. A manifest line that can't be parsed, or a
+    job writing a file already written by a previous job (an image listed
+    twice for in-place cleaning...), is a failed BatchResult instead."""
+
+    jobs = []
+
+    if args.manifest:
+        with open(args.manifest) as manifest:
+            for number, line in enumerate(manifest, 1):
+                try:
+                    job_args = parse_manifest_line(parser, line)
+                except ValueError as e:
+                    jobs.append(BatchResult.failed(
+                        "{}:{}".format(args.manifest, number), str(e)))
+                    continue
+                if job_args is not None:
+                    jobs.append((job_args.file[0],
+                                 CleanOptions.from_args(job_args)))
+
+    if args.file:
+        options = CleanOptions.from_args(args)
+        try:
+            options.validate()
+        except MeCleanerError as e:
+            parser.error(str(e))
+
+        dirs = [d for d in (options.output, options.extract_descriptor,
+                            options.extract_me) if d]
+        if len(set(os.path.abspath(d) for d in dirs)) != len(dirs):
+            parser.error("-O, -D and -M must name different directories in "
+                         "batch mode")
+        for d in dirs:
+            if not os.path.isdir(d):
+                parser.error("{} is not a directory".format(d))
+
+        names = [os.path.basename(f) for f in args.file]
+        if dirs and len(set(names)) != len(names):
+            parser.error("the images of a batch with -O, -D or -M must have "
+                         "different file names")
+
+        for filename, name in zip(args.file, names):
+            job_options = copy.copy(options)
+            for attr in ("output", "extract_descriptor", "extract_me"):
+                if getattr(options, attr):
+                    setattr(job_options, attr,
+                            os.path.join(getattr(options, attr), name))
+            jobs.append((filename, job_options))
+
+    # Two workers writing the same file would race
+    writers = {}
+    for i, job in enumerate(jobs):
+        if isinstance(job, BatchResult):
+            continue
+        for path in written_paths(*job):
+            if path in writers:
+                jobs[i] = BatchResult.failed(
+                    job[0], "{} is also written by job #{}"
+                    .format(path, writers[path] + 1))
+                break
+        else:
+            for path in written_paths(*job):
+                writers[path] = i
+
+    return jobs
+
+
+def batch_main(parser, args):
+    jobs = batch_jobs(parser, args)
+    if not jobs:
+        parser.error("no image to process")
+
+    def print_result(result):
+        print("### {}: {}".format(result.filename,
+                                  "OK" if result.ok else "FAILED"))
+        print(result.log, end="")
+        if not result.ok:
+            print("ERROR: {}".format(result.error))
+        sys.stdout.flush()
+
+    wall_start = time.time()
+    results = list(jobs)
+    rejected = [r for r in jobs if isinstance(r, BatchResult)]
+    if not args.json:
+        for result in rejected:
+            print_result(result)
+    indexes = [i for i, job in enumerate(jobs)
+               if not isinstance(job, BatchResult)]
+    for i, result in zip(indexes, run_batch(
+            [jobs[i] for i in indexes], args.jobs,
+            None if args.json else print_result)):
+        results[i] = result
+    wall_time = time.time() - wall_start
+
+    if args.json:
+        for r in results:
+            r.report.update(wall_time=r.wall_time, cpu_time=r.cpu_time)
+        print_json({"images": [r.report for r in results],
+                    "ok": all(r.ok for r in results),
+                    "wall_time": wall_time})
+    else:
+        print_batch_summary(results, wall_time)
 
-            if not me6_ignition:
-                print("Checking the FTPR RSA signature of the extracted ME "
-                      "image... ", end="")
-                print_check_partition_signature(mef_copy,
-                                                ftpr_offset + ftpr_mn2_offset)
-            mef_copy.close()
+    return 0 if all(r.ok for r in results) else 1
 
-        if not me6_ignition:
-            print("Checking the FTPR RSA signature... ", end="")
-            print_check_partition_signature(mef, ftpr_offset + ftpr_mn2_offset)
 
-    f.close()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tool to remove as much code "
+                                     "as possible from Intel ME/TXE firmware "
+                                     "images")
+    softdis = parser.add_mutually_exclusive_group()
+    bw_list = parser.add_mutually_exclusive_group()
 
-    if not args.check:
-        print("Done! Good luck!")
+    parser.add_argument("-v", "--version", action="version",
+                        version="%(prog)s " + __version__)
 
+    parser.add_argument("file", nargs="*", help="ME/TXE image or full dump "
+                        "(any number of them with --batch)")
+    parser.add_argument("-O", "--output", metavar='output_file', help="save "
+                        "the modified image in a separate file, instead of "
+                        "modifying the original file")
+    softdis.add_argument("-S", "--soft-disable", help="in addition to the "
+                         "usual operations on the ME/TXE firmware, set the "
+                         "MeAltDisable bit or the HAP bit to ask Intel ME/TXE "
+                         "to disable itself after the hardware initialization "
+                         "(requires a full dump)", action="store_true")
+    softdis.add_argument("-s", "--soft-disable-only", help="instead of the "
+                         "usual operations on the ME/TXE firmware, just set "
+                         "the MeAltDisable bit or the HAP bit to ask Intel "
+                         "ME/TXE to disable itself after the hardware "
+                         "initialization (requires a full dump)",
+                         action="store_true")
+    parser.add_argument("-r", "--relocate", help="relocate the FTPR partition "
+                        "to the top of the ME region to save even more space",
+                        action="store_true")
+    parser.add_argument("-t", "--truncate", help="truncate the empty part of "
+                        "the firmware (requires a separated ME/TXE image or "
+                        "--extract-me)", action="store_true")
+    parser.add_argument("-k", "--keep-modules", help="don't remove the FTPR "
+                        "modules, even when possible", action="store_true")
+    bw_list.add_argument("-w", "--whitelist", metavar="whitelist",
+                         help="Comma separated list of additional partitions "
+                         "to keep in the final image. This can be used to "
+                         "specify the MFS partition for example, which stores "
+                         "PCIe and clock settings.")
+    bw_list.add_argument("-b", "--blacklist", metavar="blacklist",
+                         help="Comma separated list of partitions to remove "
+                         "from the image. This option overrides the default "
+                         "removal list.")
+    parser.add_argument("-d", "--descriptor", help="remove the ME/TXE "
+                        "Read/Write permissions to the other regions on the "
+                        "flash from the Intel Flash Descriptor (requires a "
+                        "full dump)", action="store_true")
+    parser.add_argument("-D", "--extract-descriptor",
+                        metavar='output_descriptor', help="extract the flash "
+                        "descriptor from a full dump; when used with "
+                        "--truncate save a descriptor with adjusted regions "
+                        "start and end")
+    parser.add_argument("-M", "--extract-me", metavar='output_me_image',
+                        help="extract the ME firmware from a full dump; when "
+                        "used with --truncate save a truncated ME/TXE image")
+    parser.add_argument("-u", "--from-update", help="the image is an "
+                        "update image, holding only the FTPR partition: "
+                        "build an ME region from it, with the FPT header and "
+                        "the FTPR entry of its layout, and clean it (the "
+                        "result is written to the output file, or replaces "
+                        "the update image)", action="store_true")
+    parser.add_argument("--carve", help="the image is embedded somewhere in "
+                        "the file (an installer or an update capsule): find "
+                        "it and process it alone (the result is written to "
+                        "the output file, or replaces the file)",
+                        action="store_true")
+    parser.add_argument("--carve-offset", metavar="offset",
+                        type=lambda x: int(x, 0), help="with --carve, the "
+                        "offset of the image to process when the file holds "
+                        "several (as listed by me_carve.py)")
+    parser.add_argument("-c", "--check", help="verify the integrity of the "
+                        "fundamental parts of the firmware and exit",
+                        action="store_true")
+    parser.add_argument("--no-mmap", help="access the image with plain file "
+                        "reads and writes instead of mapping it in memory",
+                        action="store_true")
+    parser.add_argument("--batch", help="process all the given images in "
+                        "parallel with the same options; -O, -D and -M name "
+                        "directories where the files are saved with the name "
+                        "of the input image. A summary is printed at the end",
+                        action="store_true")
+    parser.add_argument("--manifest", metavar="manifest", help="batch mode: "
+                        "read a file where each line holds the arguments of "
+                        "one image to process (options and input file, as "
+                        "on the command line)")
+    parser.add_argument("-j", "--jobs", metavar="jobs", type=int,
+                        help="number of worker processes in batch mode "
+                        "(default: one per available CPU)")
+    parser.add_argument("--json", help="instead of the usual messages, print "
+                        "a JSON report of the regions, partitions and modules "
+                        "found, of what has been done to them and of the "
+                        "time spent", action="store_true")
+    parser.add_argument("--plan", metavar="plan_file", help="don't modify "
+                        "anything, just compute the edits to the image and "
+                        "save them in plan_file (or print them, if plan_file "
+                        "is -)")
+    parser.add_argument("--patch", metavar="patch_file", help="don't modify "
+                        "anything, save to patch_file a patch that turns the "
+                        "image into the cleaned one: the copies, fills and "
+                        "data of the cleaned image, with the SHA-256 of both "
+                        "images")
+    parser.add_argument("--apply", metavar="plan_file", help="apply the edits "
+                        "saved by --plan, or the patch saved by --patch, to "
+                        "the image (or to a copy, with -O) in a single pass")
+    parser.add_argument("--cache", metavar="cache_dir", help="keep the files "
+                        "produced in cache_dir, and restore them from there "
+                        "instead of processing again an image already seen "
+                        "with the same options")
+    parser.add_argument("--cache-size", metavar="MiB", type=int,
+                        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help="maximum size of the cache; the least recently "
+                        "used results are removed first (default: "
+                        "%(default)s MiB)")
+    parser.add_argument("--sparse", help="don't write the runs of 0xFF left "
+                        "by the removed partitions and modules: they are "
+                        "left as holes in the image and listed in "
+                        "a map saved next to it (" + SPARSE_MAP_SUFFIX +
+                        "), which me_cleaner reads back as 0xFF. Other tools "
+                        "need the image to be expanded first",
+                        action="store_true")
+    parser.add_argument("--expand", help="write the full image of an image "
+                        "saved with --sparse (to a copy, with -O)",
+                        action="store_true")
+    parser.add_argument("--profile", help="print the wall and CPU time, the "
+                        "bytes read and written, the system calls and the "
+                        "page faults of each phase (or add them to the JSON "
+                        "report, with --json)", action="store_true")
+    parser.add_argument("--profile-stats", metavar="stats_file",
+                        help="profile the Python functions too, and save the "
+                        "statistics to stats_file, to be read with pstats "
+                        "(implies --profile)")
+    parser.add_argument("--profile-trace", metavar="trace_file",
+                        help="save the phases to trace_file in the Chrome "
+                        "trace format, for chrome://tracing or Perfetto "
+                        "(implies --profile)")
+
+    args = parser.parse_args(argv)
+
+    if args.batch or args.manifest:
+        if args.plan or args.patch or args.apply or args.expand or \
+           args.profile or args.profile_stats or args.profile_trace:
+            parser.error("--plan, --patch, --apply, --expand and --profile "
+                         "can't be used in batch mode")
+        sys.exit(batch_main(parser, args))
+
+    if len(args.file) != 1:
+        parser.error("exactly one image is required (use --batch for more)")
+
+    options = CleanOptions.from_args(args)
+    report = Report(text=not options.json)
+
+    profiler = None
+    if args.profile or args.profile_stats or args.profile_trace:
+        profiler = Profiler(python_profile=bool(args.profile_stats))
+        report.add_hook(profiler)
+
+    try:
+        with profiler or contextlib.suppress():
+            if args.apply:
+                apply_plan(args.file[0], args.apply, options.output, report,
+                           options.sparse)
+            elif args.expand:
+                expand_sparse(args.file[0], options.output, report)
+            else:
+                clean(args.file[0], options, report)
+    except MeCleanerError as e:
+        if not options.json:
+            sys.exit(str(e))
+    finally:
+        if profiler:
+            report_profile(profiler, args, report)
+
+    if options.json:
+        print_json(report.data)
+        if not report.data["ok"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# me_hashes - Verification of the blobs against their SHA-256 hashes
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# The digests of the files are kept in a JSON cache, under the absolute path
+# of each file along with its inode, size and modification time: a file
+# whose stat() still gives the same values is not hashed again. A file
+# modified less than RACY_WINDOW seconds before it was hashed could change
+# again without its modification time changing, so its digest is not cached.
+# The files to hash are read through memory maps, in parallel threads
+# (hashlib releases the GIL while hashing).
+#
+# The expected hashes are read from the hashes.txt manifests of the board
+# directories ("<sha256>  <file>" lines, relative to the manifest, and
+# comments starting with #) or given as "<sha256> <path>" pairs, as taken by
+# check_outputs in blobs/lib.sh, which calls this tool.
+
+from __future__ import division, print_function
+
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from me_cache import file_sha256
+
+BLOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                         "..")
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache",
+                             "heads-blobs", "hashes.json")
+
+RACY_WINDOW = 2
+
+DEFAULT_WORKERS = 8
+
+MANIFEST_LINE = re.compile(r"^([0-9a-fA-F]{64})\s+\*?(.+?)\s*$")
+
+
+class HashCache:
+    """Digests of files by (path, inode, size, mtime_ns), saved as JSON in
+    filename (kept in memory only if it's None)"""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self.modified = False
+        if filename:
+            try:
+                with open(filename) as f:
+                    self.entries = json.load(f)
+            except (EnvironmentError, ValueError):
+                pass
+
+    @staticmethod
+    def stat_key(st):
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def get(self, path, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == self.stat_key(st):
+            return entry[3]
+        return None
+
+    def put(self, path, st, digest, hash_time):
+        if hash_time - st.st_mtime_ns / 1e9 < RACY_WINDOW:
+            return
+        self.entries[path] = self.stat_key(st) + [digest]
+        self.modified = True
+
+    def save(self):
+        """Save the cache, without the entries of the files which no longer
+        exist"""
+        if not self.filename or not self.modified:
+            return
+        entries = {path: entry for path, entry in self.entries.items()
+                   if os.path.exists(path)}
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.filename)
+        self.modified = False
+
+
+def default_cache():
+    return os.environ.get("HEADS_HASH_CACHE", DEFAULT_CACHE)
+
+
+def hash_files(paths, cache=None, workers=DEFAULT_WORKERS):
+    """Return the SHA-256 of the files, by path, None for those that are
+    missing"""
+
+    if cache is None:
+        cache = HashCache()
+    digests = {}
+    todo = []
+
+    for path in paths:
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            digests[path] = None
+            continue
+        digest = cache.get(path, st)
+        if digest is None:
+            todo.append((path, st))
+        digests[path] = digest
+
+    def hash_file(item):
+        path, st = item
+        return path, st, file_sha256(path), time.time()
+
+    if todo:
+        with ThreadPoolExecutor(max_workers=min(workers, len(todo))) as pool:
+            for path, st, digest, hash_time in pool.map(hash_file, todo):
+                digests[path] = digest
+                cache.put(path, st, digest, hash_time)
+
+    return digests
+
+
+def read_manifest(filename):
+    """The (sha256, path) pairs of a hashes.txt manifest, with the paths
+    relative to its directory"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    pairs = []
+    with open(filename) as f:
+        for line in f:
+            match = MANIFEST_LINE.match(line)
+            if match:
+                pairs.append((match.group(1).lower(),
+                              os.path.join(directory, match.group(2))))
+    return pairs
+
+
+def parse_pair(pair):
+    """A "<sha256> <path>" pair, as taken by check_outputs"""
+    try:
+        digest, path = pair.split(None, 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("\"{}\" is not a \"<sha256> <path>\" "
+                                         "pair".format(pair))
+    return digest.lower(), path.strip()
+
+
+def check(pairs, cache=None, workers=DEFAULT_WORKERS):
+    """Check the files of the (sha256, path) pairs; return their statuses,
+    OK, MISSING or HASH MISMATCH, in the same order"""
+    digests = hash_files([path for _, path in pairs], cache, workers)
+    statuses = []
+    for expected, path in pairs:
+        digest = digests[os.path.abspath(path)]
+        if digest is None:
+            statuses.append("MISSING")
+        elif digest == expected:
+            statuses.append("OK")
+        else:
+            statuses.append("HASH MISMATCH")
+    return statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check blobs against their "
+                                     "SHA-256 hashes, reusing the hashes of "
+                                     "the files that didn't change")
+    parser.add_argument("manifests", nargs="*", metavar="hashes.txt",
+                        help="manifests to check (default: those of all the "
+                        "boards, if no pair is given)")
+    parser.add_argument("-p", "--pair", metavar="\"sha256 path\"",
+                        action="append", default=[], type=parse_pair,
+                        help="check path against sha256 (repeatable)")
+    parser.add_argument("-c", "--cache", metavar="cache_file",
+                        default=default_cache(),
+                        help="cache of the hashes (default: "
+                        "$HEADS_HASH_CACHE or %(default)s)")
+    parser.add_argument("--no-cache", help="hash every file",
+                        action="store_true")
+    parser.add_argument("-j", "--jobs", metavar="jobs", type=int,
+                        default=DEFAULT_WORKERS, help="files hashed at the "
+                        "same time (default: %(default)s)")
+    parser.add_argument("-q", "--quiet", help="only print the files that "
+                        "don't match", action="store_true")
+    args = parser.parse_args(argv)
+
+    manifests = args.manifests
+    if not manifests and not args.pair:
+        manifests = sorted(glob.glob(os.path.join(BLOBS_DIR, "*",
+                                                  "hashes.txt")))
+
+    pairs = list(args.pair)
+    for manifest in manifests:
+        try:
+            pairs += read_manifest(manifest)
+        except EnvironmentError as e:
+            sys.exit("Can't read {}: {}".format(manifest, e))
+
+    cache = HashCache(None if args.no_cache else args.cache)
+    statuses = check(pairs, cache, args.jobs)
+    try:
+        cache.save()
+    except EnvironmentError as e:
+        print("WARNING: can't save the hash cache: {}".format(e),
+              file=sys.stderr)
+
+    for (_, path), status in zip(pairs, statuses):
+        if status != "OK" or not args.quiet:
+            print("CHECKING: {}... {}".format(path, status))
+
+    if any(status != "OK" for status in statuses):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
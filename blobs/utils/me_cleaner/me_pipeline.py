@@ -0,0 +1,708 @@
+#!/usr/bin/env python
+
+# me_pipeline - Parallel regeneration of the ME/TXE blobs of the boards
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# The download scripts of the boards (blobs/*/download_*.sh) as one graph of
+# stages: fetch, extract, clean, deguard, pad. A stage runs as soon as the
+# stages it depends on are done, on a pool of threads; a stage shared by
+# several boards (the Dell ME of the T480 and T480s) runs once.
+#
+# The output of each stage is an artifact named by its SHA-256, kept in a
+# store (an OutputCache) under the key of the stage: its kind, the identity
+# of the tool, its parameters and the digests of its inputs. A stage whose
+# key is in the store is not run again. The stages running in this process
+# (me_cleaner, unzip, pad) get their inputs from memory or straight from the
+# store; the external tools (innoextract, Dell_PFS_Extract, deguard) work in
+# a scratch directory of the store, from which their output is moved in.
+#
+# The vendor files are taken from a mirror directory, by file name, and
+# checked against their known hashes; with --download, the missing ones are
+# downloaded into the mirror first. The git repositories of the tools are
+# cloned from the mirror too, when it holds a clone of them.
+
+from __future__ import division, print_function
+
+import argparse
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+import me_cleaner
+import me_hashes
+from me_cache import OutputCache, clone_file, tool_id
+
+BLOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                         "..")
+
+DEFAULT_STORE = os.path.join(os.path.expanduser("~"), ".cache",
+                             "heads-blobs")
+DEFAULT_STORE_SIZE = 4 * 1024 * 1024 * 1024
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; rv:91.0) Gecko/20100101 " \
+             "Firefox/91.0"
+
+BIOSUTILITIES = ("https://github.com/platomav/BIOSUtilities",
+                 "ef50b75ae115ae8162fa8b0a7b8c42b1d2db894b")
+DEGUARD = ("https://github.com/coreboot/deguard",
+           "0ed3e4ff824fc42f71ee22907d0594ded38ba7b2")
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Artifact:
+    """Output of a stage, named by its SHA-256. data is set when it was
+    produced in this process, path when it is a file (in the store or in the
+    mirror)."""
+
+    def __init__(self, digest, size, data=None, path=None):
+        self.digest = digest
+        self.size = size
+        self.data = data
+        self.path = path
+
+    def read(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+# name: unique name of the stage, used for its dependencies and in the log
+# kind: key of STAGE_KINDS
+# inputs: names of the stages whose artifacts are the inputs
+# params: JSON serializable parameters, part of the key of the stage
+# sha256: expected digest of the artifact, if known
+Stage = namedtuple("Stage", "name kind inputs params sha256")
+
+# run(ctx, stage, inputs, scratch): return the output as bytes, as the path
+#     of a file in the scratch directory or as an Artifact
+# tool(ctx, stage): identity of the tool, part of the key of the stage, or
+#     None for the stages which are never stored
+StageKind = namedtuple("StageKind", "run tool")
+
+
+def stage(name, kind, inputs=(), sha256=None, **params):
+    return Stage(name, kind, tuple(inputs), params, sha256)
+
+
+class Pipeline:
+    """The stages of a set of boards, by name"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, new_stage):
+        """Add a stage and return its name; a board can add a stage already
+        added by another one, as long as it is the same"""
+        old = self.stages.setdefault(new_stage.name, new_stage)
+        if old != new_stage:
+            raise ValueError("Conflicting definitions of stage \"{}\""
+                             .format(new_stage.name))
+        for name in new_stage.inputs:
+            if name not in self.stages:
+                raise ValueError("Unknown input \"{}\" of stage \"{}\""
+                                 .format(name, new_stage.name))
+        return new_stage.name
+
+    def closure(self, names):
+        """The given stages and all the stages they depend on"""
+        needed = set()
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].inputs)
+        return needed
+
+
+class PipelineContext:
+    """What the stages share: the store, the mirror and the log"""
+
+    def __init__(self, store_dir, mirror_dir, download=False,
+                 store_size=DEFAULT_STORE_SIZE, verbose=False,
+                 hash_cache=None):
+        self.store = OutputCache(store_dir, store_size)
+        # The hashes of the mirror files and of the outputs
+        self.hashes = me_hashes.HashCache(hash_cache)
+        self.scratch_dir = os.path.join(store_dir, "tmp")
+        self.tools_dir = os.path.join(store_dir, "tools")
+        for d in (self.scratch_dir, self.tools_dir):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        self.mirror_dir = mirror_dir
+        self.download = download
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self._path_locks = defaultdict(threading.Lock)
+        self._tool_ids = {}
+
+    def log(self, fmt, *args):
+        with self.lock:
+            print(fmt.format(*args))
+            sys.stdout.flush()
+
+    def path_lock(self, path):
+        """Lock serializing the creation of path (a mirror file or a tool
+        checkout) between the stages"""
+        with self.lock:
+            return self._path_locks[path]
+
+    def tool_id(self, name, compute):
+        """Identity of a tool, computed once per run"""
+        with self.lock:
+            if name in self._tool_ids:
+                return self._tool_ids[name]
+        value = compute()
+        with self.lock:
+            return self._tool_ids.setdefault(name, value)
+
+    def run_tool(self, args, cwd):
+        """Run an external tool, raising PipelineError with the end of its
+        output if it fails"""
+        if self.verbose:
+            self.log("  $ {}", " ".join(args))
+        try:
+            process = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise PipelineError("Can't run {}: {}".format(args[0], e))
+        output = process.communicate()[0].decode("utf-8", "replace")
+        if process.returncode != 0:
+            tail = "\n".join(output.splitlines()[-10:])
+            raise PipelineError("{} failed with status {}:\n{}".format(
+                os.path.basename(args[0]), process.returncode, tail))
+        return output
+
+    def checkout(self, repository):
+        """Path of a checkout of the (url, commit) repository, cloned from
+        the mirror if it holds it, from its URL otherwise"""
+        url, commit = repository
+        name = os.path.basename(url)
+        path = os.path.join(self.tools_dir, "{}-{}".format(name, commit))
+        with self.path_lock(path):
+            if os.path.isdir(path):
+                return path
+
+            source = os.path.join(self.mirror_dir, name)
+            if not os.path.isdir(source):
+                if not self.download:
+                    raise PipelineError("{} is not in the mirror ({}), use "
+                                        "--download".format(name, source))
+                source = url
+
+            tmp = tempfile.mkdtemp(dir=self.tools_dir, prefix=".tmp-")
+            try:
+                self.run_tool(["git", "clone", "-q", source, tmp], None)
+                self.run_tool(["git", "-c", "advice.detachedHead=false",
+                               "checkout", "-q", commit], tmp)
+                os.rename(tmp, path)
+            except BaseException:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            return path
+
+
+def fetch(ctx, stage, inputs, scratch):
+    url = stage.params["url"]
+    path = os.path.join(ctx.mirror_dir, os.path.basename(url))
+
+    with ctx.path_lock(path):
+        if not os.path.exists(path):
+            if not ctx.download:
+                raise PipelineError("{} is not in the mirror, use --download"
+                                    .format(path))
+            ctx.log("Downloading {}...", url)
+            if not os.path.isdir(ctx.mirror_dir):
+                os.makedirs(ctx.mirror_dir)
+            fd, tmp = tempfile.mkstemp(dir=ctx.mirror_dir, prefix=".tmp-")
+            try:
+                request = Request(url, headers={"User-Agent": USER_AGENT})
+                with os.fdopen(fd, "wb") as f:
+                    shutil.copyfileobj(urlopen(request), f, 1024 * 1024)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+    # The mirror file is used in place, the store doesn't keep a copy of it
+    digest = me_hashes.hash_files([path], ctx.hashes)[os.path.abspath(path)]
+    return Artifact(digest, os.path.getsize(path), path=path)
+
+
+def innoextract(ctx, stage, inputs, scratch):
+    member = stage.params["member"]
+    ctx.run_tool(["innoextract", "-s", "-I", member, "-d", scratch,
+                  inputs[0].path], scratch)
+    return os.path.join(scratch, member)
+
+
+def innoextract_tool(ctx, stage):
+    return ctx.tool_id("innoextract", lambda: ctx.run_tool(
+        ["innoextract", "--version"], None).splitlines()[0])
+
+
+def unzip(ctx, stage, inputs, scratch):
+    source = inputs[0].path or io.BytesIO(inputs[0].data)
+    with zipfile.ZipFile(source) as z:
+        try:
+            return z.read(stage.params["member"])
+        except KeyError:
+            raise PipelineError("No {} in the archive"
+                                .format(stage.params["member"]))
+
+
+def dell_pfs_extract(ctx, stage, inputs, scratch):
+    tool = os.path.join(ctx.checkout(BIOSUTILITIES), "Dell_PFS_Extract.py")
+    # The extracted files are named after the installer, next to it
+    installer = os.path.join(scratch, stage.params["installer"])
+    try:
+        os.link(inputs[0].path, installer)
+    except OSError:
+        clone_file(inputs[0].path, installer)
+
+    ctx.run_tool([sys.executable, tool, installer, "-e"], scratch)
+    return os.path.join(installer + "_extracted", stage.params["member"])
+
+
+def me_cleaner_stage(ctx, stage, inputs, scratch):
+    params = dict(stage.params)
+    extract_me = params.pop("extract_me", False)
+    options = me_cleaner.CleanOptions(
+        output=os.path.join(scratch, "image.bin"), json=True, **params)
+    if extract_me:
+        options.extract_me = os.path.join(scratch, "me.bin")
+
+    # The input may be a file of the mirror or of the store: -O leaves it
+    # untouched
+    report = me_cleaner.Report(text=False)
+    try:
+        me_cleaner.clean(inputs[0].path, options, report)
+    except me_cleaner.MeCleanerError as e:
+        raise PipelineError("me_cleaner: {}".format(e))
+    return options.extract_me or options.output
+
+
+def me_cleaner_tool(ctx, stage):
+    return ctx.tool_id("me_cleaner", me_cleaner.cache_tool_id)
+
+
+def deguard(ctx, stage, inputs, scratch):
+    path = ctx.checkout(DEGUARD)
+    output = os.path.join(scratch, "me.bin")
+    ctx.run_tool([sys.executable, "./finalimage.py",
+                  "--delta", "data/delta/" + stage.params["delta"],
+                  "--version", stage.params["version"],
+                  "--pch", stage.params["pch"],
+                  "--sku", stage.params["sku"],
+                  "--fake-fpfs", "data/fpfs/zero",
+                  "--input", os.path.abspath(inputs[0].path),
+                  "--output", output], path)
+    return output
+
+
+def pad(ctx, stage, inputs, scratch):
+    """As dd if=/dev/zero of=file bs=1 seek=$((size - 1)) count=1: truncate
+    or zero-extend to size bytes, the last one being 0"""
+    size = stage.params["size"]
+    data = inputs[0].read()[:size - 1]
+    return data + b"\0" * (size - len(data))
+
+
+def in_process_tool(ctx, stage):
+    return ctx.tool_id("me_pipeline",
+                       lambda: tool_id("me_pipeline", [__file__]))
+
+
+STAGE_KINDS = {
+    "fetch": StageKind(fetch, None),
+    "innoextract": StageKind(innoextract, innoextract_tool),
+    "unzip": StageKind(unzip, in_process_tool),
+    "dell_pfs_extract": StageKind(
+        dell_pfs_extract, lambda ctx, stage: "Dell_PFS_Extract {}".format(
+            BIOSUTILITIES[1])),
+    "me_cleaner": StageKind(me_cleaner_stage, me_cleaner_tool),
+    "deguard": StageKind(
+        deguard, lambda ctx, stage: "deguard {}".format(DEGUARD[1])),
+    "pad": StageKind(pad, in_process_tool),
+}
+
+
+def run_stage(ctx, stage, inputs):
+    """Run a stage, or get its artifact from the store; return the artifact
+    and whether it came from the store"""
+    kind = STAGE_KINDS[stage.kind]
+    key = None
+    if kind.tool is not None:
+        key = ctx.store.key([a.digest for a in inputs],
+                            [stage.kind, kind.tool(ctx, stage)],
+                            stage.params)
+        entry = ctx.store.get(key)
+        if entry is not None:
+            digest = entry["files"]["output"]
+            path = ctx.store.object_path(digest)
+            return Artifact(digest, os.path.getsize(path), path=path), True
+
+    scratch = tempfile.mkdtemp(dir=ctx.scratch_dir, prefix=stage.kind + "-")
+    try:
+        output = kind.run(ctx, stage, inputs, scratch)
+        if isinstance(output, Artifact):
+            artifact = output
+        elif isinstance(output, bytes):
+            artifact = Artifact(None, len(output), data=output)
+        elif os.path.isfile(output):
+            artifact = Artifact(None, os.path.getsize(output))
+        else:
+            raise PipelineError("{} produced no {}".format(
+                stage.kind, os.path.relpath(output, scratch)))
+
+        if key is not None:
+            # Adding the object and its entry must not interleave with the
+            # eviction done by another stage
+            with ctx.lock:
+                if artifact.data is not None:
+                    artifact.digest = ctx.store.add_data(artifact.data)
+                else:
+                    artifact.digest = ctx.store.add_object(output, move=True)
+                ctx.store.put_entry(key, {"output": artifact.digest},
+                                    {"stage": stage.name})
+                artifact.path = ctx.store.object_path(artifact.digest)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return artifact, False
+
+
+def run_pipeline(ctx, pipeline, targets, jobs=None):
+    """Run the stages needed by the targets, concurrently on jobs threads.
+    Return the artifacts and the errors of the stages, by name; the stages
+    depending on a failed one are not run."""
+
+    pending = pipeline.closure(targets)
+    artifacts = {}
+    errors = {}
+    running = {}
+
+    def check(name, artifact):
+        expected = pipeline.stages[name].sha256
+        if expected and artifact.digest != expected:
+            raise PipelineError("unexpected SHA-256 {} (expected {})"
+                                .format(artifact.digest, expected))
+
+    with ThreadPoolExecutor(
+            max_workers=jobs or me_cleaner.available_cpus()) as executor:
+        while True:
+            for name in sorted(pending):
+                stage = pipeline.stages[name]
+                if any(i in errors for i in stage.inputs):
+                    errors[name] = "not run, an input failed"
+                    pending.discard(name)
+                elif all(i in artifacts for i in stage.inputs):
+                    future = executor.submit(
+                        run_stage, ctx, stage,
+                        [artifacts[i] for i in stage.inputs])
+                    running[future] = (name, time.time())
+                    pending.discard(name)
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, start = running.pop(future)
+                try:
+                    artifact, cached = future.result()
+                    check(name, artifact)
+                except (PipelineError, EnvironmentError) as e:
+                    errors[name] = str(e)
+                    ctx.log("FAILED {}: {}", name, e)
+                    continue
+                artifacts[name] = artifact
+                ctx.log("{:<8} {} ({} bytes, {:.2f} s)",
+                        "cached" if cached else "done", name, artifact.size,
+                        time.time() - start)
+
+    return artifacts, errors
+
+
+# Output = (file name in the board directory, stage name, expected SHA-256)
+Output = namedtuple("Output", "filename stage sha256")
+
+# directory: of the board under blobs/, holding its hashes.txt
+# script: download script of the board, in that directory
+# add_stages(p, variables, hashes): add the stages of the board to a
+#     Pipeline and return its Outputs
+Board = namedtuple("Board", "directory script add_stages")
+
+SCRIPT_VARIABLE = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)=\"?([^\"]*)\"?\s*$")
+
+
+def script_variables(filename):
+    """The variables assigned at the top level of a download script"""
+    variables = {}
+    with open(filename) as f:
+        for line in f:
+            match = SCRIPT_VARIABLE.match(line)
+            if match:
+                variables[match.group(1)] = match.group(2)
+    return variables
+
+
+def read_board(board):
+    """The variables of the download script of a board and the SHA-256 of
+    the files of its hashes.txt, by file name, as taken by its add_stages:
+    the pipeline uses the same parameters and hashes as the script"""
+    directory = os.path.join(BLOBS_DIR, board.directory)
+    variables = script_variables(os.path.join(directory, board.script))
+    hashes = {os.path.basename(path): digest for digest, path in
+              me_hashes.read_manifest(os.path.join(directory, "hashes.txt"))}
+    return variables, hashes
+
+
+def sha256sum_digest(line):
+    """The digest of a "<sha256>  <file>" line, as checked by sha256sum"""
+    return line.split()[0].lower()
+
+
+def deguard_params(variables):
+    return dict(delta=variables["ME_delta"], version=variables["ME_version"],
+                pch=variables["ME_pch"], sku=variables["ME_sku"])
+
+
+def board_xx20(p, variables, hashes):
+    exe = p.add(stage(
+        "83rf46ww.exe", "fetch",
+        url="https://download.lenovo.com/ibmdl/pub/pc/pccbbs/mobiles/"
+            "83rf46ww.exe",
+        sha256=sha256sum_digest(variables["ME_EXE_SHA256SUM"])))
+    update = p.add(stage(
+        "ME7_5M_UPD_Production.bin", "innoextract", [exe],
+        member="app/ME7_5M_UPD_Production.bin",
+        sha256=sha256sum_digest(
+            variables["ME7_5M_UPD_PRODUCTION_SHA256SUM"])))
+    # As me7_update_parser.py
+    me = p.add(stage("xx20 me.bin", "me_cleaner", [update],
+                     from_update=True, relocate=True, truncate=True))
+    return [Output("me.bin", me, hashes["me.bin"])]
+
+
+def board_xx30(p, variables, hashes):
+    exe = p.add(stage("g1rg24ww.exe", "fetch",
+                      url="https://download.lenovo.com/pccbbs/mobiles/"
+                          "g1rg24ww.exe"))
+    me8 = p.add(stage("ME8_5M_Production.bin", "innoextract", [exe],
+                      member="app/ME8_5M_Production.bin"))
+    # The script runs the me_cleaner of coreboot, this stage the one of this
+    # tree: its output is checked against the me.bin of hashes.txt, as the
+    # one of the script, and is not installed if they differ
+    me = p.add(stage("xx30 me.bin", "me_cleaner", [me8], relocate=True,
+                     truncate=True))
+    return [Output("me.bin", me, hashes["me.bin"])]
+
+
+def dell_5468_me(p, variables):
+    """The ME of the Dell Inspiron 5468, cleaned for deguard: the MFS is
+    kept and FTPR is not relocated"""
+    installer = "Inspiron_5468_1.3.0.exe"
+    exe = p.add(stage(
+        installer, "fetch",
+        url="https://dl.dell.com/FOLDER04573471M/1/" + installer,
+        sha256=variables["ME_DOWNLOAD_HASH"]))
+    update = p.add(stage(
+        "Inspiron_5468 ME update", "dell_pfs_extract", [exe],
+        installer=installer,
+        member="Firmware/1 Inspiron_5468_1.3.0 -- 3 Intel Management Engine "
+               "(Non-VPro) Update v{}.bin".format(variables["ME_version"])))
+    return p.add(stage("Inspiron_5468 cleaned ME", "me_cleaner", [update],
+                       whitelist="MFS", truncate=True))
+
+
+def thinkpad_tb(p, board, installer, variables):
+    exe = p.add(stage(installer, "fetch",
+                      url="https://download.lenovo.com/pccbbs/mobiles/" +
+                      installer, sha256=variables["TB_DOWNLOAD_HASH"]))
+    tbt = p.add(stage(installer + " TBT.bin", "innoextract", [exe],
+                      member="code$GetExtractPath$/TBT.bin"))
+    # The script pads with dd seek=TBFW_SIZE count=1
+    return p.add(stage(board + " tb.bin", "pad", [tbt],
+                       size=int(variables["TBFW_SIZE"]) + 1))
+
+
+def board_t480(p, variables, hashes):
+    me = p.add(stage("t480 me.bin", "deguard", [dell_5468_me(p, variables)],
+                     **deguard_params(variables)))
+    tb = thinkpad_tb(p, "t480", "n24th13w.exe", variables)
+    return [Output("t480_me.bin", me, hashes["t480_me.bin"]),
+            Output("t480_tb.bin", tb, hashes["t480_tb.bin"])]
+
+
+def board_t480s(p, variables, hashes):
+    me = p.add(stage("t480s me.bin", "deguard", [dell_5468_me(p, variables)],
+                     **deguard_params(variables)))
+    tb = thinkpad_tb(p, "t480s", "n22th11w.exe", variables)
+    return [Output("t480s_me.bin", me, hashes["t480s_me.bin"]),
+            Output("t480s_tb.bin", tb, hashes["t480s_tb.bin"])]
+
+
+def board_m900(p, variables, hashes):
+    archive = p.add(stage(
+        "H110M-DGS(7.30)ROM.zip", "fetch",
+        url="https://download.asrock.com/BIOS/1151/H110M-DGS(7.30)ROM.zip",
+        sha256=variables["ME_DOWNLOAD_HASH"]))
+    dump = p.add(stage("H11MDGS7.30", "unzip", [archive],
+                       member="H11MDGS7.30"))
+    cleaned = p.add(stage("H11MDGS7.30 cleaned ME", "me_cleaner", [dump],
+                          whitelist="MFS", truncate=True, extract_me=True))
+    me = p.add(stage("m900 me.bin", "deguard", [cleaned],
+                     **deguard_params(variables)))
+    return [Output("m900_me.bin", me, hashes["m900_me.bin"])]
+
+
+BOARDS = {
+    "xx20": Board("xx20", "download_parse_me.sh", board_xx20),
+    "xx30": Board("xx30", "download_clean_me.sh", board_xx30),
+    "t480": Board("xx80", "t480_download_clean_deguard_me_pad_tb.sh",
+                  board_t480),
+    "t480s": Board("xx80", "t480s_download_clean_deguard_me_pad_tb.sh",
+                   board_t480s),
+    "m900": Board("m900", "m900_download_clean_deguard_me.sh", board_m900),
+}
+
+
+def outputs_match(ctx, board_dir, outputs):
+    statuses = me_hashes.check([(o.sha256, os.path.join(board_dir, o.filename))
+                                for o in outputs], ctx.hashes)
+    return all(status == "OK" for status in statuses)
+
+
+def install(artifact, path):
+    """Copy an artifact to the board directory"""
+    if artifact.data is not None and artifact.path is None:
+        with open(path + ".tmp", "wb") as f:
+            f.write(artifact.data)
+        os.replace(path + ".tmp", path)
+    else:
+        clone_file(artifact.path, path)
+
+
+def regenerate(ctx, boards, output_root, jobs=None, force=False):
+    """Regenerate the blobs of the boards whose outputs are missing or don't
+    match their hashes (all of them if force is set); return the names of
+    the boards that failed"""
+
+    pipeline = Pipeline()
+    todo = {}
+    for board in boards:
+        directory, _, add_stages = BOARDS[board]
+        board_dir = os.path.join(output_root, directory)
+        outputs = add_stages(pipeline, *read_board(BOARDS[board]))
+        if not force and outputs_match(ctx, board_dir, outputs):
+            ctx.log("{}: all outputs match, nothing to do", board)
+        else:
+            todo[board] = (board_dir, outputs)
+
+    targets = [o.stage for _, outputs in todo.values() for o in outputs]
+    artifacts, errors = run_pipeline(ctx, pipeline, targets, jobs)
+
+    failed = []
+    for board, (board_dir, outputs) in sorted(todo.items()):
+        for output in outputs:
+            path = os.path.join(board_dir, output.filename)
+            if output.stage in errors:
+                ctx.log("{}: {} not generated: {}", board, path,
+                        errors[output.stage])
+            elif artifacts[output.stage].digest != output.sha256:
+                ctx.log("{}: {} has an unexpected SHA-256 {}", board, path,
+                        artifacts[output.stage].digest)
+            else:
+                install(artifacts[output.stage], path)
+                ctx.log("{}: {} OK", board, path)
+                continue
+            if board not in failed:
+                failed.append(board)
+
+    ctx.hashes.save()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download, extract, clean, "
+                                     "deguard and pad the ME/TXE and "
+                                     "Thunderbolt blobs of the boards, in "
+                                     "parallel")
+    parser.add_argument("boards", nargs="*", metavar="board",
+                        help="boards to process: {} (default: all)"
+                        .format(", ".join(sorted(BOARDS))))
+    parser.add_argument("-m", "--mirror", metavar="mirror_dir",
+                        help="directory holding the vendor files and the "
+                        "clones of the tools (default: mirror/ in the "
+                        "store)")
+    parser.add_argument("--download", help="download the files missing from "
+                        "the mirror", action="store_true")
+    parser.add_argument("-s", "--store", metavar="store_dir",
+                        default=DEFAULT_STORE, help="directory of the "
+                        "intermediate artifacts (default: %(default)s)")
+    parser.add_argument("--store-size", metavar="MiB", type=int,
+                        default=DEFAULT_STORE_SIZE // (1024 * 1024),
+                        help="size limit of the store (default: "
+                        "%(default)s)")
+    parser.add_argument("-o", "--output-root", metavar="blobs_dir",
+                        default=BLOBS_DIR, help="directory holding the "
+                        "board directories (default: the blobs directory of "
+                        "this tree)")
+    parser.add_argument("-j", "--jobs", metavar="jobs", type=int,
+                        help="stages run at the same time (default: number "
+                        "of CPUs)")
+    parser.add_argument("-f", "--force", help="regenerate the outputs even "
+                        "if they match", action="store_true")
+    parser.add_argument("-v", "--verbose", help="print the external "
+                        "commands", action="store_true")
+    args = parser.parse_args(argv)
+
+    for board in args.boards:
+        if board not in BOARDS:
+            parser.error("unknown board \"{}\"".format(board))
+
+    ctx = PipelineContext(args.store,
+                          args.mirror or os.path.join(args.store, "mirror"),
+                          args.download, args.store_size * 1024 * 1024,
+                          args.verbose, me_hashes.default_cache())
+
+    start = time.time()
+    failed = regenerate(ctx, args.boards or sorted(BOARDS),
+                        args.output_root, args.jobs, args.force)
+    ctx.log("{:.2f} s", time.time() - start)
+    if failed:
+        sys.exit("Failed: {}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# me_profile - Per-phase profiling of me_cleaner runs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# A Profiler is a phase hook of a Report: it samples the clocks and the I/O
+# counters of the process when a phase starts and stops, and keeps the
+# difference. The I/O counters come from /proc/self/io (Linux only): bytes
+# and system calls of read() and write() like calls, whatever the file, so
+# the accesses through a memory map only show up as page faults (from
+# getrusage, where available). Nested phases are included in the phases
+# enclosing them.
+
+from __future__ import division, print_function
+
+import cProfile
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROC_IO = "/proc/self/io"
+
+# Counters of a sample, besides the clocks, and their fields in /proc/self/io
+IO_FIELDS = (("read_bytes", b"rchar"), ("written_bytes", b"wchar"),
+             ("read_syscalls", b"syscr"), ("write_syscalls", b"syscw"))
+
+
+class IoCounters:
+    """Reader of /proc/self/io that leaves its own reads out of the counts"""
+
+    def __init__(self):
+        try:
+            self.fd = os.open(PROC_IO, os.O_RDONLY)
+        except (OSError, AttributeError):
+            self.fd = None
+        self.own_bytes = 0
+        self.own_reads = 0
+
+    @property
+    def available(self):
+        return self.fd is not None
+
+    def sample(self):
+        data = os.pread(self.fd, 4096, 0)
+        fields = dict(line.split(b": ") for line in data.splitlines())
+        counters = {name: int(fields[field]) for name, field in IO_FIELDS}
+        # The counters include the reads of the previous samples, not this one
+        counters["read_bytes"] -= self.own_bytes
+        counters["read_syscalls"] -= self.own_reads
+        self.own_bytes += len(data)
+        self.own_reads += 1
+        return counters
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Profiler:
+    """Collect, for each phase, the number of calls, the wall and CPU time,
+    the bytes read and written, the read and write system calls and the page
+    faults. Use it as a hook of a Report (Report.add_hook); as a context
+    manager, it also runs cProfile if python_profile is set."""
+
+    def __init__(self, python_profile=False):
+        self.phases = {}
+        self.events = []
+        self.io = IoCounters()
+        self.python_profile = cProfile.Profile() if python_profile else None
+        self._starts = []
+        self._origin = time.perf_counter()
+
+        self.counters = ["wall", "cpu"]
+        if self.io.available:
+            self.counters += [name for name, _ in IO_FIELDS]
+        if resource is not None:
+            self.counters.append("page_faults")
+
+    def sample(self):
+        values = {"wall": time.perf_counter(), "cpu": time.process_time()}
+        if self.io.available:
+            values.update(self.io.sample())
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            values["page_faults"] = usage.ru_minflt + usage.ru_majflt
+        return values
+
+    def __call__(self, event, name):
+        if event == "start":
+            self.phases.setdefault(name, dict.fromkeys(["calls"] +
+                                                       self.counters, 0))
+            self._starts.append((name, self.sample()))
+        elif event == "stop":
+            stop = self.sample()
+            start_name, start = self._starts.pop()
+            assert start_name == name
+
+            phase = self.phases[name]
+            phase["calls"] += 1
+            delta = {}
+            for counter, value in stop.items():
+                delta[counter] = value - start[counter]
+                phase[counter] += delta[counter]
+
+            self.events.append({
+                "name": name,
+                "cat": "me_cleaner",
+                "ph": "X",
+                "ts": (start["wall"] - self._origin) * 1e6,
+                "dur": delta.pop("wall") * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.current_thread().ident,
+                "args": delta,
+            })
+
+    def __enter__(self):
+        if self.python_profile:
+            self.python_profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.python_profile:
+            self.python_profile.disable()
+        self.io.close()
+
+    def to_dict(self):
+        return {"counters": self.counters, "phases": self.phases}
+
+    def format_table(self):
+        """The phases as lines of text, in the order they first started"""
+        columns = [("calls", "calls", "{:d}"), ("wall", "wall ms", "{:.2f}"),
+                   ("cpu", "cpu ms", "{:.2f}"),
+                   ("read_bytes", "read", "{:d}"),
+                   ("written_bytes", "written", "{:d}"),
+                   ("read_syscalls", "reads", "{:d}"),
+                   ("write_syscalls", "writes", "{:d}"),
+                   ("page_faults", "faults", "{:d}")]
+        columns = [c for c in columns
+                   if c[0] == "calls" or c[0] in self.counters]
+
+        lines = ["{:<12}".format("phase") +
+                 "".join("{:>11}".format(title) for _, title, _ in columns)]
+        for name, phase in self.phases.items():
+            cells = []
+            for counter, _, fmt in columns:
+                value = phase[counter]
+                if counter in ("wall", "cpu"):
+                    value *= 1000
+                cells.append("{:>11}".format(fmt.format(value)))
+            lines.append("{:<12}".format(name) + "".join(cells))
+        return lines
+
+    def save_stats(self, filename):
+        """Save the cProfile statistics, to be loaded with pstats"""
+        self.python_profile.dump_stats(filename)
+
+    def save_trace(self, filename):
+        """Save the phases in the Chrome trace event format (chrome://tracing,
+        Perfetto)"""
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.events,
+                       "displayTimeUnit": "ms"}, f, indent=1)
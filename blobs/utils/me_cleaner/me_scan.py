@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+
+# me_scan - Index of the ME/TXE images of a directory tree
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# Every regular file of the scanned trees is recorded in an SQLite database,
+# with its inode, size and modification time: a file that still has the same
+# ones is not scanned again, unless the scanner itself changed. A file is
+# parsed only if it starts like an ME/TXE image or a full dump ($FPT or the
+# descriptor signature at 0x0 or 0x10); it is read through a memory map, so
+# only the structures parse_image() and the module lists need are read.
+#
+# For each image the index holds the regions of the descriptor, the FPT
+# entries, the $CPD entries of the code partitions (generation 3, from the
+# directories decoded once by MeImage), the version, variant and public key
+# of the FTPR manifest, its
+# signature validity and the SHA-256 of its signed parts (which identifies
+# the firmware), and the minimum size of the ME region as me_cleaner would
+# compute it with and without -r. The minimum sizes come from a cleaning
+# recorded in an EditPlan, so the files are never modified.
+
+from __future__ import division, print_function
+
+import argparse
+import binascii
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import me_cleaner
+import me_signature
+from me_cache import tool_id
+
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER, size INTEGER, mtime_ns INTEGER, scanned_at REAL,
+    status TEXT,            -- me, other or error
+    error TEXT,
+    type TEXT,              -- full dump or ME/TXE image
+    generation INTEGER, version TEXT, variant TEXT,
+    pubkey_md5 TEXT, pubkey_known INTEGER,
+    signature_valid INTEGER, manifest_sha256 TEXT,
+    min_size INTEGER, min_size_relocated INTEGER,
+    me_start INTEGER, me_end INTEGER, fpt_offset INTEGER,
+    ftpr_start INTEGER, ftpr_end INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_version ON files (version);
+CREATE INDEX IF NOT EXISTS files_pubkey ON files (pubkey_md5);
+CREATE INDEX IF NOT EXISTS files_manifest ON files (manifest_sha256);
+CREATE TABLE IF NOT EXISTS regions (
+    path TEXT, name TEXT, start INTEGER, end INTEGER
+);
+CREATE INDEX IF NOT EXISTS regions_path ON regions (path);
+CREATE TABLE IF NOT EXISTS partitions (
+    path TEXT, idx INTEGER, name TEXT, offset INTEGER, length INTEGER,
+    flags INTEGER
+);
+CREATE INDEX IF NOT EXISTS partitions_path ON partitions (path);
+CREATE TABLE IF NOT EXISTS modules (
+    path TEXT, partition TEXT, name TEXT, offset INTEGER, length INTEGER,
+    huffman INTEGER
+);
+CREATE INDEX IF NOT EXISTS modules_path ON modules (path);
+CREATE INDEX IF NOT EXISTS modules_name ON modules (name);
+"""
+
+FILE_COLUMNS = ("path", "inode", "size", "mtime_ns", "scanned_at", "status",
+                "error", "type", "generation", "version", "variant",
+                "pubkey_md5", "pubkey_known", "signature_valid",
+                "manifest_sha256", "min_size", "min_size_relocated",
+                "me_start", "me_end", "fpt_offset", "ftpr_start", "ftpr_end")
+
+# Magic numbers at 0x0 or 0x10 of the files worth parsing
+MAGICS = (b"$FPT", b"\x5a\xa5\xf0\x0f")
+
+TABLES = ("meta", "files", "regions", "partitions", "modules")
+
+BATCH_SIZE = 32
+COMMIT_INTERVAL = 1.0
+
+
+def scanner_id():
+    """Identity of the scanner, including me_cleaner: the files scanned by
+    another version are scanned again"""
+    return "{} / {}".format(tool_id("me_scan", [__file__]),
+                            me_cleaner.cache_tool_id())
+
+
+def min_size(f, relocate):
+    """Minimum size of the ME region of the image in f, cleaned with the
+    default options (and -r if relocate is set), or None"""
+    plan_file = me_cleaner.PlanFile(f)
+    report = me_cleaner.Report(text=False)
+    image = me_cleaner.parse_image(plan_file, report)
+    try:
+        end_addr = me_cleaner.clean_partitions(
+            image.mef, image, me_cleaner.CleanOptions(relocate=relocate),
+            report)
+    except (me_cleaner.MeCleanerError, me_cleaner.OutOfRegionException):
+        return None
+    return end_addr if end_addr > 0 else None
+
+
+def scan_image(f, record):
+    """Fill record with what parse_image() finds in f, and return the
+    regions, the partitions and the $CPD entries of the image"""
+    image = me_cleaner.parse_image(f, me_cleaner.Report(text=False))
+    record.update(status="me", generation=image.gen, me_start=image.me_start,
+                  me_end=image.me_end,
+                  type="full dump" if image.full_dump else "ME/TXE image")
+
+    regions = []
+    if image.full_dump:
+        regions = [("descriptor", image.fd_start, image.fd_end),
+                   ("bios", image.bios_start, image.bios_end),
+                   ("me", image.me_start, image.me_end)]
+    if image.me_disabled:
+        return regions, [], []
+
+    partitions = [(i, p.name, p.offset, p.length, p.flags)
+                  for i, p in enumerate(image.partitions)]
+    modules = []
+    if image.gen == 3:
+        modules = [(name, e.name, image.me_start + d.offset + e.offset,
+                    e.length, e.huffman)
+                   for name, d in image.code_partitions.items()
+                   for e in d.entries]
+
+    manifest = me_signature.read_signed_manifest(
+        image.mef, image.ftpr_manifest_offset)
+    record.update(version=image.version_string, variant=image.variant,
+                  pubkey_md5=image.pubkey_md5,
+                  pubkey_known=image.pubkey_known,
+                  signature_valid=me_signature.verify(manifest),
+                  manifest_sha256=binascii.hexlify(manifest.digest)
+                  .decode("ascii"),
+                  fpt_offset=image.me_start + image.fpt_offset,
+                  ftpr_start=image.me_start + image.ftpr_offset,
+                  ftpr_end=image.me_start + image.ftpr_offset +
+                  image.ftpr_length)
+
+    if image.gen != 1:
+        record["min_size"] = min_size(f, False)
+        record["min_size_relocated"] = min_size(f, True)
+
+    return regions, partitions, modules
+
+
+def scan_file(path, st):
+    """Scan a file; return its record (a dict of FILE_COLUMNS), its regions,
+    its partitions and its $CPD entries"""
+    record = dict.fromkeys(FILE_COLUMNS)
+    record.update(path=path, inode=st[0], size=st[1], mtime_ns=st[2],
+                  scanned_at=time.time(), status="other")
+    regions = partitions = modules = []
+
+    try:
+        with open(path, "rb") as f:
+            head = f.read(0x14)
+        if head[0x0:0x4] not in MAGICS and head[0x10:0x14] not in MAGICS:
+            return record, regions, partitions, modules
+
+        f = me_cleaner.open_image(path, "rb")
+        try:
+            regions, partitions, modules = scan_image(f, record)
+        finally:
+            f.close()
+    except me_cleaner.MeCleanerError as e:
+        record.update(status="error", error=str(e))
+    except Exception as e:
+        record.update(status="error",
+                      error="{}: {}".format(type(e).__name__, e))
+
+    return record, regions, partitions, modules
+
+
+def scan_files(items):
+    return [scan_file(path, st) for path, st in items]
+
+
+def open_index(filename):
+    db = sqlite3.connect(filename)
+    if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        for table in TABLES:
+            db.execute("DROP TABLE IF EXISTS " + table)
+        db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+    db.executescript(SCHEMA)
+    return db
+
+
+def walk(roots):
+    """The regular files of the trees (or the files) in roots, as absolute
+    path and (inode, size, mtime_ns)"""
+    for root in roots:
+        root = os.path.abspath(root)
+        if os.path.isfile(root):
+            st = os.stat(root)
+            yield root, (st.st_ino, st.st_size, st.st_mtime_ns)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if st.st_mode & 0o170000 == 0o100000:
+                    yield path, (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def store(db, results):
+    for record, regions, partitions, modules in results:
+        path = record["path"]
+        for table in TABLES[2:]:
+            db.execute("DELETE FROM {} WHERE path = ?".format(table),
+                       (path,))
+        db.execute("INSERT OR REPLACE INTO files ({}) VALUES ({})".format(
+            ", ".join(FILE_COLUMNS), ", ".join("?" * len(FILE_COLUMNS))),
+            [record[c] for c in FILE_COLUMNS])
+        db.executemany("INSERT INTO regions VALUES (?, ?, ?, ?)",
+                       [(path,) + r for r in regions])
+        db.executemany("INSERT INTO partitions VALUES (?, ?, ?, ?, ?, ?)",
+                       [(path,) + p for p in partitions])
+        db.executemany("INSERT INTO modules VALUES (?, ?, ?, ?, ?, ?)",
+                       [(path,) + m for m in modules])
+
+
+def scan(db, roots, workers=None, prune=True, on_result=None):
+    """Scan the files of roots that changed since they were indexed, on
+    workers processes; with prune, forget the indexed files under roots that
+    no longer exist. Return the numbers of files seen and scanned."""
+
+    current_id = scanner_id()
+    row = db.execute("SELECT value FROM meta WHERE key = 'scanner'")\
+        .fetchone()
+    rescan_all = row is None or row[0] != current_id
+
+    known = {}
+    if not rescan_all:
+        known = {path: (inode, size, mtime_ns)
+                 for path, inode, size, mtime_ns in
+                 db.execute("SELECT path, inode, size, mtime_ns FROM files")}
+
+    seen = set()
+    todo = []
+    for path, st in walk(roots):
+        seen.add(path)
+        if known.get(path) != st:
+            todo.append((path, st))
+
+    if prune:
+        roots = [os.path.abspath(r) for r in roots]
+        prefixes = tuple(os.path.join(r, "") for r in roots)
+        gone = [(path,) for path, in db.execute("SELECT path FROM files")
+                if path not in seen and
+                (path in roots or path.startswith(prefixes))]
+        for table in TABLES[1:]:
+            db.executemany("DELETE FROM {} WHERE path = ?".format(table),
+                           gone)
+
+    batches = [todo[i:i + BATCH_SIZE]
+               for i in range(0, len(todo), BATCH_SIZE)]
+    last_commit = time.time()
+    if len(batches) > 1 and workers != 1:
+        with ProcessPoolExecutor(workers or me_cleaner.available_cpus()) \
+                as executor:
+            futures = [executor.submit(scan_files, b) for b in batches]
+            for future in as_completed(futures):
+                results = future.result()
+                store(db, results)
+                if on_result:
+                    for result in results:
+                        on_result(result[0])
+                if time.time() - last_commit > COMMIT_INTERVAL:
+                    db.commit()
+                    last_commit = time.time()
+    else:
+        for batch in batches:
+            results = scan_files(batch)
+            store(db, results)
+            if on_result:
+                for result in results:
+                    on_result(result[0])
+
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('scanner', ?)",
+               (current_id,))
+    db.commit()
+    return len(seen), len(todo)
+
+
+QUERY_COLUMNS = ("path", "status", "generation", "version", "variant",
+                 "pubkey_known", "signature_valid", "min_size",
+                 "min_size_relocated", "error")
+
+
+def print_rows(rows):
+    for row in rows:
+        values = dict(zip(QUERY_COLUMNS, row))
+        if values["status"] != "me":
+            print("{path}: {status} {error}".format(**values).rstrip())
+            continue
+        print("{}: {} {} gen {}, key {}, signature {}, min. size {}/{}"
+              .format(values["path"], values["variant"], values["version"],
+                      values["generation"],
+                      "known" if values["pubkey_known"] else "unknown",
+                      "VALID" if values["signature_valid"] else "INVALID",
+                      "-" if values["min_size"] is None
+                      else "{:#x}".format(values["min_size"]),
+                      "-" if values["min_size_relocated"] is None
+                      else "{:#x}".format(values["min_size_relocated"])))
+
+
+def query(db, where, params):
+    return db.execute("SELECT {} FROM files WHERE {} ORDER BY path".format(
+        ", ".join(QUERY_COLUMNS), where), params).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index the ME/TXE images "
+                                     "of directory trees in an SQLite "
+                                     "database and query it")
+    parser.add_argument("roots", nargs="*", metavar="path",
+                        help="directories (or files) to scan")
+    parser.add_argument("-d", "--database", metavar="index.db",
+                        default="me_index.db", help="index database "
+                        "(default: %(default)s)")
+    parser.add_argument("-j", "--jobs", metavar="jobs", type=int,
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument("--no-prune", help="keep the deleted files in the "
+                        "index", action="store_true")
+    parser.add_argument("-v", "--verbose", help="print each scanned file",
+                        action="store_true")
+    queries = parser.add_mutually_exclusive_group()
+    queries.add_argument("--same-firmware", metavar="file", help="list the "
+                         "images holding the same firmware (FTPR manifest) "
+                         "as file, as indexed")
+    queries.add_argument("--version", metavar="version", help="list the "
+                         "images of a firmware version, or of the versions "
+                         "starting with it")
+    queries.add_argument("--pubkey", metavar="md5", help="list the images "
+                         "signed with a public key")
+    queries.add_argument("--module", metavar="name", help="list the images "
+                         "with a $CPD entry called name (generation 3)")
+    queries.add_argument("--errors", help="list the files that look like "
+                         "images but can't be parsed", action="store_true")
+    queries.add_argument("--summary", help="count the images by version and "
+                         "public key", action="store_true")
+    args = parser.parse_args(argv)
+
+    db = open_index(args.database)
+
+    if args.roots:
+        start = time.time()
+        seen, scanned = scan(
+            db, args.roots, args.jobs, not args.no_prune,
+            (lambda r: print("{path}: {status}".format(**r)))
+            if args.verbose else None)
+        print("{} file(s), {} scanned in {:.2f} s".format(
+            seen, scanned, time.time() - start), file=sys.stderr)
+
+    if args.same_firmware:
+        row = db.execute("SELECT manifest_sha256 FROM files WHERE path = ?",
+                         (os.path.abspath(args.same_firmware),)).fetchone()
+        if row is None or row[0] is None:
+            sys.exit("{} is not an indexed image".format(args.same_firmware))
+        print_rows(query(db, "manifest_sha256 = ?", row))
+    elif args.version:
+        print_rows(query(db, "version = ? OR version LIKE ?",
+                         (args.version, args.version + ".%")))
+    elif args.pubkey:
+        print_rows(query(db, "pubkey_md5 = ?", (args.pubkey.lower(),)))
+    elif args.module:
+        print_rows(query(db, "path IN (SELECT path FROM modules WHERE "
+                         "name = ?)", (args.module,)))
+    elif args.errors:
+        print_rows(query(db, "status = 'error'", ()))
+    elif args.summary:
+        for row in db.execute("SELECT variant, version, pubkey_md5, "
+                              "pubkey_known, COUNT(*) FROM files WHERE "
+                              "status = 'me' GROUP BY variant, version, "
+                              "pubkey_md5 ORDER BY variant, version"):
+            print("{} {:<16} {} ({}) {:>6} image(s)".format(
+                row[0], row[1], row[2], "known" if row[3] else "unknown",
+                row[4]))
+    elif not args.roots:
+        parser.error("nothing to scan or query")
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
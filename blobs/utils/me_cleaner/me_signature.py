@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# me_signature - Verification of the RSA signature of ME/TXE manifests
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# A $MN2 manifest holds a 0x80 bytes header, the RSA public key (modulus and
+# exponent, little endian), the signature (little endian) and then the rest
+# of the manifest. The signature is an EMSA-PKCS1-v1_5 encoding of the
+# SHA-256 of the header and of the data following the signature.
+#
+# The results are memoized by modulus, exponent, signature and digest, so
+# that the same manifest (in a copy of the image, or in another image) is
+# verified only once per process.
+
+from __future__ import division, print_function
+
+import hashlib
+from collections import namedtuple
+from struct import unpack
+
+from me_structs import ManifestHeader
+
+
+# DER encoding of the DigestInfo of a SHA-256 digest, RFC 8017 9.2
+DIGEST_INFO_SHA256 = bytes.fromhex("3031300d060960864801650304020105000420")
+
+# Results of the verifications done so far, by SignedManifest
+MAX_VERIFIED = 4096
+_verified = {}
+
+SignedManifest = namedtuple("SignedManifest",
+                            "modulus exponent signature digest")
+
+
+def read_signed_manifest(f, offset):
+    """Read the public key and the signature of the manifest at offset in f
+    and hash its signed parts"""
+    f.seek(offset)
+    header = f.read(0x80)
+    modulus = f.read(0x100)
+    exponent = unpack("<I", f.read(4))[0]
+    signature = f.read(0x100)
+
+    manifest = ManifestHeader.unpack_from(header)
+    header_len = manifest.header_length * 4
+    manifest_len = manifest.size * 4
+    f.seek(offset + header_len)
+
+    sha256 = hashlib.sha256()
+    sha256.update(header)
+    sha256.update(f.read(manifest_len - header_len))
+
+    return SignedManifest(modulus, exponent, signature, sha256.digest())
+
+
+def pkcs1_digest(em):
+    """Return the digest in the EMSA-PKCS1-v1_5 encoded message em, with or
+    without its DigestInfo, or None if em is not well formed"""
+    if em[:2] != b"\x00\x01":
+        return None
+    sep = em.find(b"\x00", 2)
+    # At least 8 bytes of padding
+    if sep < 10 or em[2:sep].strip(b"\xff"):
+        return None
+    digest = em[sep + 1:]
+    if digest.startswith(DIGEST_INFO_SHA256):
+        digest = digest[len(DIGEST_INFO_SHA256):]
+    return digest
+
+
+def _verify(manifest):
+    n = int.from_bytes(manifest.modulus, "little")
+    s = int.from_bytes(manifest.signature, "little")
+    if n == 0 or s >= n:
+        return False
+    em = pow(s, manifest.exponent, n).to_bytes((n.bit_length() + 7) // 8,
+                                               "big")
+    return pkcs1_digest(em) == manifest.digest
+
+
+def verify(manifest):
+    """Verify a SignedManifest"""
+    try:
+        return _verified[manifest]
+    except KeyError:
+        return _remember(manifest, _verify(manifest))
+
+
+def _remember(manifest, valid):
+    if len(_verified) >= MAX_VERIFIED:
+        _verified.clear()
+    _verified[manifest] = valid
+    return valid
+
+
+def check_partition_signature(f, offset):
+    """Verify the signature of the manifest at offset in f"""
+    return verify(read_signed_manifest(f, offset))
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+# me_structs - Records of the structures found in ME/TXE images
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# Each record is decoded at once by a precompiled Struct, straight from the
+# buffer holding it (bytes, bytearray, mmap or memoryview), and keeps its
+# fields in slots. Tables are read with a single read and decoded in place.
+
+from __future__ import division, print_function
+
+from struct import Struct
+
+
+def flreg_to_start_end(flreg):
+    return (flreg & 0x7fff) << 12, (flreg >> 4 & 0x7fff000 | 0xfff) + 1
+
+
+def start_end_to_flreg(start, end):
+    return (start & 0x7fff000) >> 12 | ((end - 1) & 0x7fff000) << 4
+
+
+class Record:
+    """Fixed size little-endian structure: the fields are the __slots__ of
+    the subclass, in the order of its STRUCT"""
+
+    __slots__ = ()
+    STRUCT = Struct("")
+
+    def __init__(self, *fields):
+        for name, value in zip(self.__slots__, fields):
+            setattr(self, name, value)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        return cls(*cls.STRUCT.unpack_from(buf, offset))
+
+    @classmethod
+    def array_from(cls, buf, offset, count, stride=None):
+        """Decode count records laid out every stride bytes (default: the
+        size of the record) from offset in buf"""
+        unpack_from = cls.STRUCT.unpack_from
+        stride = stride or cls.STRUCT.size
+        return [cls(*unpack_from(buf, offset + i * stride))
+                for i in range(count)]
+
+    @classmethod
+    def read(cls, f, offset):
+        """Read and decode the record at offset in the file object f"""
+        f.seek(offset)
+        return cls.unpack_from(f.read(cls.STRUCT.size))
+
+    @classmethod
+    def read_array(cls, f, offset, count, stride=None):
+        """Read a table of count records from offset in f in a single read,
+        and decode it"""
+        stride = stride or cls.STRUCT.size
+        f.seek(offset)
+        return cls.array_from(memoryview(f.read(count * stride)), 0, count,
+                              stride)
+
+    def pack(self):
+        return self.STRUCT.pack(*(getattr(self, name)
+                                  for name in self.__slots__))
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(name, getattr(self, name))
+            for name in self.__slots__))
+
+
+def _ascii(tag):
+    return tag.rstrip(b"\x00").decode("ascii")
+
+
+class FlashMap(Record):
+    """FLMAP0-2 of the flash descriptor, at 0x4 (generation 1) or 0x14"""
+
+    __slots__ = ("flmap0", "flmap1", "flmap2")
+    STRUCT = Struct("<III")
+
+    @property
+    def frba(self):
+        return self.flmap0 >> 12 & 0xff0
+
+    @property
+    def fmba(self):
+        return (self.flmap1 & 0xff) << 4
+
+    @property
+    def fisba(self):
+        # FPSBA on generations 2 and 3
+        return self.flmap1 >> 12 & 0xff0
+
+    @property
+    def fmsba(self):
+        return (self.flmap2 & 0xff) << 4
+
+
+class FlashRegions(Record):
+    """FLREG0-2 of the flash descriptor, at FRBA"""
+
+    __slots__ = ("descriptor", "bios", "me")
+    STRUCT = Struct("<III")
+
+
+class FptHeader(Record):
+    """Header of the FPT partition table, at 0x0 or 0x10 in the ME region"""
+
+    __slots__ = ("tag", "num_entries", "header_version", "entry_version",
+                 "header_length", "checksum", "flash_cycle_life",
+                 "flash_cycle_limit", "uma_size", "flags", "fitc_major",
+                 "fitc_minor", "fitc_hotfix", "fitc_build")
+    STRUCT = Struct("<4sIBBBBHHIIHHHH")
+
+
+class FptEntry(Record):
+    """Entry of the FPT partition table, following its header"""
+
+    __slots__ = ("tag", "owner", "offset", "length", "start_tokens",
+                 "max_tokens", "scratch_sectors", "flags")
+    STRUCT = Struct("<4s4sIIIIII")
+
+    @property
+    def name(self):
+        try:
+            return _ascii(self.tag)
+        except UnicodeDecodeError:
+            return "????"
+
+    @property
+    def raw(self):
+        return self.pack()
+
+
+class ManifestHeader(Record):
+    """Header of a $MAN/$MN2 manifest, followed by the RSA public key and
+    signature. Lengths are in dwords."""
+
+    __slots__ = ("header_type", "header_length", "header_version", "flags",
+                 "vendor", "date", "size", "tag", "num_modules", "major",
+                 "minor", "hotfix", "build")
+    STRUCT = Struct("<IIIIIII4sIHHHH")
+
+    @property
+    def version(self):
+        return self.major, self.minor, self.hotfix, self.build
+
+
+class ModuleHeader(Record):
+    """$MME header of a module of the FTPR partition (generation 2), from
+    0x290 in the manifest, every 0x60 or 0x80 bytes"""
+
+    __slots__ = ("tag", "raw_name", "hash", "base", "offset",
+                 "uncompressed_size", "size", "memory_size", "pre_uma_size",
+                 "entry_point", "flags")
+    STRUCT = Struct("<4s16s32sIIIIIIII")
+
+    @property
+    def name(self):
+        return _ascii(self.raw_name)
+
+    @property
+    def compression(self):
+        return (self.flags >> 4) & 7
+
+
+class CpdHeader(Record):
+    """Header of a $CPD directory (generation 3)"""
+
+    __slots__ = ("tag", "num_entries", "header_version", "entry_version",
+                 "header_length", "checksum", "partition_name")
+    STRUCT = Struct("<4sIBBBB4s")
+
+    @property
+    def name(self):
+        return _ascii(self.partition_name)
+
+
+class CpdEntry(Record):
+    """Entry of a $CPD directory, from 0x10"""
+
+    __slots__ = ("raw_name", "offset_block", "length", "reserved")
+    STRUCT = Struct("<12sIII")
+
+    @property
+    def name(self):
+        return _ascii(self.raw_name)
+
+    @property
+    def offset(self):
+        return self.offset_block & 0x01ffffff
+
+    @property
+    def huffman(self):
+        return (self.offset_block & 0x02000000) >> 25
+
+
+class LlutHeader(Record):
+    """Header of the LLUT of the Huffman compressed modules, followed by the
+    table of the chunks at 0x40"""
+
+    __slots__ = ("tag", "chunk_count", "addr_base", "spi_base",
+                 "huffman_size", "huffman_offset", "reserved", "chunk_size")
+    STRUCT = Struct("<4sIIIII24sI")
+
+    @property
+    def huffman_end(self):
+        return self.huffman_offset + self.huffman_size
+
+    @property
+    def start_correction(self):
+        # Bytes 0x1:0x3 of the AddrBase, added to the SpiBase by the ROM
+        return self.addr_base >> 8 & 0xffff
+
+
+class CpdDirectory:
+    """$CPD directory of a code partition (generation 3): its header, its
+    entries in directory order and an index of the entries by name. The
+    entries follow the header (0x10 bytes, 0x14 with a CRC32 since header
+    version 2); their offsets are relative to the partition."""
+
+    # Enough for the header and 84 entries, read at once by read()
+    READ_SIZE = 0x800
+
+    def __init__(self, offset, header, entries):
+        self.offset = offset
+        self.header = header
+        self.entries = entries
+        self.index = {}
+        for entry in entries:
+            self.index.setdefault(entry.name, entry)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Decode the directory at offset in buf, or return None if there is
+        no $CPD tag there. A truncated table gives the entries it holds."""
+        if len(buf) < offset + CpdHeader.STRUCT.size or \
+           buf[offset:offset + 4] != b"$CPD":
+            return None
+        header = CpdHeader.unpack_from(buf, offset)
+        start = offset + max(header.header_length, CpdHeader.STRUCT.size)
+        count = min(header.num_entries,
+                    max(len(buf) - start, 0) // CpdEntry.STRUCT.size)
+        return cls(offset, header, CpdEntry.array_from(buf, start, count))
+
+    @classmethod
+    def read(cls, f, offset, limit=None):
+        """Read the directory at offset in the file object f (in a single
+        read unless it has more than 84 entries) and decode it. The first
+        read stops at limit, the offset where f ends, if given; the rest of
+        the table is then read as needed, up to limit too (a truncated table
+        gives the entries it holds)."""
+        f.seek(offset)
+        size = cls.READ_SIZE
+        if limit is not None:
+            size = max(min(size, limit - offset), 0)
+        data = f.read(size)
+        if len(data) >= CpdHeader.STRUCT.size and data[0:4] == b"$CPD":
+            header = CpdHeader.unpack_from(data)
+            end = max(header.header_length, CpdHeader.STRUCT.size) + \
+                header.num_entries * CpdEntry.STRUCT.size
+            if limit is not None:
+                end = min(end, limit - offset)
+            if end > len(data):
+                data += f.read(end - len(data))
+        directory = cls.unpack_from(memoryview(data))
+        if directory is not None:
+            directory.offset = offset
+        return directory
+
+    @property
+    def name(self):
+        return self.header.name
+
+    def get(self, name):
+        """The entry called name, or None"""
+        return self.index.get(name)
+
+    def modules(self, partition_length):
+        """The (entry, start, end) extents of the entries of a partition of
+        partition_length bytes, by offset: each one ends where the next one
+        (or the partition) starts"""
+        ends = sorted([(partition_length, None)] +
+                      [(entry.offset, entry) for entry in self.entries],
+                      key=lambda x: x[0])
+        return [(entry, start, ends[i + 1][0]) for i, (start, entry)
+                in enumerate(ends[:len(self.entries)]) if entry is not None]
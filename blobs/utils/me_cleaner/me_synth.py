@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+# me_synth - Synthetic Intel ME/TXE firmware images for benchmarking
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# The images generated here are structurally valid (descriptor, FPT, FTPR
+# manifest, $MME/LLUT/$CPD tables, RSA signature) but contain no code: every
+# data byte is pseudo-random. They are only meant to exercise the parsing and
+# editing paths of me_cleaner.py and me7_update_parser.py, see me_bench.py.
+# The RSA key is generated from a fixed seed, so it is not one of the known
+# Intel keys.
+
+from __future__ import division, print_function
+
+import argparse
+import hashlib
+import random
+from struct import pack, pack_into
+
+from me_signature import DIGEST_INFO_SHA256
+
+
+SMALL_PRIMES = (3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59,
+                61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113)
+
+GEN2_MODULES = ("BUP", "KERNEL", "POLICY", "HOSTCOMM", "RSA", "CLS", "TDT",
+                "FPF", "SESSMGR", "NFC", "PAVP", "KVM", "EFFS", "MCTP")
+GEN3_MODULES = ("rbe", "kernel", "syslib", "bup", "pm", "vfs", "evtdisp",
+                "loadmgr", "busdrv", "gpio", "prtc", "policy", "crypto",
+                "heci", "storage", "pmdrv", "maestro", "fpf", "hci", "mca")
+
+_keys = {}
+
+
+def _is_probable_prime(n, rng, rounds=16):
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for _ in range(rounds):
+        x = pow(rng.randrange(2, n - 2), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def _random_prime(bits, e, rng):
+    while True:
+        p = rng.getrandbits(bits) | (3 << (bits - 2)) | 1
+        if (p - 1) % e != 0 and _is_probable_prime(p, rng):
+            return p
+
+
+def rsa_key(seed=1, bits=2048, e=0x11):
+    """Return a deterministic (modulus, exponent, private exponent) tuple"""
+    if seed not in _keys:
+        rng = random.Random(seed)
+        p = _random_prime(bits // 2, e, rng)
+        q = _random_prime(bits // 2, e, rng)
+        _keys[seed] = (p * q, e, pow(e, -1, (p - 1) * (q - 1)))
+
+    return _keys[seed]
+
+
+def sign_manifest(ftpr, mn2_offset, key):
+    """Fill the RSA public key and the signature of the manifest at
+    mn2_offset, which must already contain its final header and data"""
+    modulus, e, d = key
+    header_len = (0x284 // 4) * 4
+    manifest_len = \
+        int.from_bytes(ftpr[mn2_offset + 0x18:mn2_offset + 0x1c], "little") * 4
+
+    ftpr[mn2_offset + 0x80:mn2_offset + 0x180] = \
+        modulus.to_bytes(0x100, "little")
+    pack_into("<I", ftpr, mn2_offset + 0x180, e)
+
+    sha256 = hashlib.sha256()
+    sha256.update(ftpr[mn2_offset:mn2_offset + 0x80])
+    sha256.update(ftpr[mn2_offset + header_len:mn2_offset + manifest_len])
+
+    tail = DIGEST_INFO_SHA256 + sha256.digest()
+    em = b"\x00\x01" + b"\xff" * (0x100 - 3 - len(tail)) + b"\x00" + tail
+    signature = pow(int.from_bytes(em, "big"), d, modulus)
+    ftpr[mn2_offset + 0x184:mn2_offset + 0x284] = \
+        signature.to_bytes(0x100, "little")
+
+
+def manifest_header(tag, num_modules, manifest_len, version):
+    header = bytearray(0x80)
+    pack_into("<HHIII", header, 0x0, 0x4, 0x0, 0x284 // 4, 0x10000, 0)
+    pack_into("<II", header, 0x10, 0x8086, 0x20180101)
+    pack_into("<I", header, 0x18, manifest_len // 4)
+    header[0x1c:0x20] = tag
+    pack_into("<I", header, 0x20, num_modules)
+    pack_into("<HHHH", header, 0x24, *version)
+    return header
+
+
+def align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def build_ftpr_gen2(rng, base, key, num_modules=8, huffman_modules=4,
+                    chunk_count=256, chunk_size=0x1000, version=(9, 1, 0, 1),
+                    tag=b"$MN2"):
+    """Build a generation 1/2 FTPR partition with $MME module headers.
+
+    base is the absolute offset of the partition, used for the LLUT and
+    Huffman chunk addresses. The first module is an uncompressed ROMP, the
+    next huffman_modules share a LLUT of chunk_count chunks and the rest are
+    LZMA compressed. Returns the partition as a bytearray."""
+
+    num_modules = max(num_modules, huffman_modules + 1)
+    manifest_len = 0x290 + num_modules * 0x60
+    ftpr = bytearray(manifest_header(tag, num_modules, manifest_len, version))
+    ftpr += b"\x00" * (manifest_len - len(ftpr))
+    data_offset = align(manifest_len, 0x1000)
+    ftpr += b"\xff" * (data_offset - len(ftpr))
+
+    headers = []
+    for i in range(num_modules):
+        if i == 0:
+            name, comp_type = "ROMP", 0
+        elif i <= huffman_modules:
+            name, comp_type = GEN2_MODULES[(i - 1) % len(GEN2_MODULES)], 1
+        else:
+            name = GEN2_MODULES[(i - 1) % len(GEN2_MODULES)]
+            comp_type = 2
+        if i > len(GEN2_MODULES):
+            name = name[:12] + "{:02d}".format(i)
+        headers.append([name, comp_type, 0, 0, 0, 0])
+
+    for hdr in headers:
+        if hdr[1] != 1:
+            size = rng.randrange(0x800, 0x6000)
+            hdr[2] = len(ftpr)
+            hdr[3] = size
+            ftpr += rng.randbytes(size)
+            ftpr += b"\xff" * (align(len(ftpr), 0x10) - len(ftpr))
+
+    if huffman_modules:
+        llut_offset = align(len(ftpr), 0x100)
+        ftpr += b"\xff" * (llut_offset - len(ftpr))
+        addr_base = 0x20000
+        lut_start_corr = (addr_base >> 8) & 0xffff
+        huff_start = align(llut_offset + 0x40 + chunk_count * 4, 0x40)
+
+        chunks = []
+        pos = huff_start
+        for i in range(chunk_count):
+            if i % 37 == 36:
+                chunks.append(None)
+            else:
+                size = rng.randrange(0x100, chunk_size)
+                chunks.append(pos)
+                pos += size
+        huff_end = pos
+
+        llut = bytearray(0x40)
+        llut[0x0:0x4] = b"LLUT"
+        pack_into("<IIIII", llut, 0x4, chunk_count, addr_base,
+                  base + llut_offset + 0x40 - lut_start_corr,
+                  huff_end - huff_start, base + huff_start)
+        pack_into("<I", llut, 0x30, chunk_size)
+        for chunk in chunks:
+            if chunk is None:
+                llut += b"\x00\x00\x00\x80"
+            else:
+                llut += pack("<I", base + chunk)[0:3] + b"\x00"
+
+        ftpr += llut
+        ftpr += b"\xff" * (huff_start - len(ftpr))
+        ftpr += rng.randbytes(huff_end - huff_start)
+
+        first_chunk = 0
+        per_module = max(chunk_count // huffman_modules, 1)
+        for hdr in headers:
+            if hdr[1] == 1:
+                count = min(per_module, max(chunk_count - first_chunk, 1))
+                hdr[2] = llut_offset
+                hdr[3] = huff_end - llut_offset
+                hdr[4] = 0x10000000 + addr_base + first_chunk * chunk_size
+                hdr[5] = count * chunk_size - 1
+                first_chunk += count
+
+    for i, (name, comp_type, offset, size, mbase, msize) in \
+            enumerate(headers):
+        hdr = bytearray(0x60)
+        hdr[0x0:0x4] = b"$MME"
+        hdr[0x4:0x4 + len(name)] = name.encode("ascii")
+        pack_into("<IIII", hdr, 0x34, mbase, offset, msize, size)
+        pack_into("<I", hdr, 0x50, comp_type << 4)
+        ftpr[0x290 + i * 0x60:0x290 + (i + 1) * 0x60] = hdr
+
+    sign_manifest(ftpr, 0, key)
+    ftpr += b"\xff" * (align(len(ftpr), 0x1000) - len(ftpr))
+
+    return ftpr
+
+
+def build_ftpr_gen3(rng, key, num_modules=12, version=(11, 6, 0, 1126)):
+    """Build a generation 3 FTPR partition with a $CPD directory"""
+    names = ["FTPR.man"]
+    for i in range(num_modules):
+        name = GEN3_MODULES[i % len(GEN3_MODULES)]
+        if i >= len(GEN3_MODULES):
+            name = name[:8] + "{:02d}".format(i)
+        names.append(name + ".met")
+        names.append(name)
+
+    header_len = 0x10 + len(names) * 0x18
+    ftpr = bytearray(align(header_len, 0x100))
+    ftpr[0x0:0x4] = b"$CPD"
+    pack_into("<IBBB", ftpr, 0x4, len(names), 1, 1, 0x10)
+    ftpr[0xc:0x10] = b"FTPR"
+
+    entries = []
+    for name in names:
+        if name == "FTPR.man":
+            manifest_len = 0x284 + 0x17c
+            offset = len(ftpr)
+            ftpr += manifest_header(b"$MN2", 0, manifest_len, version)
+            ftpr += b"\x00" * (manifest_len - 0x80)
+            comp_type = 0
+        else:
+            size = rng.randrange(0x40, 0x100) if name.endswith(".met") \
+                else rng.randrange(0x1000, 0x10000)
+            offset = len(ftpr)
+            ftpr += rng.randbytes(size)
+            comp_type = 0 if name.endswith(".met") else rng.randrange(2)
+        entries.append((name, offset, len(ftpr) - offset, comp_type))
+        ftpr += b"\xff" * (align(len(ftpr), 0x40) - len(ftpr))
+
+    mn2_offset = entries[0][1]
+    ftpr[mn2_offset + 0x284:mn2_offset + 0x400] = rng.randbytes(0x17c)
+    sign_manifest(ftpr, mn2_offset, key)
+
+    for i, (name, offset, length, comp_type) in enumerate(entries):
+        entry = 0x10 + i * 0x18
+        ftpr[entry:entry + len(name)] = name.encode("ascii")
+        pack_into("<II", ftpr, entry + 0xc, offset | comp_type << 25, length)
+
+    ftpr += b"\xff" * (align(len(ftpr), 0x1000) - len(ftpr))
+    return ftpr
+
+
+def build_me_region(size=0x180000, gen=2, seed=0, num_modules=None,
+                    huffman_modules=4, chunk_count=256):
+    """Build a $FPT based ME region of the given size.
+
+    The region contains an FTPR partition of the given generation (gen 1 uses
+    a CODE partition and a $MAN manifest), a MFS data partition, a FLOG data
+    partition, an NVRAM entry, an entry with no data and a NFTP partition
+    filling the remaining space."""
+
+    rng = random.Random(seed)
+    key = rsa_key()
+
+    if gen == 3:
+        ftpr = build_ftpr_gen3(rng, key, num_modules or 12)
+    else:
+        ftpr = None
+        ftpr_offset = 0x1000 + align(size // 8, 0x1000) + 0x1000
+
+    fpt_offset = 0 if gen == 1 else 0x10
+    region = bytearray(size)
+    region[0:fpt_offset] = rng.randbytes(fpt_offset)
+
+    mfs = (0x1000, align(size // 8, 0x1000))
+    flog = (mfs[0] + mfs[1], 0x1000)
+    if gen == 3:
+        ftpr_offset = flog[0] + flog[1]
+    elif ftpr is None:
+        ftpr = build_ftpr_gen2(rng, ftpr_offset, key, num_modules or 8,
+                               huffman_modules, chunk_count,
+                               version=(3, 0, 0, 1) if gen == 1 else
+                               (9, 1, 0, 1),
+                               tag=b"$MAN" if gen == 1 else b"$MN2")
+    nftp_offset = ftpr_offset + len(ftpr)
+    if nftp_offset + 0x1000 > size:
+        raise ValueError("ME region too small for the FTPR partition "
+                         "({:#x} bytes needed)".format(nftp_offset + 0x1000))
+
+    partitions = (
+        (b"CODE" if gen == 1 else b"FTPR", ftpr_offset, len(ftpr), 0x00),
+        (b"MFS\x00", mfs[0], mfs[1], 0x01),
+        (b"FLOG", flog[0], flog[1], 0x01),
+        (b"UTOK", 0, 0, 0x01),
+        (b"SCA\x00", 0, 0x4000, 0x02),
+        (b"NFTP", nftp_offset, size - nftp_offset, 0x00),
+    )
+
+    header = fpt_offset
+    region[header:header + 4] = b"$FPT"
+    pack_into("<IBBBBHHI", region, header + 0x4, len(partitions), 0x20, 0x10,
+              0x20, 0, 7, 100, 0x20)
+    pack_into("<I", region, header + 0x14, 0x00000001)
+    for i, (name, offset, length, flags) in enumerate(partitions):
+        entry = header + 0x20 + i * 0x20
+        region[entry:entry + 4] = name
+        pack_into("<4sIIIIII", region, entry + 0x4, b"\xff" * 4, offset,
+                  length, 1, 1, 0, flags)
+
+    if gen == 3:
+        checksummed = region[0x10:0x30]
+    else:
+        checksummed = region[0x0:0x30]
+    region[0x1b] = (0x100 - sum(checksummed) & 0xff) & 0xff
+
+    region[mfs[0]:mfs[0] + mfs[1]] = rng.randbytes(mfs[1])
+    region[flog[0]:flog[0] + flog[1]] = rng.randbytes(flog[1])
+    region[ftpr_offset:ftpr_offset + len(ftpr)] = ftpr
+    region[nftp_offset:] = rng.randbytes(size - nftp_offset)
+
+    return region
+
+
+def flreg(start, end):
+    return (start >> 12) & 0x7fff | (((end - 1) >> 12) & 0x7fff) << 16
+
+
+def build_full_dump(size=0x800000, me_size=0x180000, gen=2, seed=0,
+                    **kwargs):
+    """Build a full SPI dump: flash descriptor, ME region and BIOS region"""
+    rng = random.Random(seed + 1)
+    image = bytearray(rng.randbytes(size))
+    fd = bytearray(b"\xff" * 0x1000)
+    sig = 0x0 if gen == 1 else 0x10
+    frba, fmba, fisba, fmsba = 0x40, 0x80, 0x100, 0x200
+
+    fd[sig:sig + 4] = b"\x5a\xa5\xf0\x0f"
+    pack_into("<III", fd, sig + 0x4, (frba >> 4) << 16 | 0x03,
+              fmba >> 4 | (fisba >> 4) << 16, fmsba >> 4)
+    pack_into("<III", fd, frba, flreg(0, 0x1000),
+              flreg(0x1000 + me_size, size), flreg(0x1000, 0x1000 + me_size))
+    pack_into("<III", fd, fmba, 0x0a0b0000, 0x0c0d0000, 0x08080118)
+    pack_into("<I", fd, fisba, 0x00000000)
+    pack_into("<I", fd, fisba + 0x28, 0x00000000)
+    pack_into("<I", fd, fmsba, 0x00000000)
+
+    image[0:0x1000] = fd
+    image[0x1000:0x1000 + me_size] = build_me_region(me_size, gen, seed,
+                                                     **kwargs)
+    return image
+
+
+def build_me7_update(seed=0, **kwargs):
+    """Build an ME 7.x update image in the layout expected by
+    me7_update_parser.py: a bare FTPR partition whose LLUT addresses refer to
+    its original offset in the factory region (0xCC000)"""
+    kwargs.setdefault("version", (7, 1, 0, 1))
+    kwargs.setdefault("chunk_count", 96)
+    ftpr = build_ftpr_gen2(random.Random(seed), 0xCC000, rsa_key(), **kwargs)
+    if len(ftpr) > 0x76000:
+        raise ValueError("Update image too large ({:#x} bytes)"
+                         .format(len(ftpr)))
+    return ftpr + b"\xff" * (0x80000 - len(ftpr))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic Intel "
+                                     "ME/TXE firmware images")
+    parser.add_argument("output", help="output file")
+    parser.add_argument("-g", "--gen", type=int, default=2, choices=(1, 2, 3),
+                        help="ME generation (default 2)")
+    parser.add_argument("-f", "--full", metavar="size", type=lambda x:
+                        int(x, 0), help="generate a full dump of this size "
+                        "instead of a bare ME region")
+    parser.add_argument("-u", "--me7-update", action="store_true",
+                        help="generate an ME 7.x update image for "
+                        "me7_update_parser.py")
+    parser.add_argument("-s", "--me-size", type=lambda x: int(x, 0),
+                        default=0x180000, help="ME region size")
+    parser.add_argument("-m", "--modules", type=int, help="number of modules")
+    parser.add_argument("-H", "--huffman-modules", type=int, default=4,
+                        help="number of Huffman modules (generation 2)")
+    parser.add_argument("-c", "--chunks", type=int,
+                        help="number of LLUT chunks (generation 2, default "
+                        "256, 96 with -u)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # The builders have their own default chunk counts
+    options = {"huffman_modules": args.huffman_modules}
+    if args.chunks is not None:
+        options["chunk_count"] = args.chunks
+
+    if args.me7_update:
+        image = build_me7_update(args.seed, num_modules=args.modules or 8,
+                                 **options)
+    elif args.full:
+        image = build_full_dump(args.full, args.me_size, args.gen, args.seed,
+                                num_modules=args.modules, **options)
+    else:
+        image = build_me_region(args.me_size, args.gen, args.seed,
+                                num_modules=args.modules, **options)
+
+    with open(args.output, "wb") as f:
+        f.write(image)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# me_update - Layouts of the ME regions built from ME update images
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# The update images shipped by the vendors hold a bare FTPR partition, with
+# the LLUT and the Huffman chunks addresses still referring to its offset in
+# the factory ME region. me_cleaner --from-update puts the partition back at
+# that offset, behind the FPT header and the FTPR entry of the layout of the
+# image, and then cleans, relocates and truncates it as any ME region.
+
+from __future__ import division, print_function
+
+from collections import namedtuple
+from struct import pack
+
+from me_structs import FptEntry, FptHeader
+
+
+# Flags of an FPT entry
+ENTRY_TYPE = 0x40
+ENTRY_DIRECT_ACCESS = 0x80
+ENTRY_READ = 0x100
+ENTRY_WRITE = 0x200
+ENTRY_EXECUTE = 0x400
+ENTRY_LOGICAL = 0x800
+ENTRY_WOP_DISABLE = 0x1000
+ENTRY_EXCL_BLOCK_USE = 0x2000
+
+# versions: prefixes of (major, minor, hotfix, build) of the FTPR manifest
+# pubkeys_md5: public keys of the FTPR manifest, as in me_cleaner.pubkeys_md5
+# ftpr_length: size of the FTPR partition, at the start of the update image
+# orig_ftpr_offset: offset of the FTPR partition in the factory ME region
+# minified_ftpr_offset: lowest offset of the relocated FTPR partition
+# rom_bypass, flash_cycle_life, flash_cycle_limit, uma_size, fpt_flags: the
+#     FPT header
+# ftpr_owner, ftpr_flags: the FTPR entry
+Layout = namedtuple("Layout", "name versions pubkeys_md5 ftpr_length "
+                    "orig_ftpr_offset minified_ftpr_offset rom_bypass "
+                    "flash_cycle_life flash_cycle_limit uma_size fpt_flags "
+                    "ftpr_owner ftpr_flags")
+
+LAYOUTS = [
+    Layout(name="ME 7.x 5MB",
+           versions=((7,),),
+           pubkeys_md5=("0903fc25b0f6bed8c4ed724aca02124c",),
+           ftpr_length=0x76000,
+           orig_ftpr_offset=0xcc000,
+           minified_ftpr_offset=0x400,
+           rom_bypass=bytes.fromhex("2020800f40000010") + pack("<II", 0, 0),
+           flash_cycle_life=7,
+           flash_cycle_limit=100,
+           uma_size=32,
+           fpt_flags=0xfffffc00,
+           ftpr_owner=b"\xff\xff\xff\xff",
+           ftpr_flags=ENTRY_EXCL_BLOCK_USE | ENTRY_EXECUTE | ENTRY_WRITE |
+           ENTRY_READ | ENTRY_DIRECT_ACCESS),
+]
+
+
+def find_layout(version, pubkey_md5):
+    """Return the layout of the update images of the given version, and
+    whether their public key is the expected one, or (None, False)"""
+    layouts = [layout for layout in LAYOUTS
+               if any(version[:len(v)] == v for v in layout.versions)]
+    for layout in layouts:
+        if pubkey_md5 in layout.pubkeys_md5:
+            return layout, True
+    if layouts:
+        return layouts[0], False
+    return None, False
+
+
+def region_size(layout):
+    return layout.orig_ftpr_offset + layout.ftpr_length
+
+
+def fpt_header(layout):
+    """ROM bypass and FPT header of a region holding only the FTPR partition,
+    0x30 bytes"""
+    header = bytearray(layout.rom_bypass + FptHeader(
+        b"$FPT", 1, 0x20, 0x10, 0x30, 0, layout.flash_cycle_life,
+        layout.flash_cycle_limit, layout.uma_size, layout.fpt_flags,
+        0, 0, 0, 0).pack())
+    header[0x1b] = (0x100 - sum(header) & 0xff) & 0xff
+    return bytes(header)
+
+
+def ftpr_entry(layout):
+    """FPT entry of the FTPR partition, at its offset in the factory region"""
+    return FptEntry(b"FTPR", layout.ftpr_owner, layout.orig_ftpr_offset,
+                    layout.ftpr_length, 1, 1, 0, layout.ftpr_flags).pack()
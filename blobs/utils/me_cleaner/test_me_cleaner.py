@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# test_me_cleaner - Regression tests of me_cleaner on synthetic images
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# The fixtures are generated by me_synth in a temporary directory. Run from
+# this directory with:
+#
+#   python3 -m unittest test_me_cleaner
+
+from __future__ import division, print_function
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from struct import pack
+
+import me_cleaner
+import me_synth
+from me_structs import CpdDirectory
+
+
+class DisabledGen1DumpTest(unittest.TestCase):
+    """A generation 1 dump whose ME region was disabled by a previous run:
+    the descriptor can still be checked and extracted"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.image = os.path.join(self.dir, "dump.bin")
+        with open(self.image, "wb") as f:
+            f.write(me_synth.build_full_dump(0x400000, 0x100000, 1, 6))
+        self.clean(me_cleaner.CleanOptions())
+        with open(self.image, "rb") as f:
+            self.data = f.read()
+
+    def clean(self, options):
+        return me_cleaner.clean(self.image, options,
+                                me_cleaner.Report(text=False))
+
+    def test_check(self):
+        report = self.clean(me_cleaner.CleanOptions(check=True)).report
+        self.assertTrue(report.data["ok"])
+        self.assertTrue(report.data["me_region_already_disabled"])
+        self.assertEqual(report.data["descriptor_bits"], {
+            "meDisable ICHSTRP0": {"before": True, "after": True},
+            "meDisable MCHSTRP0": {"before": True, "after": True},
+        })
+
+    def test_extract_descriptor(self):
+        descriptor = os.path.join(self.dir, "fd.bin")
+        output = os.path.join(self.dir, "out.bin")
+        report = self.clean(me_cleaner.CleanOptions(
+            extract_descriptor=descriptor, output=output)).report
+        self.assertTrue(report.data["ok"])
+        with open(descriptor, "rb") as f:
+            self.assertEqual(f.read(), self.data[:0x1000])
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+
+class CpdDirectoryTest(unittest.TestCase):
+
+    def test_truncated_table(self):
+        # num_entries is corrupted: the table would run past the region,
+        # and its 100 entries don't fit in the first read
+        data = b"\xff" * 0x100 + b"$CPD" + \
+            pack("<IBBBB4s", 1000, 1, 1, 0x10, 0, b"NFTP") + b"A" * 0x18 * 100
+        f = me_cleaner.RegionFile(io.BytesIO(data), 0, len(data))
+        directory = CpdDirectory.read(f, 0x100, len(data))
+        self.assertEqual(directory.name, "NFTP")
+        self.assertEqual(len(directory.entries), 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# test_me_pipeline - Consistency of me_pipeline with the download scripts
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+
+# The hashes and the deguard parameters of the boards are read from their
+# download scripts and hashes.txt; the URLs and the tool commits are checked
+# against the scripts here. Run from this directory with:
+#
+#   python3 -m unittest test_me_pipeline
+
+from __future__ import division, print_function
+
+import os
+import unittest
+
+import me_pipeline
+
+
+class BoardScriptsTest(unittest.TestCase):
+
+    def check_board(self, name):
+        board = me_pipeline.BOARDS[name]
+        with open(os.path.join(me_pipeline.BLOBS_DIR, board.directory,
+                               board.script)) as f:
+            script = f.read()
+
+        pipeline = me_pipeline.Pipeline()
+        outputs = board.add_stages(pipeline, *me_pipeline.read_board(board))
+        for output in outputs:
+            self.assertIn(output.sha256, script.lower(), output.filename)
+
+        tools = {"deguard": me_pipeline.DEGUARD,
+                 "dell_pfs_extract": me_pipeline.BIOSUTILITIES}
+        for stage_name in pipeline.closure(o.stage for o in outputs):
+            stage = pipeline.stages[stage_name]
+            if stage.kind == "fetch":
+                # The scripts name the file in a variable
+                url = stage.params["url"]
+                self.assertIn(url.rsplit("/", 1)[0] + "/", script)
+                self.assertIn(url.rsplit("/", 1)[1], script)
+            elif stage.kind in tools:
+                for part in tools[stage.kind]:
+                    self.assertIn(part, script)
+
+    def test_boards(self):
+        for name in sorted(me_pipeline.BOARDS):
+            self.check_board(name)
+
+
+if __name__ == "__main__":
+    unittest.main()